@@ -26,10 +26,11 @@ def inspect_chained_request(prepid):
 
 def get_all_chained_campaigns():
     chained_campaigns_db = database('chained_campaigns')
-    all_chained_campaigns_result = do_with_timeout(chained_campaigns_db.get_all, timeout=300)
-    if all_chained_campaigns_result:
-        prepids_list = [x['_id'] for x in all_chained_campaigns_result]
-    else:
+    prepids_list = do_with_timeout(
+        lambda: [x['_id'] for x in chained_campaigns_db.iter_view('chained_campaigns', 'all')],
+        timeout=300
+    )
+    if not prepids_list:
         prepids_list = []
 
     shuffle(prepids_list)
@@ -44,31 +45,24 @@ def multiple_inspect():
         try:
             print(('Current chained campaign: %s (%s/%s)' % (chained_campaign_prepid, chained_campaign_index + 1, len(chained_campaign_prepids))))
             chained_requests_db.clear_cache()
-            page = 0
-            chained_requests = [{}]
             query = {'member_of_campaign': chained_campaign_prepid,
                      'last_status': 'done',
                      'status': 'processing'}
 
-            while chained_requests:
-                print(('Chained campaign %s page %s' % (chained_campaign_prepid, page)))
-                chained_requests = do_with_timeout(chained_requests_db.search, query, page=page, timeout=120)
-                if not chained_requests:
-                    break
+            print(('Inspecting chained requests of %s' % (chained_campaign_prepid)))
+            for chained_request_dict in chained_requests_db.iter_search(query):
+                if not chained_request_dict.get('action_parameters', {}).get('flag', False):
+                    continue
 
-                page += 1
-                chained_requests = [x for x in chained_requests if x.get('action_parameters', {}).get('flag', False)]
-                print(('Inspecting chained requests of %s page %s number of requests %s' % (chained_campaign_prepid, page, len(chained_requests))))
-                for chained_request_dict in chained_requests:
-                    print(('Inspecting %s. %s. Step %s' % (chained_request_dict['prepid'],
-                                                          '->'.join(chained_request_dict['chain']),
-                                                          chained_request_dict['step'])))
-                    try:
-                        result = do_with_timeout(inspect_chained_request, chained_request_dict['prepid'], timeout=120)
-                        time.sleep(0.01)
-                    except Exception as e:
-                        print(('Exception while inspecting chained request %s' % (chained_request_dict['prepid'])))
-                        print(e)
+                print(('Inspecting %s. %s. Step %s' % (chained_request_dict['prepid'],
+                                                      '->'.join(chained_request_dict['chain']),
+                                                      chained_request_dict['step'])))
+                try:
+                    result = do_with_timeout(inspect_chained_request, chained_request_dict['prepid'], timeout=120)
+                    time.sleep(0.01)
+                except Exception as e:
+                    print(('Exception while inspecting chained request %s' % (chained_request_dict['prepid'])))
+                    print(e)
 
         except Exception as e:
             print(('Exception while inspecting %s' % (chained_campaign_prepid)))
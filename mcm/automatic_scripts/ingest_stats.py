@@ -0,0 +1,125 @@
+"""
+Follow the _changes feed of the Stats2 database and inspect only McM
+requests whose workflows changed, instead of sweeping all of them
+Checkpoint of the feed is stored in a file, so ingestion continues where it
+stopped, without a checkpoint it starts from the current sequence
+Usage: python3 ingest_stats.py [checkpoint file]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# Make sure the McM package is installed:
+# https://github.com/cms-PdmV/mcm_scripts?tab=readme-ov-file#build-package
+from rest import McM
+
+sys.path.append(os.path.abspath(os.path.pardir))
+from couchdb_layer.mcm_database import database
+
+dev = False
+dry_run = False
+cookie_file = Path(tempfile.TemporaryDirectory().name) / Path("cookie.txt")
+
+database_url = os.getenv("MCM_COUCHDB_URL")
+if not database_url:
+    raise RuntimeError("Set the McM database URL via: $MCM_COUCHDB_URL")
+
+stats_database_url = os.getenv("MCM_STATS2_DB_URL")
+if not stats_database_url:
+    raise RuntimeError("Set the Stats2 database URL via: $MCM_STATS2_DB_URL")
+
+checkpoint_file = sys.argv[1] if len(sys.argv) > 1 else 'ingest_stats_checkpoint.json'
+# Number of changes read at once
+changes_limit = 500
+# Number of requests inspected in one call to McM
+inspect_size = 50
+# Seconds for which Stats2 keeps the long poll open
+poll_timeout = 50
+# Seconds to wait after an error
+retry_delay = 30
+
+mcm = McM(dev=dev, cookie=cookie_file)
+stats_db = database('requests', url=stats_database_url, cache_enabled=False)
+requests_db = database('requests', cache_enabled=False)
+
+
+def load_checkpoint():
+    try:
+        with open(checkpoint_file) as checkpoint:
+            return json.load(checkpoint)['since']
+    except FileNotFoundError:
+        since = stats_db.changes(since='now')['last_seq']
+        print('No checkpoint in %s, starting from %s' % (checkpoint_file, since))
+        return since
+
+
+def save_checkpoint(since):
+    # Write and rename, so checkpoint is never half written
+    with open(checkpoint_file + '.tmp', 'w') as checkpoint:
+        json.dump({'since': since, 'time': int(time.time())}, checkpoint)
+
+    os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+
+def changed_prepids(changes):
+    """
+    Return prepids of submitted McM requests of changed workflows
+    """
+    workflow_names = sorted(set(c['id'] for c in changes
+                                if not c.get('deleted') and not c['id'].startswith('_design/')))
+    prepids = set()
+    for workflow in stats_db.bulk_get(workflow_names, include_fields='PrepID,Requests'):
+        if workflow.get('PrepID'):
+            prepids.add(workflow['PrepID'])
+
+        prepids.update(workflow.get('Requests') or [])
+
+    # Only submitted requests take new data from Stats2
+    requests = requests_db.bulk_get(sorted(prepids), include_fields='prepid,status')
+    return [r['prepid'] for r in requests if r.get('status') == 'submitted']
+
+
+def inspect(prepids):
+    """
+    Inspect requests in chunks, raise if any chunk was not inspected, so the
+    checkpoint is not moved over its changes
+    """
+    for start in range(0, len(prepids), inspect_size):
+        chunk = prepids[start:start + inspect_size]
+        url = mcm.server + 'restapi/requests/inspect/%s' % (','.join(chunk))
+        response = mcm.session.get(url=url)
+        print('Inspected %s requests, HTTP status %s' % (len(chunk), response.status_code))
+        if response.status_code != 200:
+            print('Output: %s' % (response.text))
+            raise RuntimeError('Inspection of %s failed with HTTP status %s' % (','.join(chunk),
+                                                                              response.status_code))
+
+
+def ingest():
+    since = load_checkpoint()
+    print('Following Stats2 changes since %s' % (since))
+    while True:
+        try:
+            result = stats_db.changes(since, timeout=poll_timeout, limit=changes_limit)
+            changes = result.get('results', [])
+            if changes:
+                prepids = changed_prepids(changes)
+                print('%s changes, %s submitted requests to inspect' % (len(changes), len(prepids)))
+                if prepids and not dry_run:
+                    inspect(prepids)
+
+            # Checkpoint moves only after all requests were inspected, after an
+            # error the same changes are read again, inspection is idempotent
+            since = result.get('last_seq', since)
+            save_checkpoint(since)
+        except Exception as ex:
+            print('Error while ingesting Stats2 changes since %s' % (since))
+            print(ex)
+            time.sleep(retry_delay)
+
+
+if __name__ == '__main__':
+    ingest()
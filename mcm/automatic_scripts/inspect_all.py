@@ -50,18 +50,45 @@ def do_with_timeout(func, *args, **kwargs):
     return result
 
 
-def inspect_campaign(campaign_prepid):
-    results = mcm.session.get(url=mcm.server + f"restapi/campaigns/inspect/{campaign_prepid}")
-    print("Inspect campaign HTTP request code: ", results.status_code)
-    return results.text
+def inspect_campaign(campaign_prepid, attempts=3):
+    """
+    Stream inspection output of a campaign, if the stream breaks, inspection
+    is resumed after the last cursor that McM reported
+    """
+    cursor = None
+    for attempt in range(1, attempts + 1):
+        url = mcm.server + f"restapi/campaigns/inspect/{campaign_prepid}"
+        params = {'cursor': cursor} if cursor else None
+        try:
+            with mcm.session.get(url=url, params=params, stream=True) as results:
+                print("Inspect campaign HTTP request code: ", results.status_code)
+                last_line = ''
+                for line in results.iter_lines(decode_unicode=True):
+                    if line.startswith('Cursor: '):
+                        cursor = line[len('Cursor: '):]
+                    elif line.startswith('Progress of ') or line.startswith('Inspection of '):
+                        print(line)
+
+                    last_line = line or last_line
+
+                if results.status_code == 200 and last_line.startswith('Inspection of '):
+                    return last_line
+        except Exception as e:
+            print(('Inspection of %s broke in attempt %s: %s' % (campaign_prepid, attempt, e)))
+
+        print(('Resuming inspection of %s from cursor %s' % (campaign_prepid, cursor)))
+        time.sleep(5)
+
+    return None
 
 
 def get_all_campaigns():
     campaigns_db = database('campaigns')
-    all_campaigns_result = do_with_timeout(campaigns_db.get_all, timeout=300)
-    if all_campaigns_result:
-        prepids_list = [x['_id'] for x in all_campaigns_result]
-    else:
+    prepids_list = do_with_timeout(
+        lambda: [x['_id'] for x in campaigns_db.iter_view('campaigns', 'all')],
+        timeout=300
+    )
+    if not prepids_list:
         prepids_list = []
 
     shuffle(prepids_list)
@@ -74,7 +101,7 @@ def multiple_inspect():
     for campaign_index, campaign_prepid in enumerate(campaign_prepids):
         try:
             print(('*** Current campaign: %s (%s/%s) ***' % (campaign_prepid, campaign_index + 1, len(campaign_prepids))))
-            result = do_with_timeout(inspect_campaign, campaign_prepid, timeout=3600)
+            result = inspect_campaign(campaign_prepid)
             print(('*** Finished inspecting campaign %s, result %s ***' % (campaign_prepid, result)))
             time.sleep(0.5)
         except Exception as e:
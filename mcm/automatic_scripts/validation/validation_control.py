@@ -107,10 +107,14 @@ class ValidationControl():
         Take list of requests that already had validation submitted to condor - list D
         Add lists A and B together and remove already submitted items - list D
         """
-        requests = self.request_db.search({'status': 'new', 'approval': 'validation'}, page=-1)
+        requests = self.request_db.search({'status': 'new', 'approval': 'validation'},
+                                          page=-1,
+                                          include_fields='prepid')
         requests = set(x['prepid'] for x in requests)
 
-        chained_requests = self.chained_request_db.search({'validate<int>': '1'}, page=-1)
+        chained_requests = self.chained_request_db.search({'validate<int>': '1'},
+                                                          page=-1,
+                                                          include_fields='prepid,chain')
 
         for chained_request in chained_requests:
             for request in chained_request['chain']:
@@ -0,0 +1,101 @@
+"""
+Module that contains asyncio interface of the database layer for code that
+needs many independent lookups at once
+"""
+import asyncio
+import functools
+import logging
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from couchdb_layer.mcm_database import database
+
+
+class AsyncDatabase:
+    """
+    Coroutine version of database with the same methods
+    Requests are made by a database object in a shared thread pool, so they
+    reuse keep-alive connections and the document cache of the process
+    Number of concurrent requests of every AsyncDatabase is bounded
+    """
+    logger = logging.getLogger('mcm_error')
+    # Default number of concurrent requests of a single AsyncDatabase
+    CONCURRENCY = 8
+    # Threads shared by all AsyncDatabase objects
+    executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='async-database')
+
+    def __init__(self, db_name, url=None, lucene_url=None, cache_enabled=True, concurrency=CONCURRENCY):
+        self.db = database(db_name, url=url, lucene_url=lucene_url, cache_enabled=cache_enabled)
+        self.db_name = db_name
+        self.concurrency = concurrency
+        # Semaphores are bound to an event loop, keep one per loop
+        self.semaphores = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def run(coroutine):
+        """
+        Run coroutine from synchronous code and return its result
+        """
+        return asyncio.run(coroutine)
+
+    async def __call(self, method, *args, **kwargs):
+        """
+        Call a method of database in the thread pool
+        """
+        loop = asyncio.get_running_loop()
+        semaphore = self.semaphores.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.concurrency)
+            self.semaphores[loop] = semaphore
+
+        async with semaphore:
+            return await loop.run_in_executor(self.executor, functools.partial(method, *args, **kwargs))
+
+    async def get(self, prepid, include_fields=None):
+        return await self.__call(self.db.get, prepid, include_fields=include_fields)
+
+    async def get_many(self, ids, include_fields=None):
+        """
+        Get documents with separate concurrent requests, so cached documents
+        are not fetched again
+        Return list in the same order as ids, non existing documents are None
+        """
+        return list(await asyncio.gather(*[self.get(x, include_fields) for x in ids]))
+
+    async def bulk_get(self, ids, include_fields=None):
+        return await self.__call(self.db.bulk_get, ids, include_fields=include_fields)
+
+    async def document_exists(self, prepid, include_deleted=False):
+        return await self.__call(self.db.document_exists, prepid, include_deleted)
+
+    async def raw_query_view(self, design_doc, view_name, page, limit, options=None, with_total_rows=False, include_fields=None):
+        return await self.__call(self.db.raw_query_view,
+                                 design_doc,
+                                 view_name,
+                                 page,
+                                 limit,
+                                 options=options,
+                                 with_total_rows=with_total_rows,
+                                 include_fields=include_fields)
+
+    async def query_view(self, key, value, page_num=0, limit=20):
+        return await self.__call(self.db.query_view, key, value, page_num, limit)
+
+    async def search(self, query_dict, page=0, limit=20, include_fields=None, total_rows=False, sort=None, sort_asc=True):
+        return await self.__call(self.db.search,
+                                 query_dict,
+                                 page,
+                                 limit,
+                                 include_fields,
+                                 total_rows,
+                                 sort,
+                                 sort_asc)
+
+    async def save(self, doc):
+        return await self.__call(self.db.save, doc)
+
+    async def save_with_status(self, doc):
+        return await self.__call(self.db.save_with_status, doc)
+
+    async def bulk_save(self, docs):
+        return await self.__call(self.db.bulk_save, docs)
@@ -0,0 +1,148 @@
+"""
+Module that contains the listener of CouchDB _changes feeds that keeps
+in-process caches consistent with writes done by other McM processes
+"""
+import logging
+import time
+from collections import defaultdict
+from threading import Thread, Lock
+
+from couchdb_layer.mcm_database import database
+
+
+class ChangesListener(Thread):
+    """
+    Thread that follows _changes feed of a single database
+    Every changed document is removed from the database document cache and
+    subscribers are called with the document id and whether it was deleted
+    """
+    logger = logging.getLogger('mcm_error')
+    # Databases that are followed when McM starts
+    DATABASES = ('batches',
+                 'campaigns',
+                 'chained_campaigns',
+                 'chained_requests',
+                 'flows',
+                 'invalidations',
+                 'lists',
+                 'mccms',
+                 'requests',
+                 'settings',
+                 'users')
+    # Seconds for which CouchDB keeps a long poll request open
+    POLL_TIMEOUT = 50
+    # Seconds to wait after a failed poll
+    RETRY_DELAY = 5
+    subscribers = defaultdict(list)
+    listeners = {}
+    listeners_lock = Lock()
+
+    def __init__(self, db_name):
+        Thread.__init__(self, name='changes-%s' % (db_name))
+        self.daemon = True
+        self.db_name = db_name
+        self.db = database(db_name)
+        # Checkpoint of the feed, None until the first successful poll
+        self.last_seq = None
+        self.last_change_time = 0
+        self.running = True
+        self.changes = 0
+        self.errors = 0
+
+    @classmethod
+    def subscribe(cls, db_name, callback):
+        """
+        Call callback(doc_id, deleted) for every change in given database
+        """
+        with cls.listeners_lock:
+            cls.subscribers[db_name].append(callback)
+
+    @classmethod
+    def start_listeners(cls, db_names=None):
+        """
+        Start following _changes feed of given databases
+        """
+        db_names = db_names if db_names else cls.DATABASES
+        with cls.listeners_lock:
+            for db_name in db_names:
+                listener = cls.listeners.get(db_name)
+                if listener and listener.is_alive():
+                    continue
+
+                listener = cls(db_name)
+                cls.listeners[db_name] = listener
+                listener.start()
+
+    @classmethod
+    def stop_listeners(cls):
+        """
+        Stop all listeners after their current poll
+        """
+        with cls.listeners_lock:
+            for listener in cls.listeners.values():
+                listener.running = False
+
+    @classmethod
+    def listeners_stats(cls):
+        """
+        Return checkpoint and counters of every listener
+        """
+        with cls.listeners_lock:
+            listeners = list(cls.listeners.values())
+
+        return {l.db_name: {'following': l.db_name in database.followed_databases,
+                            'last_seq': l.last_seq,
+                            'changes': l.changes,
+                            'errors': l.errors} for l in listeners}
+
+    @classmethod
+    def update_sequence(cls, db_name, quiet_for=0):
+        """
+        Return checkpoint of the feed of given database if the feed is
+        followed and nothing changed in the last quiet_for seconds, else None
+        """
+        listener = cls.listeners.get(db_name)
+        if listener is None or db_name not in database.followed_databases:
+            return None
+
+        if time.time() - listener.last_change_time < quiet_for:
+            return None
+
+        return listener.last_seq
+
+    def notify(self, doc_id, deleted):
+        """
+        Evict changed document from caches
+        """
+        self.db.invalidate_cache(doc_id)
+        for callback in list(self.subscribers[self.db_name]):
+            try:
+                callback(doc_id, deleted)
+            except Exception as ex:
+                self.logger.error('Error handling change of %s in %s: %s', doc_id, self.db_name, ex)
+
+    def run(self):
+        self.logger.info('Following _changes of %s', self.db_name)
+        while self.running:
+            try:
+                if self.last_seq is None:
+                    # Start from the current sequence, caches are filled after McM starts
+                    self.last_seq = self.db.changes(since='now')['last_seq']
+
+                result = self.db.changes(since=self.last_seq, timeout=self.POLL_TIMEOUT)
+                for change in result.get('results', []):
+                    self.changes += 1
+                    self.last_change_time = time.time()
+                    self.notify(change['id'], change.get('deleted', False))
+
+                self.last_seq = result.get('last_seq', self.last_seq)
+                database.followed_databases.add(self.db_name)
+            except Exception as ex:
+                # Caches of this database cannot be trusted until feed is caught up
+                database.followed_databases.discard(self.db_name)
+                self.errors += 1
+                self.logger.error('Error following _changes of %s: %s', self.db_name, ex)
+                time.sleep(self.RETRY_DELAY)
+
+        database.followed_databases.discard(self.db_name)
+        self.logger.info('Stopped following _changes of %s', self.db_name)
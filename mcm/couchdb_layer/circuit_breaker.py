@@ -0,0 +1,133 @@
+"""
+Module that contains circuit breakers of CouchDB and couchdb-lucene endpoints
+"""
+import logging
+import time
+import urllib.parse
+from threading import Lock
+
+
+class CircuitOpenError(Exception):
+    """
+    Request was not made because circuit of the endpoint is open
+    """
+
+    def __init__(self, endpoint, retry_in):
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+        Exception.__init__(self, 'Circuit of %s is open, next attempt in %.1fs' % (endpoint, retry_in))
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of a single (host, port) endpoint
+    After failure_threshold consecutive failures the circuit opens and
+    requests fail immediately for reset_timeout seconds, then a single trial
+    request is let through (half open) and its result closes or reopens it
+    """
+    logger = logging.getLogger('mcm_error')
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    FAILURE_THRESHOLD = 5
+    # Seconds for which open circuit rejects requests
+    RESET_TIMEOUT = 30
+    # Process wide breakers, key is (scheme, host, port)
+    breakers = {}
+    breakers_lock = Lock()
+
+    def __init__(self, endpoint, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0
+        self.trial_running = False
+        self.lock = Lock()
+        self.counters = {'successes': 0,
+                         'failures': 0,
+                         'rejected': 0,
+                         'opened': 0}
+
+    @classmethod
+    def for_url(cls, url):
+        """
+        Return the shared breaker for host and port of given url
+        """
+        parsed = urllib.parse.urlsplit(url)
+        scheme = parsed.scheme or 'http'
+        port = parsed.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parsed.hostname, port)
+        with cls.breakers_lock:
+            breaker = cls.breakers.get(key)
+            if breaker is None:
+                breaker = cls('%s:%s' % (parsed.hostname, port))
+                cls.breakers[key] = breaker
+
+            return breaker
+
+    @classmethod
+    def breakers_stats(cls):
+        """
+        Return state and counters of all breakers in this process
+        """
+        with cls.breakers_lock:
+            breakers = list(cls.breakers.values())
+
+        return {breaker.endpoint: breaker.stats() for breaker in breakers}
+
+    def before_request(self):
+        """
+        Raise CircuitOpenError if request must not be made now
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+
+            retry_in = self.opened_at + self.reset_timeout - time.time()
+            if self.state == self.OPEN and retry_in <= 0:
+                self.state = self.HALF_OPEN
+                self.trial_running = False
+
+            if self.state == self.HALF_OPEN and not self.trial_running:
+                # This request is the trial
+                self.trial_running = True
+                return
+
+            self.counters['rejected'] += 1
+            raise CircuitOpenError(self.endpoint, max(0, retry_in))
+
+    def record_success(self):
+        with self.lock:
+            self.counters['successes'] += 1
+            self.consecutive_failures = 0
+            if self.state != self.CLOSED:
+                self.logger.info('Closing circuit of %s', self.endpoint)
+                self.state = self.CLOSED
+                self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.counters['failures'] += 1
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.logger.error('Opening circuit of %s after %s failures',
+                                      self.endpoint,
+                                      self.consecutive_failures)
+                    self.counters['opened'] += 1
+
+                self.state = self.OPEN
+                self.opened_at = time.time()
+                self.trial_running = False
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['state'] = self.state
+            stats['consecutive_failures'] = self.consecutive_failures
+            if self.state == self.OPEN:
+                stats['retry_in'] = max(0, self.opened_at + self.reset_timeout - time.time())
+
+        return stats
@@ -0,0 +1,242 @@
+"""
+Module that contains the keep-alive connection pool shared by all
+database objects talking to CouchDB and couchdb-lucene
+"""
+import http.client as client
+import io
+import logging
+import time
+import urllib.error
+import urllib.parse
+from collections import deque
+from threading import Lock
+
+
+class PooledResponse(io.BytesIO):
+    """
+    Fully read HTTP response that is already detached from its connection
+    It can be used in the same way as responses returned by urllib openers
+    """
+
+    def __init__(self, url, status, reason, headers, body):
+        io.BytesIO.__init__(self, body)
+        self.url = url
+        self.status = status
+        self.code = status
+        self.reason = reason
+        self.headers = headers
+
+    def getcode(self):
+        return self.status
+
+    def info(self):
+        return self.headers
+
+
+class ConnectionPool:
+    """
+    Thread safe pool of HTTP/1.1 keep-alive connections to a single (host, port)
+    At most max_idle connections are kept open, idle connections that were not
+    used for idle_timeout seconds are closed
+    """
+    logger = logging.getLogger('mcm_error')
+    # Process wide pools, key is (scheme, host, port)
+    pools = {}
+    pools_lock = Lock()
+    MAX_IDLE = 16
+    # Idle timeout in seconds
+    IDLE_TIMEOUT = 60
+    # Socket timeout in seconds
+    CONNECTION_TIMEOUT = 120
+
+    def __init__(self, scheme, host, port, max_idle=MAX_IDLE, idle_timeout=IDLE_TIMEOUT):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        # Pairs of (connection, last time it was used)
+        self.idle = deque()
+        self.lock = Lock()
+        self.counters = {'requests': 0,
+                         'created': 0,
+                         'reused': 0,
+                         'closed': 0,
+                         'evicted': 0,
+                         'errors': 0,
+                         'in_use': 0}
+
+    @classmethod
+    def for_url(cls, url):
+        """
+        Return the shared pool for host and port of given url
+        """
+        parsed = urllib.parse.urlsplit(url)
+        scheme = parsed.scheme or 'http'
+        port = parsed.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parsed.hostname, port)
+        with cls.pools_lock:
+            pool = cls.pools.get(key)
+            if pool is None:
+                cls.logger.info('Creating connection pool for %s://%s:%s', *key)
+                pool = cls(*key)
+                cls.pools[key] = pool
+
+            return pool
+
+    @classmethod
+    def pools_stats(cls):
+        """
+        Return statistics of all pools in this process
+        """
+        with cls.pools_lock:
+            pools = list(cls.pools.values())
+
+        return {'%s:%s' % (pool.host, pool.port): pool.stats() for pool in pools}
+
+    @classmethod
+    def close_all(cls):
+        """
+        Close idle connections of all pools
+        """
+        with cls.pools_lock:
+            pools = list(cls.pools.values())
+
+        for pool in pools:
+            pool.close_idle()
+
+    def new_connection(self):
+        """
+        Return a new HTTPConnection or HTTPSConnection
+        """
+        if self.scheme == 'https':
+            return client.HTTPSConnection(self.host, self.port, timeout=self.CONNECTION_TIMEOUT)
+
+        return client.HTTPConnection(self.host, self.port, timeout=self.CONNECTION_TIMEOUT)
+
+    def __evict_idle(self):
+        """
+        Close connections that were idle for too long
+        Must be called with the pool lock held
+        """
+        deadline = time.time() - self.idle_timeout
+        # Oldest connections are on the left side
+        while self.idle and self.idle[0][1] < deadline:
+            connection, _ = self.idle.popleft()
+            connection.close()
+            self.counters['evicted'] += 1
+
+    def acquire(self):
+        """
+        Return a tuple of a connection and whether it was reused
+        """
+        with self.lock:
+            self.__evict_idle()
+            self.counters['in_use'] += 1
+            if self.idle:
+                # Take most recently used connection, it is the least likely
+                # to be closed by the server
+                connection, _ = self.idle.pop()
+                self.counters['reused'] += 1
+                return connection, True
+
+            self.counters['created'] += 1
+
+        return self.new_connection(), False
+
+    def release(self, connection, reusable=True):
+        """
+        Return connection to the pool or close it if it cannot be reused
+        """
+        with self.lock:
+            self.counters['in_use'] -= 1
+            if reusable and len(self.idle) < self.max_idle:
+                self.idle.append((connection, time.time()))
+                return
+
+            self.counters['closed'] += 1
+
+        connection.close()
+
+    def close_idle(self):
+        """
+        Close all idle connections
+        """
+        with self.lock:
+            while self.idle:
+                connection, _ = self.idle.popleft()
+                connection.close()
+                self.counters['closed'] += 1
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        Make a HTTP request and return the response together with its body
+        Request is retried once on a new connection if reused connection was
+        already closed by the server
+        """
+        headers = headers if headers else {}
+        for attempt in (1, 2):
+            connection, reused = self.acquire()
+            with self.lock:
+                self.counters['requests'] += 1
+
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (ConnectionError, client.BadStatusLine) as ex:
+                self.release(connection, reusable=False)
+                if reused and attempt == 1:
+                    self.logger.debug('Stale connection to %s:%s, retrying: %s', self.host, self.port, ex)
+                    continue
+
+                with self.lock:
+                    self.counters['errors'] += 1
+
+                raise
+            except Exception:
+                self.release(connection, reusable=False)
+                with self.lock:
+                    self.counters['errors'] += 1
+
+                raise
+
+            self.release(connection, reusable=not response.will_close)
+            return response, data
+
+    def stats(self):
+        """
+        Return pool counters and number of idle connections
+        """
+        with self.lock:
+            stats = dict(self.counters)
+            stats['idle'] = len(self.idle)
+            stats['max_idle'] = self.max_idle
+
+        return stats
+
+
+class KeepAliveOpener:
+    """
+    Replacement of urllib opener that sends urllib.request.Request objects
+    through the shared connection pools
+    Like urllib, it raises urllib.error.HTTPError for non 2xx responses
+    """
+
+    def open(self, request):
+        url = request.full_url
+        parsed = urllib.parse.urlsplit(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+
+        pool = ConnectionPool.for_url(url)
+        response, body = pool.request(request.get_method(),
+                                      path,
+                                      body=request.data,
+                                      headers=dict(request.header_items()))
+        result = PooledResponse(url, response.status, response.reason, response.headers, body)
+        if not 200 <= response.status < 300:
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, result)
+
+        return result
@@ -0,0 +1,141 @@
+"""
+Module that contains the size bounded LRU cache of CouchDB documents
+"""
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class DocumentCache:
+    """
+    LRU cache of raw (JSON encoded) documents bounded by number of entries and bytes
+    Entries are keyed by server, database name and _id and tagged with the
+    document _rev, so they can be revalidated with a conditional request
+    Raw bodies are stored, so every reader decodes its own copy of the document
+    Recent invalidations are numbered, so a body that was fetched before an
+    invalidation is not stored after it
+    """
+    # Number of recent invalidations that are remembered
+    MAX_INVALIDATIONS = 10000
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # Single documents above this size are not cached at all
+        self.max_entry_bytes = max_bytes // 8
+        # Key -> [rev, body, time of last validation]
+        self.entries = OrderedDict()
+        self.size = 0
+        # Key -> number of its last invalidation, oldest first
+        self.invalidated = OrderedDict()
+        self.sequence = 0
+        # Number of the newest invalidation that is not remembered anymore
+        self.forgotten = 0
+        self.lock = Lock()
+        self.counters = {'hits': 0,
+                         'revalidated': 0,
+                         'misses': 0,
+                         'evictions': 0,
+                         'invalidations': 0}
+
+    def get(self, key):
+        """
+        Return tuple of rev, body and time of last validation for given key or None
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            self.entries.move_to_end(key)
+            return tuple(entry)
+
+    def generation(self):
+        """
+        Return number of the last invalidation, taken before a fetch and
+        given to set() after it
+        """
+        return self.sequence
+
+    def set(self, key, rev, body, generation=None):
+        """
+        Store raw document body with its revision
+        If generation is given, body is not stored if the key might have been
+        invalidated since then
+        """
+        if not rev or len(body) > self.max_entry_bytes:
+            self.invalidate(key)
+            return
+
+        with self.lock:
+            if generation is not None and (self.invalidated.get(key, 0) > generation
+                                           or self.forgotten > generation):
+                return
+
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+
+            self.entries[key] = [rev, body, time.time()]
+            self.size += len(body)
+            while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted[1])
+                self.counters['evictions'] += 1
+
+    def touch(self, key):
+        """
+        Mark entry as just validated
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry[2] = time.time()
+
+    def invalidate(self, key):
+        """
+        Remove entry from the cache
+        """
+        with self.lock:
+            self.sequence += 1
+            self.invalidated.pop(key, None)
+            self.invalidated[key] = self.sequence
+            if len(self.invalidated) > self.MAX_INVALIDATIONS:
+                _, self.forgotten = self.invalidated.popitem(last=False)
+
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= len(entry[1])
+                self.counters['invalidations'] += 1
+
+    def count(self, counter):
+        """
+        Increment one of hit/miss counters
+        """
+        with self.lock:
+            self.counters[counter] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            # Bodies that are being fetched are not stored
+            self.sequence += 1
+            self.invalidated.clear()
+            self.forgotten = self.sequence
+
+    def length(self):
+        return len(self.entries)
+
+    def stats(self):
+        """
+        Return counters together with current and maximum size of the cache
+        """
+        with self.lock:
+            stats = dict(self.counters)
+            stats['entries'] = len(self.entries)
+            stats['bytes'] = self.size
+            stats['max_entries'] = self.max_entries
+            stats['max_bytes'] = self.max_bytes
+
+        return stats
@@ -1,14 +1,19 @@
 import time
 import os
 import logging
-import sys
+import random
 import socket
 import base64
-import json
 import urllib.request, urllib.error, urllib.parse
 import urllib.request, urllib.parse, urllib.error
 from tools.locator import locator
-from tools.locker import locker
+from tools import json_codec
+from tools.metrics import metrics
+from couchdb_layer.connection_pool import ConnectionPool, KeepAliveOpener
+from couchdb_layer.document_cache import DocumentCache
+from couchdb_layer.circuit_breaker import CircuitBreaker
+from couchdb_layer.rate_limiter import RateLimiter
+from couchdb_layer.unit_of_work import UnitOfWork, current_unit
 from cachelib import SimpleCache
 
 
@@ -17,27 +22,76 @@ class database:
     # Cache timeout in seconds
     CACHE_TIMEOUT = 60 * 60
     IP_CACHE_TIMEOUT = 15 * 60
-    cache = SimpleCache()
+    # Seconds for which cached documents are returned without asking the
+    # database whether their revision changed, other databases always revalidate
+    CACHE_FRESHNESS = {'campaigns': CACHE_TIMEOUT,
+                       'chained_campaigns': CACHE_TIMEOUT}
+    CACHE_MAX_ENTRIES = 20000
+    CACHE_MAX_BYTES = 256 * 1024 * 1024
+    cache = DocumentCache(CACHE_MAX_ENTRIES, CACHE_MAX_BYTES)
     ip_cache = SimpleCache()
-
-    def __init__(self, db_name, url=None, lucene_url=None, cache_enabled=False):
-        if not url:
-            url = locator().database_url()
-
-        if not lucene_url:
-            lucene_url = locator().lucene_url()
-
+    # Keep-alive connections are shared by all database objects
+    opener = KeepAliveOpener()
+    # Marker returned when conditional fetch found the same revision
+    NOT_MODIFIED = object()
+    # Number of rows fetched at once when iterating over views and searches
+    PAGE_SIZE = 500
+    # Number of documents in one _bulk_get request
+    BULK_GET_SIZE = 200
+    # Databases whose _changes feed is followed by this process, cached
+    # documents of these databases are evicted as soon as they change
+    followed_databases = set()
+    # Seconds that a request, including all retries, may take
+    RETRY_DEADLINE = 10
+    # Base and maximum of exponential backoff between retries in seconds
+    RETRY_BACKOFF = 0.25
+    RETRY_MAX_BACKOFF = 4
+
+    def __init__(self, db_name, url=None, lucene_url=None, cache_enabled=True):
         if not db_name:
             raise Exception('Missing database name')
 
         self.db_name = db_name
-        self.cache_enabled = cache_enabled or db_name in {'campaigns', 'chained_campaigns'}
-        self.db_url = self.resolve_hostname_to_ip(url)
-        self.lucene_url = self.resolve_hostname_to_ip(lucene_url)
-        self.auth_header = locator().database_credentials()
-        self.opener = urllib.request.build_opener(urllib.request.HTTPHandler)
+        self.cache_enabled = cache_enabled
+        # Unit of work whose identity map is used, see shared_database()
+        self.unit_of_work = None
+        self.cache_freshness = self.CACHE_FRESHNESS.get(db_name, 0)
+        # Urls and credentials are resolved on first request, so database
+        # objects can be created at import time without network access
+        self.__url = url
+        self.__lucene_url = lucene_url
+        self.__db_url = None
+        self.__resolved_lucene_url = None
+        self.__auth_header = None
         self.max_attempts = 3
 
+    @property
+    def db_url(self):
+        """
+        CouchDB url with hostname resolved to IP address
+        """
+        if self.__db_url is None:
+            self.__db_url = self.resolve_hostname_to_ip(self.__url or locator().database_url())
+
+        return self.__db_url
+
+    @property
+    def lucene_url(self):
+        """
+        couchdb-lucene url with hostname resolved to IP address
+        """
+        if self.__resolved_lucene_url is None:
+            self.__resolved_lucene_url = self.resolve_hostname_to_ip(self.__lucene_url or locator().lucene_url())
+
+        return self.__resolved_lucene_url
+
+    @property
+    def auth_header(self):
+        if self.__auth_header is None:
+            self.__auth_header = locator().database_credentials()
+
+        return self.__auth_header
+
     def resolve_hostname_to_ip(self, hostname):
         """
         Resolve hostname to IPv4 address
@@ -57,7 +111,13 @@ class database:
         """
         Return number of elements in cache and cache size in bytes
         """
-        return len(self.cache._cache), sys.getsizeof(self.cache._cache)
+        return self.cache.length(), self.cache.size
+
+    def cache_stats(self):
+        """
+        Return document cache hit, miss and eviction counters
+        """
+        return self.cache.stats()
 
     def clear_cache(self):
         """
@@ -67,6 +127,85 @@ class database:
         self.cache.clear()
         return size
 
+    def connection_pools_stats(self):
+        """
+        Return statistics of keep-alive connection pools
+        """
+        return ConnectionPool.pools_stats()
+
+    def circuit_breakers_stats(self):
+        """
+        Return state and counters of circuit breakers
+        """
+        return CircuitBreaker.breakers_stats()
+
+    def backoff(self, attempt):
+        """
+        Return seconds to wait before given retry, exponential backoff with
+        full jitter, so threads that failed together do not retry together
+        """
+        return random.uniform(0, min(self.RETRY_MAX_BACKOFF, self.RETRY_BACKOFF * 2 ** attempt))
+
+    def __open(self, request, idempotent=True):
+        """
+        Send request through circuit breaker of its endpoint and return response
+        Idempotent requests are retried after 5xx errors and connection errors
+        with jittered backoff, until max_attempts or RETRY_DEADLINE is reached
+        4xx errors are raised right away and do not count as failures
+        While circuit is open, CircuitOpenError is raised without a request
+        Threads in RateLimiter.throttled() wait for a token before every attempt
+        Every attempt is recorded in metrics, time until response headers
+        """
+        breaker = CircuitBreaker.for_url(request.full_url)
+        deadline = time.time() + self.RETRY_DEADLINE
+        labels = self.request_labels(request)
+        attempt = 0
+        while True:
+            attempt += 1
+            RateLimiter.before_request(request.full_url)
+            breaker.before_request()
+            start = time.monotonic()
+            try:
+                response = self.opener.open(request)
+                breaker.record_success()
+                return response
+            except urllib.error.HTTPError as http_error:
+                if http_error.code < 500:
+                    breaker.record_success()
+                    raise
+
+                breaker.record_failure()
+                metrics.increment('mcm_downstream_errors_total', **labels)
+                error = http_error
+            except Exception as ex:
+                breaker.record_failure()
+                metrics.increment('mcm_downstream_errors_total', **labels)
+                error = ex
+            finally:
+                metrics.observe('mcm_downstream_duration_seconds', time.monotonic() - start, **labels)
+
+            sleep = self.backoff(attempt)
+            if not idempotent or attempt >= self.max_attempts or time.time() + sleep > deadline:
+                raise error
+
+            self.logger.warning('Attempt %s of %s %s failed, retrying in %.2fs: %s',
+                                attempt,
+                                request.get_method(),
+                                request.full_url,
+                                sleep,
+                                error)
+            time.sleep(sleep)
+
+    def request_labels(self, request):
+        """
+        Return metrics labels of a request: service and operation, e.g. POST _find
+        """
+        service = 'lucene' if request.full_url.startswith(self.lucene_url) else 'couchdb'
+        parts = urllib.parse.urlsplit(request.full_url).path.strip('/').split('/')
+        # Documents are addressed by id, other endpoints start with _
+        endpoint = next((part for part in parts[1:] if part.startswith('_')), 'document')
+        return {'service': service, 'operation': '%s %s' % (request.get_method(), endpoint)}
+
     def __build_request(self, url, path, method, headers, data):
         """
         Build a HTTP request to CouchDB or couchdb-lucene
@@ -75,7 +214,7 @@ class database:
             headers = {'Content-Type': 'application/json'}
 
         if data is not None and isinstance(data, dict):
-            data = json.dumps(data)
+            data = json_codec.dumps_bytes(data)
 
         # Python 3: Encode the request body as <cls: bytes>
         if isinstance(data, str):
@@ -112,85 +251,217 @@ class database:
         Return a document for given id
         If include deleted is true, then return remains of the deleted document
         """
+        body = self.__fetch_raw(document_id, include_deleted)
+        if body is None:
+            return None
+
+        return json_codec.loads(body)
+
+    def __fetch_raw(self, document_id, include_deleted=False, rev=None):
+        """
+        Return raw body of a document for given id
+        If rev is given and document still has the same revision, return
+        NOT_MODIFIED instead of the body
+        """
         if not document_id:
             return None
 
-        db_request = self.couch_request('%s/%s' % (self.db_name, document_id))
-        for attempt in range(1, self.max_attempts + 1):
-            try:
-                with self.opener.open(db_request) as data:
-                    return json.loads(data.read())
-            except urllib.error.HTTPError as http_error:
-                code = http_error.code
-                self.logger.error('HTTP error fetching %s: %s', document_id, http_error)
-                if code == 404 and include_deleted:
-                    with http_error:
-                        # Database returned 404 - not found
-                        # Document might have never existed or it could be deleted
-                        return json.loads(http_error.read())
-
-                if 400 <= code < 500:
-                    # If it's HTTP 4xx - bad request, no point in retry
-                    return None
-
-                if attempt < self.max_attempts:
-                    sleep = 2 ** attempt
-                    time.sleep(sleep)
-            except Exception as ex:
-                self.logger.error('Error fetching %s: %s', document_id, ex)
-                if attempt < self.max_attempts:
-                    sleep = 2 ** attempt
-                    time.sleep(sleep)
+        headers = None
+        if rev:
+            headers = {'Content-Type': 'application/json',
+                       'If-None-Match': '"%s"' % (rev)}
+
+        db_request = self.couch_request('%s/%s' % (self.db_name, document_id), headers=headers)
+        try:
+            with self.__open(db_request) as data:
+                return data.read()
+        except urllib.error.HTTPError as http_error:
+            code = http_error.code
+            if code == 304:
+                # Revision did not change
+                return self.NOT_MODIFIED
+
+            self.logger.error('HTTP error fetching %s: %s', document_id, http_error)
+            if code == 404 and include_deleted:
+                with http_error:
+                    # Database returned 404 - not found
+                    # Document might have never existed or it could be deleted
+                    return http_error.read()
+        except Exception as ex:
+            self.logger.error('Error fetching %s: %s', document_id, ex)
 
         return None
 
-    def __save_to_cache(self, key, value):
+    def invalidate_cache(self, prepid):
         """
-        Save value to cache if cache is enabled
+        Remove document from cache, e.g. after it was written
         """
-        if self.cache_enabled:
-            with locker.lock(key):
-                cache_key = 'mcm_database_' + key
-                self.cache.set(cache_key, value, timeout=self.CACHE_TIMEOUT)
+        self.cache.invalidate(self.cache_key(prepid))
+        UnitOfWork.invalidate(self.db_name, prepid)
+        unit = current_unit(create=False)
+        if unit is not None:
+            unit.forget(self.db_name, prepid)
 
-    def __get_from_cache(self, key):
+    def projected_fields(self, include_fields):
         """
-        Return value from cache if cache is enabled
-        If cache is disabled or value could not be found, return None
+        Return sorted list of fields from comma separated include_fields
+        _id is always included, it is needed to match documents with their ids
         """
-        if self.cache_enabled:
-            with locker.lock(key):
-                cache_key = 'mcm_database_' + key
-                return self.cache.get(cache_key)
-        else:
-            return None
+        if isinstance(include_fields, str):
+            include_fields = include_fields.split(',')
+
+        fields = set(f.strip() for f in include_fields if f.strip())
+        fields.add('_id')
+        return sorted(list(fields))
 
-    def get(self, prepid):
+    def __find(self, selector, include_fields, limit):
+        """
+        Return documents that match Mango selector, only with given fields
+        """
+        request = self.couch_request('%s/_find' % (self.db_name),
+                                     method='POST',
+                                     data={'selector': selector,
+                                           'fields': self.projected_fields(include_fields),
+                                           'limit': limit})
+        with self.__open(request) as response:
+            return json_codec.load(response).get('docs', [])
+
+    def get(self, prepid, include_fields=None):
         """
         Get a document from database
+        Cached documents are returned as long as their revision did not change
+        and documents that were read through a database object of a unit of
+        work are not fetched again, databases without cache always fetch the
+        document
+        If include_fields is given, return only these fields of the document,
+        projected documents are not cached
+        """
+        if include_fields and prepid:
+            try:
+                docs = self.__find({'_id': prepid}, include_fields, 1)
+            except Exception as ex:
+                self.logger.error('Error fetching %s: %s', prepid, ex)
+                return None
+
+            return docs[0] if docs else None
+
+        if not self.cache_enabled or not prepid:
+            return self.__fetch(prepid)
+
+        unit = self.unit_of_work
+        if unit is not None:
+            body = unit.get_document(self.db_name, prepid)
+            if body is not None:
+                return json_codec.loads(body)
+
+            sequence = UnitOfWork.current_sequence()
+
+        body, doc = self.__get_cached(prepid)
+        if body is None:
+            return None
+
+        if unit is not None:
+            unit.remember(self.db_name, prepid, body, sequence)
+
+        return doc if doc is not None else json_codec.loads(body)
+
+    def cache_key(self, prepid):
+        """
+        Return key of a document in the shared cache, url is None for the
+        McM database, so documents of other servers, e.g. Stats2, are not mixed
+        """
+        return (self.__url, self.db_name, prepid)
+
+    def __get_cached(self, prepid):
+        """
+        Return raw document from cache or database and decoded document if
+        it had to be decoded anyway
         """
-        cached = self.__get_from_cache(prepid)
+        cache_key = self.cache_key(prepid)
+        # Document invalidated during a slow fetch is not stored
+        generation = self.cache.generation()
+        cached = self.cache.get(cache_key)
         if cached:
-            return cached
+            rev, body, validated = cached
+            if self.is_fresh(validated):
+                self.cache.count('hits')
+                return body, None
+
+            new_body = self.__fetch_raw(prepid, rev=rev)
+            if new_body is self.NOT_MODIFIED:
+                self.cache.count('revalidated')
+                self.cache.touch(cache_key)
+                return body, None
+        else:
+            new_body = self.__fetch_raw(prepid)
 
-        doc = self.__fetch(prepid)
-        self.__save_to_cache(prepid, doc)
-        return doc
+        self.cache.count('misses')
+        if new_body is None:
+            self.cache.invalidate(cache_key)
+            return None, None
 
-    def bulk_get(self, ids):
+        doc = json_codec.loads(new_body)
+        self.cache.set(cache_key, doc.get('_rev'), new_body, generation)
+        return new_body, doc
+
+    def is_fresh(self, validated):
+        """
+        Return whether cached document validated at given time can be returned
+        without asking the database
         """
-        Get multiple documents at once
-        Non existing documents are changed with None
+        freshness = self.cache_freshness
+        if self.db_name in self.followed_databases:
+            freshness = self.CACHE_TIMEOUT
+
+        return time.time() - validated < freshness
+
+    def known_revision(self, prepid):
+        """
+        Return revision of a document if it is known without asking the
+        database, i.e. document is cached and fresh, otherwise None
+        """
+        if not self.cache_enabled or not prepid:
+            return None
+
+        cached = self.cache.get(self.cache_key(prepid))
+        if cached and self.is_fresh(cached[2]):
+            return cached[0]
+
+        return None
+
+    def bulk_get(self, ids, include_fields=None):
+        """
+        Get multiple documents at once, BULK_GET_SIZE documents per request
+        Non existing documents are skipped
         Order is preserved
+        If include_fields is given, return only these fields of the documents
+        Documents are looked up by _id and projected here, _find with $in of
+        _id would scan the whole database
         """
-        request = self.couch_request('%s/_bulk_get' % (self.db_name),
-                                     method='POST',
-                                     data={'docs': [{'id': x} for x in ids]})
+        ids = list(ids or [])
+        fields = self.projected_fields(include_fields) if include_fields else None
+        results = []
+        for start in range(0, len(ids), self.BULK_GET_SIZE):
+            chunk = ids[start:start + self.BULK_GET_SIZE]
+            request = self.couch_request('%s/_bulk_get' % (self.db_name),
+                                         method='POST',
+                                         data={'docs': [{'id': x} for x in chunk]})
 
-        with self.opener.open(request) as data:
-            results = json.loads(data.read())['results']
-            results = [r['docs'][-1]['ok'] for r in results if r.get('docs') if r['docs'][-1].get('ok')]
-            return results
+            with self.__open(request) as data:
+                for result in json_codec.load(data)['results']:
+                    doc = result['docs'][-1].get('ok') if result.get('docs') else None
+                    if not doc:
+                        continue
+
+                    if fields:
+                        if doc.get('_deleted'):
+                            continue
+
+                        doc = {f: doc[f] for f in fields if f in doc}
+
+                    results.append(doc)
+
+        return results
 
     def document_exists(self, prepid, include_deleted=False):
         """
@@ -198,13 +469,14 @@ class database:
         Optionally, include deleted items
         """
         self.logger.debug('Checking if document "%s" exists', prepid)
+        if not include_deleted:
+            # Document is usually read right after the check, so it is cached
+            return self.get(prepid) is not None
+
         doc = self.__fetch(prepid, include_deleted)
         if not doc:
             return False
 
-        if not include_deleted and doc:
-            return True
-
         error = doc.get('error')
         if not error:
             return True
@@ -222,7 +494,7 @@ class database:
             return False
 
         # Update cache just in case
-        self.__save_to_cache(prepid, None)
+        self.invalidate_cache(prepid)
         doc['_deleted'] = True
         self.update(doc)
         self.logger.info('Deleted "%s" from "%s"', prepid, self.db_name)
@@ -234,7 +506,6 @@ class database:
             self.logger.error('Could not find _id in document of "%s"', self.db_name)
 
         self.logger.info('Updating "%s" in "%s"...', doc_id, self.db_name)
-        self.__save_to_cache(doc_id, None)
         saved = self.save(doc)
         if saved:
             self.logger.info('Updated "%s" in "%s"', doc_id, self.db_name)
@@ -243,42 +514,222 @@ class database:
 
         return saved
 
-    def save(self, doc):
+    def save(self, doc, fence=None):
+        return self.save_with_status(doc, fence)['ok']
+
+    def save_with_status(self, doc, fence=None):
+        """
+        Save a document and return its status in the same format as bulk_save
+        CouchDB writes the document only if its _rev is the latest revision,
+        otherwise status has a 'conflict' error
+        Successfully saved document gets its new _rev
+        Fence is the held lock that protects the write, its fencing token is
+        checked right before the write and StaleLockError is raised without
+        writing if the lock was taken over
+        """
+        if fence is not None:
+            fence.check_fence()
+
         doc_id = doc.get('_id')
         if not doc_id:
             self.logger.error('Could not find _id in document of "%s"', self.db_name)
 
         doc_rev = doc.get('_rev')
         self.logger.info('Saving "%s" (%s) in "%s"...', doc_id, doc_rev, self.db_name)
+        # Cached revision is outdated regardless of the result
+        self.invalidate_cache(doc_id)
+        status = {'id': doc_id, 'ok': False, 'rev': None, 'error': None, 'reason': None}
         request = self.couch_request(self.db_name, 'POST', data=doc)
         try:
-            with self.opener.open(request) as response:
-                data = json.loads(response.read())
-                success = data.get('ok') is True
-                if not success:
-                    self.logger.error(data)
+            # Writes are not retried, first attempt might have been written
+            with self.__open(request, idempotent=False) as response:
+                data = json_codec.load(response)
+        except urllib.error.HTTPError as http_error:
+            with http_error:
+                body = http_error.read()
+
+            self.logger.error('HTTP error saving %s: %s %s', doc_id, http_error, body)
+            try:
+                data = json_codec.loads(body)
+            except ValueError:
+                data = {}
 
-                return success
+            status['error'] = data.get('error', 'http_%s' % (http_error.code))
+            status['reason'] = data.get('reason', str(http_error))
+            return status
         except Exception as ex:
             self.logger.error('Error saving %s: %s', doc_id, ex)
-            return False
+            status['error'] = 'exception'
+            status['reason'] = str(ex)
+            return status
+
+        status['ok'] = data.get('ok') is True
+        status['rev'] = data.get('rev')
+        if status['ok']:
+            doc['_rev'] = status['rev']
+        else:
+            self.logger.error(data)
+            status['error'] = data.get('error')
+            status['reason'] = data.get('reason')
+
+        return status
+
+    def changes(self, since, timeout=None, limit=None):
+        """
+        Return changes of the database since given sequence
+        If timeout is given, wait up to timeout seconds for a change (long poll)
+        If limit is given, return at most limit changes
+        """
+        options = {'since': since}
+        if limit:
+            options['limit'] = limit
+
+        if timeout:
+            options['feed'] = 'longpoll'
+            options['timeout'] = int(timeout * 1000)
+
+        url = '%s/_changes?%s' % (self.db_name, urllib.parse.urlencode(options))
+        request = self.couch_request(url)
+        with self.__open(request) as response:
+            return json_codec.load(response)
+
+    def bulk_save(self, docs):
+        """
+        Save multiple documents with a single _bulk_docs request
+        Return a list of statuses in the same order as documents:
+        {'id': ..., 'ok': bool, 'rev': new revision, 'error': ..., 'reason': ...}
+        Successfully saved documents get their new _rev
+        """
+        if not docs:
+            return []
+
+        self.logger.info('Saving %s documents in "%s"...', len(docs), self.db_name)
+        for doc in docs:
+            # Cached revisions are outdated regardless of the result
+            self.invalidate_cache(doc.get('_id'))
+
+        request = self.couch_request('%s/_bulk_docs' % (self.db_name),
+                                     method='POST',
+                                     data={'docs': docs})
+        try:
+            with self.__open(request, idempotent=False) as response:
+                results = json_codec.load(response)
+        except Exception as ex:
+            self.logger.error('Error saving %s documents in %s: %s', len(docs), self.db_name, ex)
+            return [{'id': doc.get('_id'), 'ok': False, 'rev': None, 'error': 'exception', 'reason': str(ex)}
+                    for doc in docs]
+
+        statuses = []
+        for doc, result in zip(docs, results):
+            status = {'id': result.get('id', doc.get('_id')),
+                      'ok': 'error' not in result,
+                      'rev': result.get('rev'),
+                      'error': result.get('error'),
+                      'reason': result.get('reason')}
+            if status['ok']:
+                doc['_rev'] = status['rev']
+            else:
+                self.logger.error('Error saving %s in %s: %s %s',
+                                  status['id'],
+                                  self.db_name,
+                                  status['error'],
+                                  status['reason'])
+
+            statuses.append(status)
+
+        return statuses
 
     def pagify(self, page_num=0, limit=20):
         """
         Return limit and skip values for given page and limit
         """
         if page_num < 0:
-            # Page <0 means "all", but it still has to be limited to something
-            return 9999, 0
+            # Page <0 means "all", callers iterate over all pages instead
+            return -1, 0
 
         skip = limit * page_num
         return limit, skip
 
-    def raw_query_view(self, design_doc, view_name, page, limit, options=None, with_total_rows=False):
+    def __row_value(self, row, include_docs, design_doc):
+        """
+        Return document, key or value of a view row
+        """
+        if include_docs:
+            return row['doc']
+
+        if design_doc == 'unique':
+            return row['key']
+
+        return row['value']
+
+    def iter_view(self, design_doc, view_name, options=None, page_size=PAGE_SIZE, include_fields=None):
+        """
+        Iterate over all rows of a CouchDB view, holding only one page in memory
+        Next page starts at startkey and startkey_docid of the row after the
+        current page, so deep pages are as fast as the first one
+        Values of key, startkey and endkey options are JSON encoded here
+        Yields the same items as raw_query_view
+        """
+        url = '%s/_design/%s/_view/%s' % (self.db_name, design_doc, view_name)
+        options = dict(options) if options else {}
+        include_docs = options.pop('include_docs', True)
+        # Projected documents are fetched with bulk_get instead of include_docs
+        project = include_docs and include_fields
+        query = {'include_docs': 'true' if include_docs and not project else 'false',
+                 'limit': page_size + 1}
+        if 'key' in options:
+            # Key is the same as startkey and endkey, but startkey moves with pages
+            options['startkey'] = options['endkey'] = options.pop('key')
+
+        for name, value in options.items():
+            if name in ('startkey', 'endkey'):
+                query[name] = json_codec.dumps(value)
+            elif isinstance(value, bool):
+                query[name] = 'true' if value else 'false'
+            else:
+                query[name] = value
+
+        while True:
+            request = self.couch_request(url + '?' + urllib.parse.urlencode(query))
+            self.logger.debug('Query view page %s', request.full_url)
+            with self.__open(request) as response:
+                rows = json_codec.load(response).get('rows', [])
+
+            next_row = rows[page_size] if len(rows) > page_size else None
+            del rows[page_size:]
+            if project:
+                for doc in self.bulk_get([r['id'] for r in rows], include_fields):
+                    yield doc
+            else:
+                for row in rows:
+                    yield self.__row_value(row, include_docs, design_doc)
+
+            if next_row is None:
+                return
+
+            query['startkey'] = json_codec.dumps(next_row['key'])
+            if 'id' in next_row:
+                query['startkey_docid'] = next_row['id']
+
+    def raw_query_view(self, design_doc, view_name, page, limit, options=None, with_total_rows=False, include_fields=None):
         """
         Internal method for querying a CouchDB view
+        Page <0 returns all rows, they are fetched page by page with iter_view
+        If include_fields is given, documents have only these fields
         """
         url = '%s/_design/%s/_view/%s' % (self.db_name, design_doc, view_name)
+        if page < 0:
+            try:
+                rows = list(self.iter_view(design_doc, view_name, options, include_fields=include_fields))
+            except Exception as ex:
+                self.logger.error('Error querying view %s: %s', url, ex)
+                rows = []
+
+            if with_total_rows:
+                return {'rows': rows, 'total_rows': len(rows)}
+
+            return rows
+
         limit, skip = self.pagify(page, limit)
         if options is None:
             options = {}
@@ -290,10 +741,15 @@ class database:
         if options.get('include_docs', True):
             options['include_docs'] = True
 
+        project = options['include_docs'] and include_fields
+        if project:
+            # Projected documents are fetched with bulk_get instead of include_docs
+            options['include_docs'] = False
+
         if options.get('key'):
             key = options['key']
             if isinstance(key, list):
-                key = json.dumps(key)
+                key = json_codec.dumps(key)
             else:
                 key = '"%s"' % (key)
 
@@ -305,14 +761,13 @@ class database:
         self.logger.debug('Query view %s', url)
         request = self.couch_request(url)
         try:
-            with self.opener.open(request) as response:
-                data = json.loads(response.read())
-                if options.get('include_docs'):
-                    rows = [r['doc'] for r in data.get('rows', [])]
-                elif design_doc == 'unique':
-                    rows = [r['key'] for r in data.get('rows', [])]
+            with self.__open(request) as response:
+                data = json_codec.load(response)
+                include_docs = options.get('include_docs')
+                if project:
+                    rows = self.bulk_get([r['id'] for r in data.get('rows', [])], include_fields)
                 else:
-                    rows = [r['value'] for r in data.get('rows', [])]
+                    rows = [self.__row_value(r, include_docs, design_doc) for r in data.get('rows', [])]
 
                 if with_total_rows:
                     total_rows = data.get('total_rows', 0)
@@ -326,11 +781,44 @@ class database:
 
             return []
 
-    def get_all(self, page=-1, limit=20, with_total_rows=False):
+    def query_view_keys(self, design_doc, view_name, keys, include_docs=True):
+        """
+        Query a CouchDB view for many keys at once
+        Return dictionary of key and list of documents (or values) of its rows,
+        keys without rows are missing
+        Keys are sent in chunks of PAGE_SIZE
+        """
+        url = '%s/_design/%s/_view/%s?include_docs=%s' % (self.db_name,
+                                                          design_doc,
+                                                          view_name,
+                                                          'true' if include_docs else 'false')
+        keys = list(keys)
+        results = {}
+        for start in range(0, len(keys), self.PAGE_SIZE):
+            chunk = keys[start:start + self.PAGE_SIZE]
+            self.logger.debug('Query view %s with %s keys', url, len(chunk))
+            request = self.couch_request(url, method='POST', data={'keys': chunk})
+            with self.__open(request) as response:
+                rows = json_codec.load(response).get('rows', [])
+
+            for row in rows:
+                value = self.__row_value(row, include_docs, design_doc)
+                if value is not None:
+                    results.setdefault(row['key'], []).append(value)
+
+        return results
+
+    def get_all(self, page=-1, limit=20, with_total_rows=False, include_fields=None):
         """
         Get all documents from specific database
+        If include_fields is given, documents have only these fields
         """
-        return self.raw_query_view(self.db_name, 'all', page, limit, with_total_rows=with_total_rows)
+        return self.raw_query_view(self.db_name,
+                                   'all',
+                                   page,
+                                   limit,
+                                   with_total_rows=with_total_rows,
+                                   include_fields=include_fields)
 
     def query_view(self, key, value, page_num=0, limit=20):
         """
@@ -420,10 +908,52 @@ class database:
 
         return 'AND'.join(query)
 
+    def iter_search(self, query_dict, page_size=PAGE_SIZE, include_fields=None, sort=None, sort_asc=True):
+        """
+        Iterate over all couchdb-lucene results of a query, holding only one
+        page in memory
+        couchdb-lucene does not support bookmarks, so pages are requested with skip
+        Errors are raised, so a failed page does not look like the end of results
+        """
+        page = 0
+        while True:
+            rows = self.__search_page(query_dict, page, page_size, include_fields, False, sort, sort_asc)
+            for row in rows:
+                yield row
+
+            if len(rows) < page_size:
+                return
+
+            page += 1
+
     def search(self, query_dict, page=0, limit=20, include_fields=None, total_rows=False, sort=None, sort_asc=True):
         """
         Query couchdb-lucene with given query dict
         Return a dict of results "rows" and number of "total_rows"
+        Page <0 returns all results, they are fetched page by page with iter_search
+        On error, no results are returned, also if only some pages failed
+        """
+        try:
+            if page < 0:
+                rows = list(self.iter_search(query_dict, include_fields=include_fields, sort=sort, sort_asc=sort_asc))
+                if total_rows:
+                    return {'rows': rows, 'total_rows': len(rows)}
+
+                return rows
+
+            return self.__search_page(query_dict, page, limit, include_fields, total_rows, sort, sort_asc)
+        except Exception as ex:
+            self.logger.error('Error searching %s in %s: %s', query_dict, self.db_name, ex)
+
+        if total_rows:
+            return {'rows': [],
+                    'total_rows': 0}
+
+        return []
+
+    def __search_page(self, query_dict, page, limit, include_fields, total_rows, sort, sort_asc):
+        """
+        Query one page of couchdb-lucene results, errors are raised
         """
         limit, skip = self.pagify(page, limit)
         query = self.make_query(query_dict)
@@ -436,10 +966,7 @@ class database:
         if include_fields:
             # couchdb-lucene bug - _id must be always included when specifying
             # which fields to fetch because couchdb-lucene has "_id" hardcoded
-            include_fields = set(include_fields.split(','))
-            include_fields.add('_id')
-            include_fields = ','.join(sorted(list(include_fields)))
-            options['include_fields'] = include_fields
+            options['include_fields'] = ','.join(self.projected_fields(include_fields))
 
         if not sort_asc:
             options['sort'] = '\\%s' % (options['sort'])
@@ -456,34 +983,10 @@ class database:
                                              method='POST',
                                              headers=headers,
                                              data=options)
-        for attempt in range(1, self.max_attempts + 1):
-            try:
-                with self.opener.open(lucene_request) as response:
-                    data = json.loads(response.read())
-                    if total_rows:
-                        return {'rows': [r['doc'] for r in data.get('rows', [])],
-                                'total_rows': data.get('total_rows', 0)}
-
-                    return [r['doc'] for r in data.get('rows', [])]
-
-            except urllib.error.HTTPError as http_error:
-                code = http_error.code
-                self.logger.error('HTTP error %s %s: %s', url, options, http_error)
-                if 400 <= code < 500:
-                    # If it's HTTP 4xx - bad request, no point in retry
-                    break
-
-                if attempt < self.max_attempts:
-                    sleep = 2 ** attempt
-                    time.sleep(sleep)
-            except Exception as ex:
-                self.logger.error('Error %s %s: %s', url, options, ex)
-                if attempt < self.max_attempts:
-                    sleep = 2 ** attempt
-                    time.sleep(sleep)
+        with self.__open(lucene_request) as response:
+            data = json_codec.load(response)
+            if total_rows:
+                return {'rows': [r['doc'] for r in data.get('rows', [])],
+                        'total_rows': data.get('total_rows', 0)}
 
-        if total_rows:
-            return {'rows': [],
-                    'total_rows': 0}
-
-        return []
+            return [r['doc'] for r in data.get('rows', [])]
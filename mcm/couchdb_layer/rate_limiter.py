@@ -0,0 +1,91 @@
+"""
+Module that contains process wide rate limiters of downstream endpoints
+"""
+import threading
+import time
+import urllib.parse
+from contextlib import contextmanager
+from threading import Lock
+
+
+class RateLimiter:
+    """
+    Token bucket of a single (host, port) endpoint
+    Only threads that run in a throttled() block take tokens, so background
+    work such as campaign inspection is kept under the ceiling while
+    interactive requests are never delayed by it
+    Tokens are reserved before sleeping, so waiting threads are served in
+    the order in which they came
+    """
+    # Process wide limiters, key is (scheme, host, port)
+    limiters = {}
+    limiters_lock = Lock()
+    # Requests per second of throttled block of the current thread
+    local = threading.local()
+
+    def __init__(self, endpoint, rate):
+        self.endpoint = endpoint
+        self.rate = float(rate)
+        # Allow a burst of at most one second worth of requests
+        self.capacity = max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = Lock()
+        self.waited = 0.0
+
+    @classmethod
+    def for_url(cls, url, rate):
+        """
+        Return the shared limiter for host and port of given url
+        """
+        parsed = urllib.parse.urlsplit(url)
+        scheme = parsed.scheme or 'http'
+        port = parsed.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parsed.hostname, port)
+        with cls.limiters_lock:
+            limiter = cls.limiters.get(key)
+            if limiter is None:
+                limiter = cls('%s:%s' % (parsed.hostname, port), rate)
+                cls.limiters[key] = limiter
+
+            return limiter
+
+    @classmethod
+    @contextmanager
+    def throttled(cls, rate):
+        """
+        Keep requests made by this thread in the block under given number
+        of requests per second per endpoint, shared with other throttled
+        threads of the process
+        """
+        previous = getattr(cls.local, 'rate', None)
+        cls.local.rate = rate
+        try:
+            yield
+        finally:
+            cls.local.rate = previous
+
+    @classmethod
+    def before_request(cls, url):
+        """
+        Wait for a token of the endpoint if current thread is throttled
+        """
+        rate = getattr(cls.local, 'rate', None)
+        if rate:
+            cls.for_url(url, rate).acquire()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            self.waited += wait
+
+        if wait:
+            time.sleep(wait)
+
+    def stats(self):
+        return {'rate': self.rate,
+                'waited': round(self.waited, 3)}
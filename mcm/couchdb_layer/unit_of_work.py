@@ -0,0 +1,153 @@
+"""
+Module that contains unit of work of a single HTTP request or script run
+Unit of work hands out shared database objects and remembers every document
+that was read through them, so each document is fetched at most once
+"""
+import threading
+import time
+from collections import OrderedDict
+from flask import g, has_request_context
+
+
+# Units of work entered by scripts, per thread
+thread_local = threading.local()
+
+
+class UnitOfWork:
+    """
+    Database objects and identity map of documents read in one unit of work
+    In HTTP requests unit of work is created on first use and stored on
+    flask.g, scripts use it as a context manager:
+        with UnitOfWork():
+            ...
+    Documents are kept JSON encoded, so every reader gets its own copy, and
+    they are forgotten as soon as they are written
+    Only database objects handed out by the unit use its identity map
+    Writes and _changes feed notifications of any thread are recorded in a
+    process wide log of invalidations, a remembered document is not used if
+    it was invalidated after it was read or if it is older than MAX_AGE
+    """
+    # Seconds for which a remembered document is used, bounds how long a
+    # change that was not seen in this process goes unnoticed
+    MAX_AGE = 10
+    # (database name, _id) -> (sequence, time) of last invalidation, oldest first
+    invalidations = OrderedDict()
+    invalidations_lock = threading.Lock()
+    sequence = 0
+
+    def __init__(self):
+        self.databases = {}
+        # (database name, _id) -> (raw document, sequence, time) when it was read
+        self.documents = {}
+        self.hits = 0
+        self.previous = None
+
+    def database(self, db_name):
+        """
+        Return database object shared by this unit of work
+        """
+        db = self.databases.get(db_name)
+        if db is None:
+            from couchdb_layer.mcm_database import database
+            db = database(db_name)
+            db.unit_of_work = self
+            self.databases[db_name] = db
+
+        return db
+
+    @classmethod
+    def invalidate(cls, db_name, doc_id):
+        """
+        Record that document changed, remembered copies of all units of work
+        that were read before are not used anymore
+        """
+        now = time.monotonic()
+        with cls.invalidations_lock:
+            cls.sequence += 1
+            key = (db_name, doc_id)
+            cls.invalidations.pop(key, None)
+            cls.invalidations[key] = (cls.sequence, now)
+            # Documents read before old invalidations are too old to be used
+            while cls.invalidations:
+                _, (_, invalidated) = next(iter(cls.invalidations.items()))
+                if now - invalidated < cls.MAX_AGE:
+                    break
+
+                cls.invalidations.popitem(last=False)
+
+    @classmethod
+    def current_sequence(cls):
+        """
+        Return sequence of the last invalidation, it must be taken before a
+        document is fetched, so changes during the fetch are not missed
+        """
+        return cls.sequence
+
+    def get_document(self, db_name, doc_id):
+        """
+        Return raw document if it was already read and did not change since,
+        otherwise None
+        """
+        key = (db_name, doc_id)
+        remembered = self.documents.get(key)
+        if remembered is None:
+            return None
+
+        body, sequence, read_at = remembered
+        invalidation = self.invalidations.get(key)
+        if (invalidation and invalidation[0] > sequence) or time.monotonic() - read_at >= self.MAX_AGE:
+            del self.documents[key]
+            return None
+
+        self.hits += 1
+        return body
+
+    def remember(self, db_name, doc_id, body, sequence):
+        self.documents[(db_name, doc_id)] = (body, sequence, time.monotonic())
+
+    def forget(self, db_name, doc_id):
+        self.documents.pop((db_name, doc_id), None)
+
+    def clear(self):
+        """
+        Forget all documents, database objects are kept
+        """
+        self.documents.clear()
+
+    def __enter__(self):
+        self.previous = getattr(thread_local, 'unit', None)
+        thread_local.unit = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        thread_local.unit = self.previous
+        self.previous = None
+
+
+def current_unit(create=True):
+    """
+    Return unit of work of the current HTTP request or the one entered by a
+    script in this thread, None if there is none
+    """
+    if has_request_context():
+        unit = g.get('mcm_unit_of_work')
+        if unit is None and create:
+            unit = UnitOfWork()
+            g.mcm_unit_of_work = unit
+
+        return unit
+
+    return getattr(thread_local, 'unit', None)
+
+
+def shared_database(db_name):
+    """
+    Return database object shared by the current unit of work or a new
+    database object if there is no unit of work
+    """
+    unit = current_unit()
+    if unit is None:
+        from couchdb_layer.mcm_database import database
+        return database(db_name)
+
+    return unit.database(db_name)
@@ -0,0 +1,55 @@
+"""
+Configuration of McM production server
+Run with: gunicorn -c gunicorn.conf.py main:app
+Worker processes and their request threads are configured with
+$MCM_WORKERS and $MCM_THREADS, see tools/locator.py
+Send SIGHUP to the master process for a graceful reload
+"""
+import logging
+import os
+
+from tools.locator import locator
+
+l_type = locator()
+bind = '%s:%s' % (l_type.host(), l_type.port())
+workers = l_type.workers()
+# Every worker serves requests with a bounded pool of threads, further
+# connections wait in the listen backlog
+worker_class = 'gthread'
+threads = l_type.threads()
+backlog = 256
+# Worker that does not respond for this long is killed and replaced, on
+# reload and shutdown workers get the same time to finish their requests
+timeout = l_type.request_timeout()
+graceful_timeout = l_type.request_timeout()
+keepalive = 5
+pidfile = 'mcm.pid'
+# Application is imported after fork, so every worker gets its own
+# threads, connection pools and caches
+preload_app = False
+
+
+def post_worker_init(worker):
+    """
+    Setup loggers and start _changes listeners in a new worker process
+    """
+    from main import setup_process
+    from couchdb_layer.changes_listener import ChangesListener
+    error_logger = setup_process(l_type.debug())
+    error_logger.info('Started worker %s, threads=%s, production mode: %s',
+                      os.getpid(),
+                      threads,
+                      l_type.isProd())
+    if l_type.follow_changes_feed():
+        ChangesListener.start_listeners()
+
+
+def worker_exit(server, worker):
+    """
+    Send notifications accumulated by the stopping worker
+    """
+    from tools.communicator import communicator
+    try:
+        communicator().flush(0)
+    except Exception as ex:
+        logging.getLogger('mcm_error').error('Could not flush notifications: %s', ex)
@@ -7,6 +7,7 @@ from json_layer.campaign import campaign
 from json_layer.mccm import mccm
 from json_layer.flow import flow
 from couchdb_layer.mcm_database import database
+from couchdb_layer.unit_of_work import shared_database
 from tools.priority import priority
 from tools.locker import locker
 from tools.locator import locator
@@ -374,13 +375,12 @@ class chained_request(json_base):
         #    'The approval of the chained request is none, and therefore flow cannot happen')
 
         # this operation requires to access all sorts of objects
-        rdb = database('requests')
-        cdb = database('campaigns')
-        ccdb = database('chained_campaigns')
-        crdb = database('chained_requests')
-        fdb = database('flows')
-        sdb = database('settings')
-        ldb = database('lists')
+        rdb = shared_database('requests')
+        cdb = shared_database('campaigns')
+        ccdb = shared_database('chained_campaigns')
+        crdb = shared_database('chained_requests')
+        fdb = shared_database('flows')
+        ldb = shared_database('lists')
 
         l_type = locator()
 
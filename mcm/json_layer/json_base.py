@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import logging
+import threading
 import traceback
 
 from tools.user_management import authenticator, user_pack
@@ -8,7 +9,10 @@ from tools.communicator import communicator
 import tools.settings as settings
 from tools.locker import locker
 from couchdb_layer.mcm_database import database
+from couchdb_layer.unit_of_work import shared_database
 from copy import deepcopy
+from collections import OrderedDict
+from contextlib import contextmanager
 from tools.user_management import access_rights
 
 class json_base:
@@ -16,6 +20,15 @@ class json_base:
     __approvalsteps = ['none', 'validation', 'define', 'approve', 'submit']
     __status = ['new', 'validation', 'defined', 'approved', 'submitted', 'done']
     __schema = {}
+    # Save batch of the current thread, see json_base.batch()
+    __batch = threading.local()
+    # Merge strategy used by save() when document was changed by someone else
+    # It is called with the latest document in database and the document being
+    # saved and returns the document to save instead or None to give up
+    # e.g. merge_strategy = staticmethod(json_base.merge_overwrite)
+    merge_strategy = None
+    # Number of save attempts when merge strategy is set
+    SAVE_ATTEMPTS = 3
     logger = logging.getLogger("mcm_error")
 
     class WrongApprovalSequence(Exception):
@@ -74,11 +87,86 @@ class json_base:
         def __str__(self):
             return self.message
 
+    class SaveBatch:
+        """
+        Unit of work that collects objects saved inside json_base.batch() and
+        writes them with one _bulk_docs request per database
+        """
+
+        def __init__(self):
+            # (database name, _id) -> (database, object)
+            self.objects = OrderedDict()
+            # (database name, _id) -> status returned by database.bulk_save
+            self.statuses = {}
+
+        def add(self, obj):
+            db = obj.get_database()
+            if db is None:
+                return False
+
+            # Last saved object of the same document wins
+            key = (db.db_name, obj.get_attribute('_id'))
+            self.objects.pop(key, None)
+            self.objects[key] = (db, obj)
+            return True
+
+        def flush(self):
+            """
+            Write all collected objects and return list of failed statuses
+            """
+            grouped = OrderedDict()
+            for (db_name, _), (db, obj) in self.objects.items():
+                grouped.setdefault(db_name, (db, []))[1].append(obj)
+
+            self.objects.clear()
+            for db, objects in grouped.values():
+                statuses = db.bulk_save([obj.json() for obj in objects])
+                for status in statuses:
+                    self.statuses[(db.db_name, status['id'])] = status
+
+            return self.failed()
+
+        def failed(self):
+            return [s for s in self.statuses.values() if not s['ok']]
+
     def __init__(self, json=None):
         json = json if json else {}
         if json:
             self.__json = json
 
+    @classmethod
+    @contextmanager
+    def batch(cls):
+        """
+        Collect objects saved inside the context and write them in bulk when it exits
+            with json_base.batch() as save_batch:
+                obj.save()
+            failed = save_batch.failed()
+        Inside the context save() only marks the object as dirty and returns True
+        Nothing is written if the context exits with an exception
+        Nested contexts are merged into the outermost one
+        """
+        save_batch = getattr(json_base.__batch, 'current', None)
+        if save_batch is not None:
+            yield save_batch
+            return
+
+        save_batch = json_base.SaveBatch()
+        json_base.__batch.current = save_batch
+        try:
+            yield save_batch
+        finally:
+            json_base.__batch.current = None
+
+        save_batch.flush()
+
+    @staticmethod
+    def in_batch():
+        """
+        Return whether saves of the current thread are collected by a batch
+        """
+        return getattr(json_base.__batch, 'current', None) is not None
+
     def setup(self):
         self.com = communicator()
 
@@ -103,6 +191,9 @@ class json_base:
         if save_current:
             if not self.save():
                 return False
+            if self.in_batch():
+                # Object is not written yet, it gets the new revision when batch is flushed
+                return True
         db = self.get_database()
         if db is None:
             return False
@@ -113,28 +204,59 @@ class json_base:
     def get_database(self):
         try:
             if self.__class__.__name__ == "batch":
-                return database(self.__class__.__name__ + "es")
+                return shared_database(self.__class__.__name__ + "es")
             else:
-                return database(self.__class__.__name__ + "s")
+                return shared_database(self.__class__.__name__ + "s")
         except (database.DatabaseNotFoundException, database.DatabaseAccessError) as ex:
             self.logger.error("Problem with database creation:\n{0}".format(ex))
             return None
 
-    def save(self):
+    @staticmethod
+    def merge_overwrite(current, document):
+        """
+        Merge strategy that writes the document over the latest revision
+        """
+        return document
+
+    def save(self, merge_strategy=None):
         """
         Updates or creates document in database with name db_name
+        Document is saved with the _rev it was read with, in one request
+        If the revision is outdated, merge strategy (argument or class
+        attribute) decides what to save and save is retried
         """
+        save_batch = getattr(json_base.__batch, 'current', None)
+        if save_batch is not None:
+            return save_batch.add(self)
+
         db = self.get_database()
         if db is None:
             return False
-        with locker.lock(self.get_attribute('_id')):
-            if not db.document_exists(self.get_attribute('_id')):
-                saved = db.save(self.json())
-            else:
-                saved = db.update(self.json())
-            if not saved:
+
+        merge_strategy = merge_strategy if merge_strategy else self.merge_strategy
+        doc_id = self.get_attribute('_id')
+        for attempt in range(1, self.SAVE_ATTEMPTS + 1):
+            status = db.save_with_status(self.__json)
+            if status['ok']:
+                return True
+
+            if status['error'] != 'conflict' or not merge_strategy or attempt == self.SAVE_ATTEMPTS:
                 return False
-        return True
+
+            current = db.get(doc_id)
+            if not current:
+                return False
+
+            merged = merge_strategy(current, self.__json)
+            if merged is None:
+                self.logger.error('Could not merge %s with revision %s', doc_id, current['_rev'])
+                return False
+
+            self.logger.info('Retrying save of %s on top of revision %s', doc_id, current['_rev'])
+            merged['_rev'] = current['_rev']
+            self.__json = merged
+
+        return False
 
     def overwrite(self, json_input):
         """
@@ -145,10 +267,10 @@ class json_base:
         if db is None:
             return False
         with locker.lock(self.get_attribute('_id')):
-            if not db.document_exists(self.get_attribute('_id')):
-                return False
             # reload the doc with db
             t = db.get(self.get_attribute('_id'))
+            if not t:
+                return False
             self.__init__(t)
             if "_rev" in json_input:
                 self.logger.debug("trying to overwrite.DB _rev:%s Doc _rev: %s" % (t["_rev"], json_input["_rev"]))
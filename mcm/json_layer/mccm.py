@@ -115,7 +115,7 @@ class mccm(json_base):
         """
         requests_db = Database('requests')
         prepids = self.get_request_list()
-        requests = requests_db.bulk_get(prepids)
+        requests = requests_db.bulk_get(prepids, include_fields='total_events')
         events = sum(max(0, r.get('total_events', 0)) for r in requests)
         self.set_attribute('total_events', events)
 
@@ -125,7 +125,7 @@ class mccm(json_base):
         """
         request_prepids = self.get_request_list()
         request_db = Database('requests')
-        requests = request_db.bulk_get(request_prepids)
+        requests = request_db.bulk_get(request_prepids, include_fields='approval')
         allowed_approvals = {'approve', 'submit'}
         for request in requests:
             if request.get('approval') not in allowed_approvals:
@@ -141,7 +141,7 @@ class mccm(json_base):
         """
         request_prepids = self.get_request_list()
         request_db = Database('requests')
-        requests = request_db.bulk_get(request_prepids)
+        requests = request_db.bulk_get(request_prepids, include_fields='prepid,approval')
         defined = {'define', 'approve', 'submit'}
         if [r for r in requests if r.get('approval') not in defined]:
             # There are requests that are not defined/approved/submitted
@@ -156,7 +156,7 @@ class mccm(json_base):
         """
         request_prepids = self.get_request_list()
         request_db = Database('requests')
-        requests = request_db.bulk_get(request_prepids)
+        requests = request_db.bulk_get(request_prepids, include_fields='prepid,approval')
         defined = {'define', 'approve', 'submit'}
         defined_prepids = [r['prepid'] for r in requests if r.get('approval') in defined]
         not_defined_prepids = sorted(list(set(request_prepids) - set(defined_prepids)))
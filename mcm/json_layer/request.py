@@ -31,6 +31,8 @@ from tools.locker import locker
 from tools.user_management import access_rights
 from tools.logger import InjectionLogAdapter
 from tools.connection_wrapper import ConnectionWrapper
+from tools.stats_sync import StatsSync
+from tools import dataset_name
 
 
 class AFSPermissionError(Exception):
@@ -315,8 +317,7 @@ class request(json_base):
             self.set_attribute('total_events', int(1 + total_events_should_be / float(rounding_unit)) * int(rounding_unit))
 
     def ok_to_move_to_approval_validation(self, for_chain=False):
-        settingsDB = database('settings')
-        if settingsDB.get('validation_stop')['value']:
+        if settings.get_value('validation_stop'):
             self.test_failure(message=None, what='', rewind=True, with_notification=False)
             return {'message': ('validation jobs are halted to allow forthcoming mcm restart - try again later')}
 
@@ -599,7 +600,7 @@ class request(json_base):
         validation_disable = settings.get_value('validation_disable')
         do_runtest = not validation_disable
 
-        by_pass = settingsDB.get('validation_bypass')['value']
+        by_pass = settings.get_value('validation_bypass')
         if self.get_attribute('prepid') in by_pass:
             do_runtest = False
             self.update_history({
@@ -1167,6 +1168,35 @@ class request(json_base):
         # the last tier is the main output : reverse it
         return list(reversed(r_tiers))
 
+    def get_expected_outputs(self):
+        """
+        Return expected tiers (main output first), their priorities, processing
+        strings and transient tiers of the outputs of this request
+        They are computed once and kept until attributes they depend on change
+        """
+        key = dumps([self.get_attribute(attribute) for attribute in ('sequences',
+                                                                     'keep_output',
+                                                                     'transient_output_modules',
+                                                                     'process_string',
+                                                                     'extension',
+                                                                     'flown_with',
+                                                                     'member_of_chain',
+                                                                     'member_of_campaign')])
+        if getattr(self, 'expected_outputs', (None,))[0] == key:
+            return self.expected_outputs[1]
+
+        tiers = self.get_tiers()
+        tier_priority = {}
+        for index, tier in enumerate(tiers):
+            tier_priority.setdefault(tier, index)
+
+        outputs = {'tiers': tiers,
+                   'tier_priority': tier_priority,
+                   'processing_strings': frozenset(self.get_processing_strings()),
+                   'transient_tiers': frozenset(self.get_transient_tiers())}
+        self.expected_outputs = (key, outputs)
+        return outputs
+
     def get_transient_tiers(self):
         transient_output_modules = self.get_attribute('transient_output_modules')
         transient_tiers = []
@@ -2022,15 +2052,18 @@ class request(json_base):
 
         return stats_reqmgr_name_list
 
-    def get_stats(self, forced=False, patch_input_dataset=True):
-        l_type = locator()
-        stats_db = database('requests', url=l_type.stats_database_url())
+    def get_stats(self, forced=False, patch_input_dataset=True, stats_sync=None):
+        """
+        Update workflows, completed events, output datasets and priority of
+        the request from Stats2, the request is not saved
+        Stats2 data is read from stats_sync, so many requests can share it
+        Return whether anything changed
+        """
+        if stats_sync is None:
+            stats_sync = StatsSync([self])
+
         prepid = self.get_attribute('prepid')
-        stats_workflows = stats_db.raw_query_view('_designDoc',
-                                                  'requests',
-                                                  page=0,
-                                                  limit=-1,
-                                                  options={'key': prepid})
+        stats_workflows = stats_sync.workflows_of(prepid)
 
         mcm_reqmgr_list = self.get_attribute('reqmgr_name')
         mcm_reqmgr_name_list = [x['name'] for x in mcm_reqmgr_list]
@@ -2062,12 +2095,12 @@ class request(json_base):
         total_events = 0
         for reqmgr_name in all_reqmgr_name_list:
             stats_doc = stats_workflows_dict.get(reqmgr_name, None)
-            if not stats_doc and stats_db.document_exists(reqmgr_name):
+            if not stats_doc and stats_sync.workflow(reqmgr_name):
                 self.logger.info('Workflow %s is in Stats DB, but workflow does not have request %s in it\'s list' % (reqmgr_name,
                                                                                                                       self.get_attribute('prepid')))
-                stats_doc = stats_db.get(reqmgr_name)
+                stats_doc = stats_sync.workflow(reqmgr_name)
 
-            if not stats_doc or not stats_db.document_exists(reqmgr_name):
+            if not stats_doc:
                 self.logger.warning('Workflow %s is in McM already, but not in Stats DB' % (reqmgr_name))
                 new_mcm_reqmgr_list.append({'name': reqmgr_name,
                                             'content': {}})
@@ -2131,21 +2164,14 @@ class request(json_base):
             new_mcm_reqmgr_list.append(new_rr)
 
         new_mcm_reqmgr_list = sorted(new_mcm_reqmgr_list, key=lambda workflow: '_'.join(workflow['name'].split('_')[-3:]))
-        old_mcm_reqmgr_list_string = dumps(mcm_reqmgr_list, indent=2, sort_keys=True)
-        new_mcm_reqmgr_list_string = dumps(new_mcm_reqmgr_list, indent=2, sort_keys=True)
-        changes_happen = old_mcm_reqmgr_list_string != new_mcm_reqmgr_list_string
+        changes_happen = mcm_reqmgr_list != new_mcm_reqmgr_list
         # self.logger.debug('New workflows: %s' % (dumps(new_mcm_reqmgr_list, indent=2, sort_keys=True)))
         self.set_attribute('reqmgr_name', new_mcm_reqmgr_list)
 
         if len(new_mcm_reqmgr_list):
-            tiers_expected = self.get_tiers()
+            tiers_expected = self.get_expected_outputs()['tiers']
             self.logger.debug('%s tiers expected: %s' % (self.get_attribute('prepid'), tiers_expected))
-            collected = self.collect_outputs(new_mcm_reqmgr_list,
-                                             tiers_expected,
-                                             self.get_processing_strings(),
-                                             self.get_attribute('dataset_name'),
-                                             self.get_attribute('member_of_campaign'),
-                                             skip_check=forced)
+            collected = self.collect_outputs(new_mcm_reqmgr_list, skip_check=forced)
 
             self.logger.debug('Collected outputs for %s: %s' % (self.get_attribute('prepid'),
                                                                 dumps(collected, indent=2, sort_keys=True)))
@@ -2180,14 +2206,9 @@ class request(json_base):
                 changes_happen = True
 
         if patch_input_dataset:
-            crdb = database('chained_requests')
-            rdb = database('requests')
-            chained_requests = crdb.query_view('contains', self.get_attribute('prepid'), page_num=-1)
-            for cr in chained_requests:
-                chain = cr.get('chain', [])
-                index_of_this_request = chain.index(self.get_attribute('prepid'))
-                if index_of_this_request > -1 and index_of_this_request < len(chain) - 1:
-                    next_request = request(rdb.get(chain[index_of_this_request + 1]))
+            for next_request_json in stats_sync.next_requests_of(prepid):
+                if next_request_json:
+                    next_request = request(next_request_json)
                     if not next_request.get_attribute('input_dataset'):
                         input_dataset = self.get_ds_input(self.get_attribute('output_dataset'), next_request.get_attribute('sequences'))
                         next_request.set_attribute('input_dataset', input_dataset)
@@ -2248,15 +2269,16 @@ class request(json_base):
             raise self.BadParameterValue('Input dataset of %s has status "%s" which is not allowed' % (prepid,
                                                                                                        status))
 
-    def inspect(self, force=False):
+    def inspect(self, force=False, stats_sync=None):
         # this will look for corresponding wm requests, add them,
         # check on the last one in date and check the status of the output DS for -> done
+        # stats_sync can hold Stats2 data prefetched for many requests
         not_good = {"prepid": self.get_attribute('prepid'), "results": False}
 
         # only if you are in submitted status
         # later, we could inspect on "approved" and trigger injection
         if self.get_attribute('status') == 'submitted':
-            return self.inspect_submitted(force=force)
+            return self.inspect_submitted(force=force, stats_sync=stats_sync)
         elif self.get_attribute('status') == 'approved':
             return self.inspect_approved()
 
@@ -2299,70 +2321,53 @@ class request(json_base):
                 self.get_attribute('status'), self.get_attribute('approval'))})
             return not_good
 
-    def collect_outputs(self, mcm_rr, tiers_expected, proc_strings, prime_ds, camp, skip_check=False):
-
-        re_to_match = re.compile("/%s(.*)/%s(.*)\\-v(.*)/" % (prime_ds, camp))
-        collected = []
-        versioned = {}
-
-        # make tiers and their priority hash_map to have O(1)
-        tiers_hash_map = {}
-        for t in tiers_expected:
-            tiers_hash_map[t] = tiers_expected.index(t)
-
+    def collect_outputs(self, mcm_rr, skip_check=False):
+        """
+        Return the newest version of every expected output dataset of the
+        workflows, sorted by priority of the tier, 1st one is used for accounting
+        skip_check takes all datasets, also the ones that were not expected
+        """
+        outputs = self.get_expected_outputs()
+        tier_priority = outputs['tier_priority']
+        proc_strings = outputs['processing_strings']
+        prime_ds = self.get_attribute('dataset_name')
+        camp = self.get_attribute('member_of_campaign')
+        # unversioned name -> (dataset, version, tier priority)
+        newest = {}
         for wma in mcm_rr:
-            if 'content' not in wma or not wma['content']:
-                continue
-            if 'pdmv_dataset_list' not in wma['content']:
+            if not wma.get('content') or 'pdmv_dataset_list' not in wma['content']:
                 continue
-            those = wma['content']['pdmv_dataset_list']
-
-            for ds in those:
-                # we do all the DS-PS/TIER checks for the requests and last Step
-                if re.match(re_to_match, ds) or skip_check:
-                    # get current version
-                    # 0th element is empty string of first /
-                    # 1st is datset+process_string
-                    # 2nd is version number
-                    # 3rd is datatier
-                    curr_v = re.split('(.*)\\-v(.*)/', ds)
-                    # Do some checks
-                    if not curr_v[-1] in tiers_expected and not skip_check:
+
+            for ds in wma['content']['pdmv_dataset_list']:
+                dataset = dataset_name.parse(ds)
+                if not skip_check:
+                    # we do all the DS-PS/TIER checks for the requests and last Step
+                    if (not dataset
+                            or not dataset.primary_dataset.startswith(prime_ds)
+                            or not dataset.processed_dataset.startswith(camp)):
+                        self.logger.info("collect_outputs didn't match anything for: %s" % (
+                                self.get_attribute("prepid")))
+                        continue
+
+                    if dataset.tier not in tier_priority:
                         continue
 
-                    if not skip_check:
-                        if not ds.split('/')[-2].split('-')[-2] in proc_strings:
-                            # most likely there is a fake/wrong dataset
-                            continue
+                    if dataset.processing_string not in proc_strings:
+                        # most likely there is a fake/wrong dataset
+                        continue
 
-                    # find and save the max version for the dataset
-                    uniq_name = curr_v[1] + curr_v[-1]
+                if dataset:
+                    uniq_name, version, tier = dataset.unversioned, dataset.version, dataset.tier
+                else:
+                    uniq_name, version, tier = ds, 0, dataset_name.tier(ds)
 
+                # find and save the max version for the dataset
+                if uniq_name not in newest or version > newest[uniq_name][1]:
                     # tier priority from has map, or max length if priority is not existing
-                    if ds.split("/")[-1] not in tiers_hash_map:
-                        tier_priority = len(tiers_hash_map)
-                    else:
-                        tier_priority = tiers_hash_map[(ds.split('/')[-1])]
-
-                    if uniq_name in versioned:
-                        if curr_v[-2] > versioned[uniq_name]["version"]:
-                            versioned[uniq_name] = {
-                                "version": curr_v[-2],
-                                "full_dataset": ds,
-                                "priority": tier_priority}
-                    else:
-                        versioned[uniq_name] = {
-                            "version": curr_v[-2],
-                            "full_dataset": ds,
-                            "priority": tier_priority}
-                else:
-                    self.logger.info("collect_outputs didn't match anything for: %s" % (
-                            self.get_attribute("prepid")))
+                    newest[uniq_name] = (ds, version, tier_priority.get(tier, len(tier_priority)))
 
-        collected = [(versioned[el]["full_dataset"], versioned[el]["priority"]) for el in versioned]
         # sort by tier priority. 1st element is taken for events calculation
-        collected.sort(key=itemgetter(1))
-
+        collected = sorted(newest.values(), key=itemgetter(2))
         # return only list of sorted datasets
         return [el[0] for el in collected]
 
@@ -2381,10 +2386,10 @@ class request(json_base):
                 valid *= (wma['content']['pdmv_dataset_statuses'][ds_for_accounting]['pdmv_status_in_DAS'] == 'VALID')
         return (valid,counted)
 
-    def inspect_submitted(self, force):
+    def inspect_submitted(self, force, stats_sync=None):
         not_good = {"prepid": self.get_attribute('prepid'), "results": False}
         # get fresh up to date stats
-        changes_happen = self.get_stats()
+        changes_happen = self.get_stats(stats_sync=stats_sync)
         mcm_rr = self.get_attribute('reqmgr_name')
         db = database('requests')
         ignore_for_status = settings.get_value('ignore_for_status')
@@ -2403,12 +2408,10 @@ class request(json_base):
 
                 if wma_r['content']['pdmv_status_from_reqmngr'] in ['announced', 'normal-archived']:
                     # this is enough to get all datasets
-                    tiers_expected = self.get_tiers()
+                    expected_outputs = self.get_expected_outputs()
+                    tiers_expected = expected_outputs['tiers']
                     collected = self.collect_outputs(
-                        mcm_rr, tiers_expected,
-                        self.get_processing_strings(), self.get_attribute("dataset_name"),
-                        self.get_attribute("member_of_campaign"),
-                        skip_check=self.get_attribute("keep_output").count(True) == 0)
+                        mcm_rr, skip_check=self.get_attribute("keep_output").count(True) == 0)
 
                     # collected as the correct order : in first place, there is what needs to be considered for accounting
                     if (not len(collected) and self.get_attribute("keep_output").count(True) > 0):
@@ -2432,14 +2435,15 @@ class request(json_base):
                         return not_good
 
                     self.logger.info('Expected tiers of %s are %s' % (self.get_attribute('prepid'), tiers_expected))
-                    transient_tiers = self.get_transient_tiers()
+                    transient_tiers = expected_outputs['transient_tiers']
                     if len(transient_tiers) > 0:
                         tiers_expected = [x for x in tiers_expected if x not in transient_tiers]
                         self.logger.info('Expected tiers of %s after removing transien tiers: %s' % (self.get_attribute('prepid'), tiers_expected))
 
                     # make sure no expected tier was left behind
                     if not force:
-                        if not all([any([t == dn.split('/')[-1] for dn in collected]) for t in tiers_expected]):
+                        produced_tiers = set(dataset_name.tier(dn) for dn in collected)
+                        if not all(t in produced_tiers for t in tiers_expected):
 
                             not_good.update({'message': 'One of the expected tiers %s has not been produced'
                                     % ( tiers_expected )})
@@ -2990,8 +2994,7 @@ class request(json_base):
 
     def request_to_tasks(self, base, depend):
         tasks = []
-        settings_db = database('settings')
-        __DT_prio = settings_db.get('datatier_input')["value"]
+        __DT_prio = settings.get_value('datatier_input')
         validation_info = []
 
         # Filter efficiency or time per event was not check on validation
@@ -7,7 +7,8 @@ from copy import deepcopy
 
 class sequence(json_base):
 
-    _json_base__schema = settings.get_value('cmsdriver_options')
+    # Schema is a setting, it is read when the first sequence is made
+    _json_base__schema = {}
 
     def __init__(self, json_input=None):
         json_input = json_input if json_input else {}
@@ -23,6 +24,10 @@ class sequence(json_base):
         self.__update(json_input)
         self.__validate()
 
+    @classmethod
+    def class_schema(cls):
+        return settings.get_value('cmsdriver_options')
+
     def __validate(self):
         if not self._json_base__json:
             return
@@ -1,4 +1,4 @@
-from rest_api.ControlActions import Search, Communicate, CacheInfo, CacheClear
+from rest_api.ControlActions import Search, Communicate, CacheInfo, CacheClear, GetMetrics
 from rest_api.RestAPIMethod import RESTResourceIndex, RESTResource
 from rest_api.RequestActions import ImportRequest, ManageRequest, DeleteRequest, GetRequest, GetRequestByDataset, UpdateRequest, GetCmsDriverForRequest, GetFragmentForRequest, GetSetupForRequest, ApproveRequest, ResetRequestApproval, SetStatus, GetStatus, GetStatusAndApproval, GetEditable, GetDefaultGenParams, CloneRequest, RegisterUser, GetActors, NotifyUser, InspectStatus, UpdateStats, RequestsFromFile, StalledReminder, RequestsReminder, SearchableRequest, UpdateMany, ListRequestPrepids, OptionResetForRequest, GetRequestOutput, GetInjectCommand, GetUploadCommand, GetUniqueValues, PutToForceComplete, ForceCompleteMethods, Reserve_and_ApproveChain, TaskChainRequestDict, RequestsPriorityChange, UpdateEventsFromWorkflow, PPDTags, GENLogOutput, RequestsFromDataset
 from rest_api.CampaignActions import CreateCampaign, DeleteCampaign, UpdateCampaign, GetCampaign, ToggleCampaignStatus, GetCmsDriverForCampaign, InspectCampaigns
@@ -8,7 +8,7 @@ from rest_api.FlowActions import CreateFlow, UpdateFlow, DeleteFlow, GetFlow, Ap
 from rest_api.UserActions import GetUserRole, AddRole, AskRole, ChangeRole, GetUser, SaveUser, GetUserPWG, NotifyPWG
 from rest_api.BatchActions import HoldBatch, GetBatch, AnnounceBatch, InspectBatches, ResetBatch, NotifyBatch
 from rest_api.InvalidationActions import GetInvalidation, DeleteInvalidation, AnnounceInvalidations, AcknowledgeInvalidation, PutHoldtoNewInvalidations, PutOnHoldInvalidation
-from rest_api.DashboardActions import GetLocksInfo, GetBjobs, GetLogFeed, GetLogs, GetRevision, GetStartTime, GetQueueInfo
+from rest_api.DashboardActions import GetLocksInfo, GetBjobs, GetLogFeed, GetLogs, GetRevision, GetStartTime, GetQueueInfo, GetCircuitBreakers, GetLockStats
 from rest_api.MccmActions import GetMccm, UpdateMccm, CreateMccm, DeleteMccm, CancelMccm, GetEditableMccmFields, GenerateChains, MccMReminderProdManagers, MccMReminderGenConveners, MccMReminderGenContacts, CalculateTotalEvts, CheckIfAllApproved, NotifyMccm
 from rest_api.SettingsActions import GetSetting, UpdateSetting, SaveSetting
 from rest_api.TagActions import GetTags, AddTag, RemoveTag
@@ -18,6 +18,9 @@ from json_layer.sequence import sequence  # to get campaign sequences
 from tools.communicator import communicator
 from tools.logger import UserFilter
 from tools.locator import locator
+from tools.metrics import metrics
+from couchdb_layer.changes_listener import ChangesListener
+from tools.responses import json_response, compress_response
 from flask_restful import Api
 from flask import Flask, send_from_directory, request, g
 
@@ -34,6 +37,13 @@ app = Flask(__name__)
 app.config.update(LOGGER_NAME="mcm_error")
 api = Api(app)
 app.url_map.strict_slashes = False
+
+
+@api.representation('application/json')
+def output_json(data, code, headers=None):
+    """Makes a Flask response with a JSON encoded body"""
+    return json_response(data, code, headers)
+
 # Set flask logging to warning
 logging.getLogger('werkzeug').setLevel(logging.WARNING)
 # Set paramiko logging to warning
@@ -349,6 +359,8 @@ api.add_resource(GetRevision, '/restapi/dashboard/get_revision')
 api.add_resource(GetStartTime, '/restapi/dashboard/get_start_time')
 api.add_resource(GetLocksInfo, '/restapi/dashboard/lock_info')
 api.add_resource(GetQueueInfo, '/restapi/dashboard/queue_info')
+api.add_resource(GetCircuitBreakers, '/restapi/dashboard/circuit_breakers')
+api.add_resource(GetLockStats, '/restapi/dashboard/lock_stats')
 # REST mccms Actions
 api.add_resource(
     GetMccm,
@@ -384,6 +396,19 @@ api.add_resource(
     '/restapi/control/communicate/<string:message_number>')
 api.add_resource(CacheInfo, '/restapi/control/cache_info')
 api.add_resource(CacheClear, '/restapi/control/cache_clear')
+api.add_resource(GetMetrics, '/restapi/control/metrics')
+
+
+def log_file_name(name):
+    """
+    Return name of a log file
+    Every worker process of the production server writes to its own files,
+    because rotation of a file shared by processes would lose records
+    """
+    if locator().workers() > 1:
+        return '%s-%s.log' % (name, os.getpid())
+
+    return '%s.log' % (name)
 
 
 def setup_error_logger(debug):
@@ -406,7 +431,7 @@ def setup_error_logger(debug):
 
         log_size = 10 * 1024 * 1024  # 10MB
         log_count = 500  # 500 files
-        log_name = os.path.join(logs_folder, "error.log")
+        log_name = os.path.join(logs_folder, log_file_name("error"))
         handler = logging.handlers.RotatingFileHandler(log_name, 'a', log_size, log_count)
         handler.setLevel(logging.INFO)
 
@@ -437,7 +462,7 @@ def setup_injection_logger(debug):
 
         log_size = 10 * 1024 * 1024  # 10MB
         log_count = 500  # 500 files
-        log_name = os.path.join(logs_folder, "inject.log")
+        log_name = os.path.join(logs_folder, log_file_name("inject"))
         handler = logging.handlers.RotatingFileHandler(log_name, 'a', log_size, log_count)
         handler.setLevel(logging.INFO)
 
@@ -466,7 +491,7 @@ def setup_access_logger(debug):
 
         log_size = 10 * 1024 * 1024  # 10MB
         log_count = 500  # 500 files
-        log_name = os.path.join(logs_folder, "access.log")
+        log_name = os.path.join(logs_folder, log_file_name("access"))
         handler = logging.handlers.RotatingFileHandler(log_name, 'a', log_size, log_count)
 
     handler.setLevel(logging.INFO)
@@ -515,17 +540,80 @@ def setup_access_logging(app, logger, debug):
     app.after_request(after)
 
 
-def main():
-    l_type = locator()
-    port = l_type.port()
-    host = l_type.host()
-    debug = l_type.debug()
-    # Setup loggers
+def setup_metrics(app):
+    """
+    Setup recording of duration, size, status and in flight count of
+    requests by the resource that handles them
+    """
+    def resource_name():
+        view = app.view_functions.get(request.endpoint)
+        view_class = getattr(view, 'view_class', None)
+        if view_class:
+            return view_class.__name__
+
+        # Static files and unknown paths
+        return request.endpoint or 'unmatched'
+
+    def before():
+        g.metrics_start_time = time.monotonic()
+        g.metrics_resource = resource_name()
+        metrics.increment('mcm_http_requests_in_flight', resource=g.metrics_resource, method=request.method)
+
+    def after(response):
+        if hasattr(g, 'metrics_start_time'):
+            resource = g.metrics_resource
+            method = request.method
+            metrics.increment('mcm_http_requests_total',
+                              resource=resource,
+                              method=method,
+                              status=response.status_code)
+            metrics.observe('mcm_http_request_duration_seconds',
+                            time.monotonic() - g.metrics_start_time,
+                            resource=resource,
+                            method=method)
+            # Unknown for streamed responses
+            size = response.calculate_content_length()
+            if size is not None:
+                metrics.observe('mcm_http_response_size_bytes', size, resource=resource, method=method)
+
+        return response
+
+    def teardown(exception):
+        if hasattr(g, 'metrics_start_time'):
+            metrics.increment('mcm_http_requests_in_flight', -1, resource=g.metrics_resource, method=request.method)
+
+    app.before_request(before)
+    app.after_request(after)
+    app.teardown_request(teardown)
+
+
+def setup_process(debug):
+    """
+    Setup loggers and access logging of this process
+    Called by the development server and by every production server worker
+    """
     logging.root.setLevel(logging.DEBUG if debug else logging.INFO)
     error_logger = setup_error_logger(debug)
     setup_injection_logger(debug)
     access_logger = setup_access_logger(debug)
     setup_access_logging(app, access_logger, debug)
+    setup_metrics(app)
+    # Registered last, so it runs first and metrics get the compressed size
+    app.after_request(compress_response)
+    return error_logger
+
+
+def main():
+    """
+    Run McM in the development server
+    Production deployments use a WSGI server, see gunicorn.conf.py
+    """
+    l_type = locator()
+    port = l_type.port()
+    host = l_type.host()
+    debug = l_type.debug()
+    error_logger = setup_process(debug)
+    signal.signal(signal.SIGTERM, at_flask_exit)
     # Write McM PID to a file
     if os.environ.get('WERKZEUG_RUN_MAIN') != 'true':
         # Do only once, before the reloader
@@ -536,6 +624,9 @@ def main():
 
     error_logger.info('Starting McM, host=%s, port=%s, debug=%s', host, port, debug)
     error_logger.info('Running in production mode: %s', l_type.isProd())
+    if l_type.follow_changes_feed():
+        ChangesListener.start_listeners()
+
     # Run flask
     app.run(host=host, port=port, threaded=True, debug=debug)
 
@@ -546,6 +637,5 @@ def at_flask_exit(*args):
     com.flush(0)
 
 
-signal.signal(signal.SIGTERM, at_flask_exit)
 if __name__ == '__main__':
     main()
@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-from couchdb_layer.mcm_database import database
+from couchdb_layer.unit_of_work import shared_database
 from json_layer.batch import batch
 from tools.locker import locker, semaphore_events
 import tools.settings as settings
@@ -9,7 +9,7 @@ import tools.settings as settings
 
 class BatchPrepId():
     def __init__(self):
-        self.bdb = database('batches')
+        self.bdb = shared_database('batches')
 
     def next_id(self, for_request, create_batch=True):
         flown_with = for_request['flown_with']
@@ -29,7 +29,7 @@ class BatchPrepId():
     def next_batch_id(self, next_campaign, version=0, extension=0, process_string="",
             flown_with="", create_batch=True):
 
-        with locker.lock('batch name clashing protection'):
+        with locker.lock('batch name clashing protection') as batch_lock:
             self.bdb.logger.debug("working on batch prepid")
             if flown_with:
                 batchName = flown_with + '_' + next_campaign
@@ -77,10 +77,10 @@ class BatchPrepId():
                     'extension': extension,
                     'process_string': process_string})
                 notes = ""
-                cdb = database('campaigns')
+                cdb = shared_database('campaigns')
                 cs = []
                 if not cdb.document_exists(next_campaign):
-                    ccdb = database('chained_campaigns')
+                    ccdb = shared_database('chained_campaigns')
                     if ccdb.document_exists(next_campaign):
                         mcm_cc = ccdb.get(next_campaign)
                         for (c, f) in mcm_cc['campaigns']:
@@ -91,13 +91,13 @@ class BatchPrepId():
                     if mcm_c['notes']:
                         notes += "Notes about the campaign %s:\n" % mcm_c['prepid'] + mcm_c['notes'] + "\n"
                 if flown_with:
-                    fdb = database('flows')
+                    fdb = shared_database('flows')
                     mcm_f = fdb.get(flown_with)
                     if mcm_f['notes']:
                         notes += "Notes about the flow:\n" + mcm_f['notes'] + "\n"
                 if notes:
                     newBatch.set_attribute('notes', notes)
                 newBatch.update_history({'action': 'created'})
-                self.bdb.save(newBatch.json())
+                self.bdb.save(newBatch.json(), fence=batch_lock)
 
             return batchName
@@ -1,15 +1,13 @@
 import flask
-import time
-import traceback
 import json
 
 from couchdb_layer.mcm_database import database as Database
 from rest_api.RestAPIMethod import RESTResource
 from json_layer.campaign import campaign as Campaign
-from json_layer.request import request as Request
 from json_layer.sequence import sequence as Sequence
 from json_layer.chained_campaign import chained_campaign as ChainedCampaign
 from tools.user_management import access_rights
+from tools.campaign_inspection import CampaignInspection
 import tools.settings as settings
 
 
@@ -226,6 +224,9 @@ class GetCampaign(RESTResource):
         campaign_db = Database('campaigns')
         return {'results': campaign_db.get(prepid=campaign_id)}
 
+    def etag(self, campaign_id):
+        return self.document_etag('campaigns', campaign_id)
+
 
 class ToggleCampaignStatus(RESTResource):
 
@@ -291,52 +292,15 @@ class InspectCampaigns(RESTResource):
     def get(self, campaign_id):
         """
         Inspect all requests in given campaign(s)
+        Optional arguments:
+        cursor - resume after "<campaign>:<prepid>" cursor from a previous output
+        workers - number of requests inspected at the same time
         """
         # force pretty output in browser for multiple lines
         self.representations = {'text/plain': self.output_text}
         # Make a list of IDs, although usually a single ID is expected
-        campaign_ids = list(set(campaign_id.split(',')))
-        from random import shuffle
-        shuffle(campaign_ids)
-        return flask.Response(flask.stream_with_context(self.inspect(campaign_ids)))
-
-    def inspect(self, campaign_ids):
-        request_db = Database('requests')
-        for campaign_id in campaign_ids:
-            try:
-                self.logger.info('Starting campaign inspect of %s', campaign_id)
-                yield 'Starting campaign inspect of %s\n' % (campaign_id)
-                query = {'member_of_campaign': campaign_id,
-                         'status': ['submitted', 'approved']}
-                # Do another loop over the requests themselves
-                page = 0
-                requests = [{}]
-                while len(requests) > 0:
-                    requests = request_db.search(query, page=page, limit=200)
-                    self.logger.info('Inspecting %s requests on page %s', len(requests), page)
-                    yield 'Inspecting %s requests on page %s\n' % (len(requests), page)
-                    for request_json in requests:
-                        prepid = request_json['prepid']
-                        self.logger.info('Inspecting request %s', prepid)
-                        yield 'Inspecting request %s\n' % (prepid)
-                        request = Request(request_json)
-                        inspect_result = request.inspect()
-                        if not inspect_result.get('results'):
-                            message = inspect_result.get('message', '?')
-                            self.logger.info('Failure: %s', message)
-                            yield 'Failure: %s\n' % (message)
-                        else:
-                            self.logger.info('Success!')
-                            yield 'Success!\n'
-
-                    page += 1
-                    time.sleep(0.1)
-
-                time.sleep(0.2)
-            except Exception as ex:
-                self.logger.error('Exception while inspecting %s campaign: %s\n%s',
-                                  campaign_id,
-                                  ex,
-                                  traceback.format_exc())
-
-            self.logger.info('Campaign %s inspection finished', campaign_id)
+        campaign_ids = campaign_id.split(',')
+        inspection = CampaignInspection(campaign_ids,
+                                        cursor=flask.request.args.get('cursor'),
+                                        workers=flask.request.args.get('workers', type=int))
+        return flask.Response(flask.stream_with_context(inspection.run()))
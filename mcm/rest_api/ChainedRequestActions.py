@@ -11,6 +11,7 @@ from json_layer.mccm import mccm
 from tools.user_management import access_rights
 from flask_restful import reqparse
 from tools.locker import locker
+import tools.settings as settings
 from rest_api.ChainedRequestPrepId import ChainedRequestPrepId
 
 
@@ -192,6 +193,9 @@ class GetChainedRequest(RESTResource):
         """
         return self.get_request(chained_request_id)
 
+    def etag(self, chained_request_id):
+        return self.document_etag(self.db_name, *chained_request_id.split(','))
+
     def get_request(self, data):
         db = database(self.db_name)
         if ',' in data:
@@ -540,9 +544,8 @@ class SearchableChainedRequest(RESTResource):
         """
         rdb = database('chained_requests')
         if action == 'do':
-            all_requests = rdb.get_all()
             searchable = {}
-            for request in all_requests:
+            for request in rdb.iter_view('chained_requests', 'all'):
                 for key in ["prepid", "approval", "status", "pwg", "step",
                             "last_status", "member_of_campaign", "dataset_name"]:
                     if key not in searchable:
@@ -592,9 +595,8 @@ class TestChainedRequest(RESTResource):
         """
         crdb = database('chained_requests')
         rdb = database('requests')
-        settingsDB = database('settings')
         mcm_cr = chained_request(crdb.get(chained_request_id))
-        if settingsDB.get('validation_stop')['value']:
+        if settings.get_value('validation_stop'):
             return {
                 "results": False,
                 'message': ('validation jobs are halted to allow forthcoming mcm ''restart - try again later'),
@@ -775,9 +777,7 @@ class TaskChainDict(RESTResource):
         kwargs = self.parser.parse_args()
         crdb = database('chained_requests')
         rdb = database('requests')
-        settingsDB = database('settings')
-
-        __DT_prio = settingsDB.get('datatier_input')["value"]
+        __DT_prio = settings.get_value('datatier_input')
 
         def tranform_to_step_chain(wma_dict, total_time_evt, total_size_evt):
             # replace Task -> Step in inside dictionaries
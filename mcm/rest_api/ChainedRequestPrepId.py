@@ -14,7 +14,7 @@ class ChainedRequestPrepId(RESTResourceIndex):
 
         chained_request_db = Database('chained_requests')
         prepid_part = '%s-%s' % (pwg, campaign_name)
-        with locker.lock('chained-request-prepid-%s' % (pwg)):
+        with locker.lock('chained-request-prepid-%s' % (pwg)) as prepid_lock:
             if prepid_part in self.serial_number_cache:
                 number = self.serial_number_cache[prepid_part] + 1
             else:
@@ -30,19 +30,26 @@ class ChainedRequestPrepId(RESTResourceIndex):
                     self.logger.info('Highest prepid number: %05d', newest[0])
                     number = newest[0] + 1
 
-            # Save last used prepid
-            # Make sure to include all deleted ones
-            prepid = '%s-%05d' % (prepid_part, number)
-            while chained_request_db.document_exists(prepid, include_deleted=True):
-                number += 1
+            while True:
+                # Make sure to include all deleted ones
                 prepid = '%s-%05d' % (prepid_part, number)
+                while chained_request_db.document_exists(prepid, include_deleted=True):
+                    number += 1
+                    prepid = '%s-%05d' % (prepid_part, number)
+
+                chained_request = ChainedRequest({'_id': prepid,
+                                                  'prepid': prepid,
+                                                  'pwg': pwg,
+                                                  'member_of_campaign': campaign_name})
+                chained_request.update_history({'action': 'created'})
+                # New document conflicts if another process created the prepid
+                # after the lease of its lock expired
+                if chained_request_db.save_with_status(chained_request.json(), fence=prepid_lock)['error'] != 'conflict':
+                    break
 
+                number += 1
+
+            # Save last used prepid
             self.serial_number_cache[prepid_part] = number
-            chained_request = ChainedRequest({'_id': prepid,
-                                              'prepid': prepid,
-                                              'pwg': pwg,
-                                              'member_of_campaign': campaign_name})
-            chained_request.update_history({'action': 'created'})
-            chained_request_db.save(chained_request.json())
             self.logger.info('New request created: %s ', prepid)
             return prepid
@@ -9,6 +9,7 @@ from json import dumps, loads
 
 from tools.communicator import communicator
 from couchdb_layer.mcm_database import database as Database
+from couchdb_layer.changes_listener import ChangesListener
 from tools.utils import clean_split
 
 
@@ -71,6 +72,9 @@ class Search(RESTResource):
         if not self.casting:
             self.prepare_casting()
 
+    def etag(self):
+        return self.listing_etag(flask.request.args.get('db_name', 'requests'))
+
     def get(self):
         args = flask.request.args.to_dict()
         self.logger.debug('Search: %s', ','.join('%s=%s' % (k, v) for k, v in list(args.items())))
@@ -161,7 +165,10 @@ class CacheInfo(RESTResource):
                             'user_cache_length': user_cache_length,
                             'user_cache_size': user_cache_size,
                             'user_role_cache_length': user_role_cache_length,
-                            'user_role_cache_size': user_role_cache_size}}
+                            'user_role_cache_size': user_role_cache_size,
+                            'db_cache_stats': db.cache_stats(),
+                            'db_connection_pools': db.connection_pools_stats(),
+                            'changes_feeds': ChangesListener.listeners_stats()}}
 
 
 class CacheClear(RESTResource):
@@ -193,3 +200,20 @@ class CacheClear(RESTResource):
                             'user_cache_size': user_cache_size,
                             'user_role_cache_length': user_role_cache_length,
                             'user_role_cache_size': user_role_cache_size}}
+
+
+class GetMetrics(RESTResource):
+
+    access_limit = access_rights.user
+
+    def __init__(self):
+        self.before_request()
+        self.count_call()
+
+    def get(self):
+        """
+        Get latency, size and error metrics of REST resources and downstream
+        services of this process in Prometheus text format
+        """
+        from tools.metrics import metrics
+        return self.output_text(metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
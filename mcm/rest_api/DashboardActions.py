@@ -156,7 +156,7 @@ class GetLocksInfo(RESTResource):
         self.count_call()
 
     def get(self):
-        from tools.locker import locker, semaphore_events
+        from tools.locker import locker, semaphore_events, lock_service
         pretty_r_locks = {}
         for key, lock in locker.lock_dictionary.items():
             pretty_r_locks[key] = '%s %s' % (key, str(lock))
@@ -165,8 +165,14 @@ class GetLocksInfo(RESTResource):
         for key, lock in locker.thread_lock_dictionary.items():
             pretty_locks[key] = '%s %s' % (key, str(lock))
 
-        return {"r_locks": pretty_r_locks,
+        pretty_local_locks = {}
+        for key, lock in locker.local_lock_dictionary.items():
+            pretty_local_locks[key] = '%s %s' % (key, str(lock))
+
+        return {"service": lock_service().name,
+                "r_locks": pretty_r_locks,
                 "locks (thread)": pretty_locks,
+                "locks (local)": pretty_local_locks,
                 "semaphores": semaphore_events.count_dictionary}
 
 class GetQueueInfo(RESTResource):
@@ -181,3 +187,51 @@ class GetQueueInfo(RESTResource):
         from tools.handlers import submit_pool
         data = {"submission_len": submit_pool.get_queue_length()}
         return data
+
+
+class GetCircuitBreakers(RESTResource):
+
+    access_limit = access_rights.generator_contact
+
+    def __init__(self):
+        self.before_request()
+        self.count_call()
+
+    def get(self):
+        """
+        Get state and counters of CouchDB and couchdb-lucene circuit breakers
+        """
+        from couchdb_layer.circuit_breaker import CircuitBreaker
+        return {"results": CircuitBreaker.breakers_stats()}
+
+
+class GetLockStats(RESTResource):
+
+    access_limit = access_rights.generator_contact
+
+    def __init__(self):
+        self.before_request()
+        self.count_call()
+
+    def get(self):
+        """
+        Get wait and hold times, contention and owners of the hottest locks
+        Optional arguments: top - number of locks, sort - attribute to sort by,
+        e.g. wait_total, wait_max, hold_total, hold_max, contended, waiting
+        """
+        import flask
+        from tools.locker import lock_statistics, lock_service, semaphore_events
+        args = flask.request.args
+        top = args.get('top', '20')
+        if not top.isdigit() or int(top) < 1:
+            return {"results": False, "message": "Top must be a positive number, not %s" % (top)}, 400
+
+        sort = args.get('sort', 'wait_total')
+        if sort not in lock_statistics.SORT_KEYS:
+            return {"results": False, "message": "Cannot sort by %s, use one of %s" % (sort, ', '.join(lock_statistics.SORT_KEYS))}, 400
+
+        top = int(top)
+        return {"results": {"service": lock_service().name,
+                            "buckets": list(lock_statistics.BUCKETS),
+                            "locks": lock_statistics.hottest(top, sort),
+                            "semaphores": dict(semaphore_events.count_dictionary)}}
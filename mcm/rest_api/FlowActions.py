@@ -35,25 +35,28 @@ class FlowRESTResource(RESTResource):
         remove_from = old_allowed_ids - (set() if next_changed else new_allowed_ids)
         add_to = new_allowed_ids - (set() if next_changed else old_allowed_ids)
         # Remove
+        # Each step is written in bulk, add step must read campaigns after removal
         if old_next_id:
-            for old_allowed_id in remove_from:
-                campaign = Campaign(json_input=campaign_db.get(old_allowed_id))
-                next_campaigns = campaign.get_attribute('next')
-                if old_next_id in next_campaigns:
-                    next_campaigns.remove(old_next_id)
-                    campaign.set_attribute('next', next_campaigns)
-                    campaign.save()
+            with Campaign.batch():
+                for old_allowed_id in remove_from:
+                    campaign = Campaign(json_input=campaign_db.get(old_allowed_id))
+                    next_campaigns = campaign.get_attribute('next')
+                    if old_next_id in next_campaigns:
+                        next_campaigns.remove(old_next_id)
+                        campaign.set_attribute('next', next_campaigns)
+                        campaign.save()
 
         # Add
         if new_next_id:
-            for new_allowed_id in add_to:
-                campaign = Campaign(json_input=campaign_db.get(new_allowed_id))
-                next_campaigns = campaign.get_attribute('next')
-                if new_next_id not in next_campaigns:
-                    next_campaigns.append(new_next_id)
-                    next_campaigns.sort()
-                    campaign.set_attribute('next', next_campaigns)
-                    campaign.save()
+            with Campaign.batch():
+                for new_allowed_id in add_to:
+                    campaign = Campaign(json_input=campaign_db.get(new_allowed_id))
+                    next_campaigns = campaign.get_attribute('next')
+                    if new_next_id not in next_campaigns:
+                        next_campaigns.append(new_next_id)
+                        next_campaigns.sort()
+                        campaign.set_attribute('next', next_campaigns)
+                        campaign.save()
 
     def set_default_request_parameters(self, flow):
         """
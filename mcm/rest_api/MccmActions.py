@@ -23,8 +23,7 @@ class CreateMccm(RESTResource):
     access_limit = access_rights.generator_contact
 
     def __init__(self):
-        settings_db = Database('settings')
-        self.possible_pwgs = settings_db.get("pwg")["value"]
+        self.possible_pwgs = settings.get_value('pwg')
         self.before_request()
         self.count_call()
 
@@ -850,7 +849,7 @@ class CheckIfAllApproved(RESTResource):
         mccm = MccM(json_input=mccm_json)
         requests_prepids = mccm.get_request_list()
         request_db = Database('requests')
-        requests = request_db.bulk_get(requests_prepids)
+        requests = request_db.bulk_get(requests_prepids, include_fields='prepid,approval')
         requests_prepids = set(requests_prepids)
         allowed_approvals = {'approve', 'submit'}
         for request in requests:
@@ -8,6 +8,9 @@ from collections import defaultdict
 import re
 
 from couchdb_layer.mcm_database import database
+from couchdb_layer.unit_of_work import shared_database
+from tools.stats_sync import StatsSync
+from tools.request_table import RequestTable, StalledRequests
 from rest_api.RestAPIMethod import RESTResource
 from rest_api.RequestPrepId import RequestPrepId
 from json_layer.request import request
@@ -352,7 +355,7 @@ class UpdateRequest(RequestRESTResource):
             else:
                 mcm_req.update_history({'action': 'update'})
 
-        return {"results": db.update(mcm_req.json())}
+        return {"results": mcm_req.save()}
 
 
 class ManageRequest(UpdateRequest):
@@ -638,11 +641,14 @@ class GetRequest(RESTResource):
         """
         return self.get_request(request_id)
 
+    def etag(self, request_id):
+        return self.document_etag(self.db_name, request_id)
+
     def get_request(self, data):
         db = database(self.db_name)
-        if not db.document_exists(data):
-            return {"results": {}}
         mcm_r = db.get(prepid=data)
+        if not mcm_r:
+            return {"results": {}}
         # cast the sequence for schema evolution !!! here or not ?
         for (i_s, s) in enumerate(mcm_r['sequences']):
             mcm_r['sequences'][i_s] = sequence(s).json()
@@ -829,13 +835,19 @@ class InspectStatus(RESTResource):
         res = []
         db = database('requests')
         crdb = database('chained_requests')
+        # Stats2 data of all submitted requests is fetched at once, requests
+        # themselves are read right before their inspection as it might
+        # change other requests of the list
+        submitted = [r for r in db.bulk_get(list(set(rlist)), include_fields=StatsSync.FIELDS)
+                     if r.get('status') == 'submitted']
+        stats_sync = StatsSync(submitted)
         for r in rlist:
             if not db.document_exists(r):
                 res.append({"prepid": r, "results": False, 'message': '%s does not exist' % r})
                 continue
             mcm_r = request(db.get(r))
             if mcm_r:
-                answer = mcm_r.inspect(force_req)
+                answer = mcm_r.inspect(force_req, stats_sync=stats_sync)
                 res.append(answer)
                 # trigger chained request inspection on "true" results from inspection
                 if answer['results']:
@@ -918,16 +930,23 @@ class UpdateEventsFromWorkflow(RESTResource):
                     "message": "No requests found produced by this workflow"}
 
         ret = []
-        # iterate on all requests running in same workflow, then put stats_update
+        # update all requests running in same workflow at once and save the changed ones
         # we do not trigger stats refresh as this api will be triggered by stats
-        for req in res:
-            mcm_r = request(rdb.get(req["prepid"]))
-            if mcm_r.get_stats():
-                mcm_r.reload()
-                ret.append({"prepid": req["prepid"], "results": True})
+        mcm_requests = [request(r) for r in rdb.bulk_get([req["prepid"] for req in res])]
+        stats_sync = StatsSync(mcm_requests)
+        changed = set(stats_sync.sync())
+        for mcm_r in mcm_requests:
+            prepid = mcm_r.get_attribute("prepid")
+            if prepid in changed:
+                ret.append({"prepid": prepid, "results": True})
+            elif prepid in stats_sync.failed:
+                ret.append({
+                    "prepid": prepid,
+                    "results": False,
+                    "message": "could not save the changes"})
             else:
                 ret.append({
-                    "prepid": req["prepid"],
+                    "prepid": prepid,
                     "results": False,
                     "message": "no apparent changes"})
 
@@ -1187,63 +1206,29 @@ class StalledReminder(RESTResource):
         """
         Collect the requests that have been running for too long (/since) or will run for too long (/since/remaining) and send a reminder, and below (/since/remaining/below) a certain percentage of completion
         """
-        l_type = locator()
-        rdb = database('requests')
-        bdb = database('batches')
-        statsDB = database('stats', url=l_type.stats_database_url())
-        __query = rdb.make_query()
-        today = time.mktime(time.gmtime())
+        rdb = shared_database('requests')
         text = "The following requests appear to be not progressing since %s days or will require more than %s days to complete and are below %4.1f%% completed :\n\n" % (time_since, time_remaining, below_completed)
-        reminded = 0
         by_batch = defaultdict(list)
-        request_prepids = []
-        page = 0
-        rs = [{}]
-        while len(rs) > 0:
-            rs = rdb.search({'status': 'submitted'}, page=page, limit=100)
-            self.logger.info('Found %d requests that are in status submitted in page %d' % (len(rs), page))
-            page += 1
-            for r in rs:
-                date_s = [h for h in r['history'] if 'step' in h and h['step'] == 'submitted'][-1]['updater']['submission_date']
-                date = time.mktime(time.strptime(date_s, "%Y-%m-%d-%H-%M"))
-                elapsed_t = (today - date)
-                elapsed = (today - date) / 60. / 60. / 24.  # in days
-                remaining = float("inf")
-                if r['completed_events']:
-                    remaining_t = (elapsed_t * ((r['total_events'] / float(r['completed_events'])) - 1))
-                    remaining = remaining_t / 60. / 60. / 24.
-                    if remaining < 0:  # already over stats
-                        remaining = 0.
-                fraction = min(100., r['completed_events'] * 100. / r['total_events'])  # maxout to 100% completed
-                if fraction > below_completed:
-                    continue
-
-                if (remaining > time_remaining and remaining != float('Inf')) or (elapsed > time_since and remaining != 0):
-                    reminded += 1
-                    bs = bdb.search({'contains': r['prepid'],
-                                     'status': ['announced', 'hold']},
-                                    page=-1)
-                    # take the last one ?
-                    in_batch = 'NoBatch'
-                    if len(bs):
-                        in_batch = bs[-1]['prepid']
-                    wma_status = 'not-found'
-                    if len(r['reqmgr_name']):
-                        wma_name = r['reqmgr_name'][-1]['name']
-                        stats = statsDB.get(wma_name)
-                        if stats and 'pdmv_status_from_reqmngr' in stats:
-                            wma_status = stats['pdmv_status_from_reqmngr']
-
-                    line = "%30s: %4.1f days since submission: %8s = %5.1f%% completed, remains %6.1f days, status %s, priority %s \n" % (
-                        r['prepid'],
-                        elapsed,
-                        r['completed_events'],
-                        fraction,
-                        remaining,
-                        wma_status,
-                        r['priority'])
-                    by_batch[in_batch].append(line)
-                    request_prepids.append(r['prepid'])
+        # Only needed fields of submitted requests are read, derived columns
+        # are computed for all of them and batches and Stats2 statuses of
+        # stalled ones are looked up in bulk
+        table = StalledRequests.search(rdb, {'status': 'submitted'})
+        table.compute(time.time())
+        stalled = table.stalled(time_since, time_remaining, below_completed)
+        reminded = len(stalled)
+        in_batch = table.batches(stalled)
+        wma_statuses = table.workflow_statuses(stalled)
+        for row in stalled:
+            prepid = table['prepid'][row]
+            line = "%30s: %4.1f days since submission: %8s = %5.1f%% completed, remains %6.1f days, status %s, priority %s \n" % (
+                prepid,
+                table['elapsed'][row],
+                int(table['completed_events'][row]),
+                table['fraction'][row],
+                table['remaining'][row],
+                wma_statuses.get(table['workflow'][row], 'not-found'),
+                table['priority'][row])
+            by_batch[in_batch.get(prepid, 'NoBatch')].append(line)
 
         l_type = locator()
         for (b, lines) in list(by_batch.items()):
@@ -1257,8 +1242,8 @@ class StalledReminder(RESTResource):
 
         udb = database('users')
 
-        production_managers = udb.search({'role': 'production_manager'}, page=-1)
-        gen_conveners = udb.search({'role': 'generator_convener'}, page=-1)
+        production_managers = udb.search({'role': 'production_manager'}, page=-1, include_fields='email')
+        gen_conveners = udb.search({'role': 'generator_convener'}, page=-1, include_fields='email')
         people_list = production_managers + gen_conveners
         subject = "Gentle reminder of %d requests that appear stalled" % (reminded)
         if reminded != 0:
@@ -1295,13 +1280,16 @@ class RequestsReminder(RESTResource):
         # fill up the reminders
         def get_all_in_status(status, extracheck=None):
             campaigns_and_ids = {}
-            for mcm_r in rdb.search({'status': status}, page=-1):
+            columns = {'prepid': ('prepid', None),
+                       'member_of_campaign': ('member_of_campaign', None),
+                       'member_of_chain': ('member_of_chain', len)}
+            table = RequestTable.search(rdb, {'status': status}, columns=columns)
+            for prepid, c, chains in zip(table['prepid'], table['member_of_campaign'], table['member_of_chain']):
                 # check whether it has a valid action before to add them in the reminder
-                c = mcm_r['member_of_campaign']
                 if c not in campaigns_and_ids:
                     campaigns_and_ids[c] = set()
-                if extracheck is None or extracheck(mcm_r):
-                    campaigns_and_ids[c].add(mcm_r['prepid'])
+                if extracheck is None or extracheck(chains):
+                    campaigns_and_ids[c].add(prepid)
 
             # then remove the empty entries, and sort the others
             for c in list(campaigns_and_ids.keys()):
@@ -1332,18 +1320,17 @@ class RequestsReminder(RESTResource):
                     message += '%srequests?page=-1&member_of_campaign=%s&status=%s \n' % (
                         l_type.baseurl(), camp, status_for_link)
 
-                for rid in ids:
-                    req = request(rdb.get(rid))
+                for req in rdb.bulk_get(ids, include_fields='prepid,dataset_name,member_of_chain,priority'):
                     message += '\t%s (%s) (%d chains) (prio %s) \n' % (
-                        rid,
-                        req.get_attribute('dataset_name'),
-                        len(req.get_attribute('member_of_chain')),
-                        req.get_attribute('priority'))
+                        req['prepid'],
+                        req.get('dataset_name'),
+                        len(req.get('member_of_chain', [])),
+                        req.get('priority'))
                 message += '\n'
             return message
 
-        def is_in_chain(r):
-            return len(r['member_of_chain']) != 0
+        def is_in_chain(number_of_chains):
+            return number_of_chains != 0
 
         def streaming_function():
             if not what or 'production_manager' in what:
@@ -1353,7 +1340,7 @@ class RequestsReminder(RESTResource):
                     res.extend([{"results": True, "prepid": i} for i in ids_for_production_managers[c]])
 
                 if len(ids_for_production_managers):
-                    production_managers = udb.search({'role': 'production_manager'}, page=-1)
+                    production_managers = udb.search({'role': 'production_manager'}, page=-1, include_fields='email')
                     message = 'A few requests that needs to be submitted \n\n'
                     message += prepare_text_for(ids_for_production_managers, 'approved')
                     subject = 'Gentle reminder on %s requests to be submitted' % ( count_entries(ids_for_production_managers))
@@ -1363,8 +1350,11 @@ class RequestsReminder(RESTResource):
                 all_ids = set()
                 # remind the gen contact about requests that are:
                 #   - in status new, and have been flown
-                mcm_rs = []
-                mcm_rs.extend(rdb.search({'status': 'validation'}, page=-1))
+                mcm_rs = list(rdb.iter_search({'status': 'validation'},
+                                              include_fields='prepid,member_of_campaign,member_of_chain,flown_with,history'))
+                # chains of all requests are read at once instead of one by one
+                chain_ids = sorted(set(cr for mcm_r in mcm_rs for cr in mcm_r.get('member_of_chain', [])))
+                chains = {cr['prepid']: cr for cr in crdb.bulk_get(chain_ids, include_fields='prepid,chain,step')}
                 for mcm_r in mcm_rs:
                     c = mcm_r['member_of_campaign']
                     request_id = mcm_r['prepid']
@@ -1377,7 +1367,10 @@ class RequestsReminder(RESTResource):
                     on_going = False
                     yield '.'
                     for in_chain in mcm_r['member_of_chain']:
-                        mcm_chained_request = chained_request(crdb.get(in_chain))
+                        if in_chain not in chains:
+                            continue
+
+                        mcm_chained_request = chained_request(chains[in_chain])
                         try:
                             if mcm_chained_request.get_attribute('chain')[mcm_chained_request.get_attribute('step')] == request_id:
                                 on_going = True
@@ -1390,7 +1383,6 @@ class RequestsReminder(RESTResource):
                                     'chain': mcm_chained_request.get_attribute('prepid'),
                                     'request': request_id},
                                 indent=2)
-                        time.sleep(0.5)  # we don't want to crash DB with a lot of single queries
                         yield '.'
                     if not on_going:
                         continue
@@ -1408,7 +1400,7 @@ class RequestsReminder(RESTResource):
                         yield '.'
 
                 # then remove the non generator
-                gen_contacts = [u['username'] for u in udb.search('search', {'role': 'generator_contact'}, page=-1)]
+                gen_contacts = [u['username'] for u in udb.search({'role': 'generator_contact'}, page=-1, include_fields='username')]
                 for contact in list(ids_for_users.keys()):
                     if who and contact not in who:
                         ids_for_users.pop(contact)
@@ -1476,21 +1468,35 @@ class UpdateMany(RequestRESTResource):
         updated_values = data["updated_data"]
         return_info = []
         db = database(self.db_name)
-        for elem in list_of_prepids:
-            document = db.get(elem)
-            for value in updated_values:
-                if value in ('generator_parameters', 'sequences', 'keep_output', 'time_event', 'size_event', 'interested_pwg'):
-                    document[value] = updated_values[value]
-                elif isinstance(updated_values[value], list):
-                    temp = updated_values[value]
-                    temp.extend(document[value])
-                    document[value] = list(set(temp))
-                else:
-                    document[value] = updated_values[value]
-            try:
-                return_info.append(self.updateSingle.update_request(document))
-            except Exception as e:
-                return_info.append({"results": False, "message": str(e)})
+        # All updated requests are written at once
+        with request.batch() as save_batch:
+            for elem in list_of_prepids:
+                document = db.get(elem)
+                if not document:
+                    # Exception would drop updates of all other requests
+                    return_info.append({"results": False, "message": "Request %s does not exist" % (elem)})
+                    continue
+
+                try:
+                    for value in updated_values:
+                        if value in ('generator_parameters', 'sequences', 'keep_output', 'time_event', 'size_event', 'interested_pwg'):
+                            document[value] = updated_values[value]
+                        elif isinstance(updated_values[value], list):
+                            temp = updated_values[value]
+                            temp.extend(document[value])
+                            document[value] = list(set(temp))
+                        else:
+                            document[value] = updated_values[value]
+
+                    return_info.append(self.updateSingle.update_request(document))
+                except Exception as e:
+                    return_info.append({"results": False, "message": str(e)})
+
+        failed = {status['id']: status for status in save_batch.failed()}
+        for index, prepid in enumerate(list_of_prepids):
+            if prepid in failed:
+                return_info[index] = {"results": False, "message": failed[prepid]['reason']}
+
         self.logger.info('updating requests: %s' % return_info)
         return {"results": return_info}
 
@@ -1694,18 +1700,25 @@ class RequestsPriorityChange(RESTResource):
             requests: list[dict] = flask.request.json
         except TypeError:
             return {"results": False, "message": "Couldn't read body of request"}
-        for request_dict in requests:
-            request_prepid = request_dict['prepid']
-            mcm_request = request(self.requests_db.get(request_prepid))
-            if 'priority_raw' in request_dict:
-                new_priority = request_dict['priority_raw']
-            else:
-                new_priority = priority().priority(request_dict['priority'])
+        # All changed requests are written at once
+        with request.batch() as save_batch:
+            for request_dict in requests:
+                request_prepid = request_dict['prepid']
+                mcm_request = request(self.requests_db.get(request_prepid))
+                if 'priority_raw' in request_dict:
+                    new_priority = request_dict['priority_raw']
+                else:
+                    new_priority = priority().priority(request_dict['priority'])
+
+                if not mcm_request.change_priority(new_priority):
+                    message = 'Unable to set new priority in request %s' % request_prepid
+                    fails.append(message)
+                    self.logger.error(message)
 
-            if not mcm_request.change_priority(new_priority):
-                message = 'Unable to set new priority in request %s' % request_prepid
-                fails.append(message)
-                self.logger.error(message)
+        for status in save_batch.failed():
+            message = 'Unable to save new priority in request %s: %s' % (status['id'], status['reason'])
+            fails.append(message)
+            self.logger.error(message)
         return {
             'results': True if len(fails) == 0 else False,
             'message': fails}
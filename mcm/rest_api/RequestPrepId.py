@@ -16,7 +16,7 @@ class RequestPrepId(RESTResourceIndex):
         request_db = Database('requests')
         campaign_db = Database('campaigns')
         prepid_part = '%s-%s' % (pwg, campaign_name)
-        with locker.lock('request-prepid-%s' % (pwg)):
+        with locker.lock('request-prepid-%s' % (pwg)) as prepid_lock:
             if prepid_part in self.serial_number_cache:
                 number = self.serial_number_cache[prepid_part] + 1
             else:
@@ -32,20 +32,27 @@ class RequestPrepId(RESTResourceIndex):
                     self.logger.info('Highest prepid number: %05d', newest[0])
                     number = newest[0] + 1
 
-            # Save last used prepid
-            # Make sure to include all deleted ones
-            prepid = '%s-%05d' % (prepid_part, number)
-            while request_db.document_exists(prepid, include_deleted=True):
-                number += 1
+            campaign = Campaign(campaign_db.get(campaign_name))
+            while True:
+                # Make sure to include all deleted ones
                 prepid = '%s-%05d' % (prepid_part, number)
+                while request_db.document_exists(prepid, include_deleted=True):
+                    number += 1
+                    prepid = '%s-%05d' % (prepid_part, number)
+
+                request = Request(campaign.add_request({'_id': prepid,
+                                                        'prepid': prepid,
+                                                        'pwg': pwg,
+                                                        'member_of_campaign': campaign_name}))
+                request.update_history({'action': 'created'})
+                # New document conflicts if another process created the prepid
+                # after the lease of its lock expired
+                if request_db.save_with_status(request.json(), fence=prepid_lock)['error'] != 'conflict':
+                    break
 
+                number += 1
+
+            # Save last used prepid
             self.serial_number_cache[prepid_part] = number
-            campaign = Campaign(campaign_db.get(campaign_name))
-            request = Request(campaign.add_request({'_id': prepid,
-                                                    'prepid': prepid,
-                                                    'pwg': pwg,
-                                                    'member_of_campaign': campaign_name}))
-            request.update_history({'action': 'created'})
-            request_db.save(request.json())
             self.logger.info('New request created: %s ', prepid)
             return prepid
@@ -1,20 +1,25 @@
 #!/usr/bin/env python
+import hashlib
 import logging
 import re
 
 from tools.user_management import access_rights, roles
 from tools.user_management import authenticator, user_pack
-from tools.locker import locker
+from tools.metrics import metrics
+from tools.responses import json_response
+from couchdb_layer.mcm_database import database
+from couchdb_layer.changes_listener import ChangesListener
 from flask_restful import Resource
-from flask import request, abort, make_response, current_app, render_template
-import json
+from flask_restful.utils import unpack
+from flask import request, abort, make_response, current_app, render_template, Response
 
 
 class RESTResource(Resource):
     logger = logging.getLogger("mcm_error")
     access_limit = None
     access_user = []
-    call_counters = {}
+    # Seconds without changes after which listing gets an ETag
+    LISTING_QUIET_TIME = 10
     limit_per_method = {
         'GET': access_rights.user,
         'PUT': access_rights.generator_contact,
@@ -30,28 +35,102 @@ class RESTResource(Resource):
             self.logger.info('Setting access limit to access_rights.%s (%s)' % (roles[access_limit], access_limit))
         elif request.method in self.limit_per_method:
             access_limit = self.limit_per_method[request.method]
-        user_p = user_pack()
         try:
-            self.user_dict = {'username': user_p.get_username(),
-                              'role': authenticator.get_user_role(user_p.get_username())}
+            # Resolved once per request
+            user = authenticator.current_user()
         except:
-            self.user_dict = {'username': 'anonymous',
-                              'role': 'user'}
-        if not user_p.get_username():
+            user = {'username': user_pack().get_username(),
+                    'role': 'user',
+                    'role_index': access_rights.user}
+        username = user['username']
+        self.user_dict = {'username': username,
+                          'role': user['role']}
+        if not username:
             # meaning we are going public, only allow GET.
             if 'public' not in request.path:
                 self.logger.error('From within %s, adfs-login not found: \n %s \n %s' % (self.__class__.__name__, str(request.headers), str(request.path)))
         else:
-            if not authenticator.can_access(user_p.get_username(), access_limit):
-                if user_p.get_username() in self.access_user:
-                    self.logger.error('User %s allowed to get through' % user_p.get_username())
+            if access_limit is not None and user['role_index'] < access_limit:
+                if username in self.access_user:
+                    self.logger.error('User %s allowed to get through' % username)
                 else:
                     abort(403)
 
+    def etag(self, *args, **kwargs):
+        """
+        Return ETag of GET response for given arguments if it is known without
+        reading the database, otherwise None
+        Resources whose responses can be cached by clients override it
+        """
+        return None
+
+    def make_etag(self, *parts):
+        value = '|'.join(str(part) for part in (self.__class__.__name__,) + parts)
+        return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+    def document_etag(self, db_name, *doc_ids):
+        """
+        Return ETag made of revisions of documents if all of them are known
+        """
+        db = database(db_name)
+        revisions = [db.known_revision(doc_id) for doc_id in doc_ids]
+        if not revisions or None in revisions:
+            return None
+
+        return self.make_etag(db_name, *revisions)
+
+    def listing_etag(self, db_name):
+        """
+        Return ETag of a listing of given database, it changes with every change
+        in the database
+        Search index is updated after the database, so no ETag is given until
+        the database was not changing for LISTING_QUIET_TIME seconds
+        """
+        sequence = ChangesListener.update_sequence(db_name, self.LISTING_QUIET_TIME)
+        if sequence is None:
+            return None
+
+        return self.make_etag(db_name, sequence, request.full_path)
+
+    def dispatch_request(self, *args, **kwargs):
+        """
+        Answer GET with 304 Not Modified if client has the current version
+        """
+        if request.method != 'GET':
+            return Resource.dispatch_request(self, *args, **kwargs)
+
+        etag = self.etag(*args, **kwargs)
+        if etag and request.if_none_match.contains_weak(etag):
+            return Response(status=304, headers={'ETag': 'W/"%s"' % (etag)})
+
+        response = Resource.dispatch_request(self, *args, **kwargs)
+        if etag is None:
+            # Handler might have cached the documents
+            etag = self.etag(*args, **kwargs)
+
+        if etag is None:
+            return response
+
+        # Weak, body is the same, but it might be compressed differently
+        etag = 'W/"%s"' % (etag)
+        if isinstance(response, Response):
+            if response.status_code == 200:
+                response.headers['ETag'] = etag
+
+            return response
+
+        data, code, headers = unpack(response)
+        if code != 200:
+            return response
+
+        headers = dict(headers or {})
+        headers['ETag'] = etag
+        return data, code, headers
+
     def output_text(self, data, code, headers=None):
         """Makes a Flask response with a plain text encoded body"""
         if isinstance(data, (dict, list)):
-            data = json.dumps(data, indent=1)
+            return json_response(data, code, headers)
 
         resp = make_response(data, code)
         if headers:
@@ -62,13 +141,7 @@ class RESTResource(Resource):
 
     def count_call(self):
         # counter for calls
-        method = request.method
-        with locker.lock("rest-call-counter"):
-           key = self.__class__.__name__ + method
-           try:
-               RESTResource.call_counters[key] += 1
-           except KeyError:
-               RESTResource.call_counters[key] = 1
+        metrics.increment('mcm_rest_calls_total', resource=self.__class__.__name__, method=request.method)
 
     def get_obj_diff(self, old, new, ignore_keys, diff=None, key_path=''):
         if diff is None:
@@ -175,12 +248,7 @@ class RESTResourceIndex(RESTResource):
                 else:
                     method_dict['access_limit'] = roles[func.view_class.limit_per_method[m]]
 
-                try:
-                    call_count_key = function_name + m
-                    call_count = RESTResource.call_counters[call_count_key]
-                except KeyError:
-                    call_count = 0
-
+                call_count = metrics.value('mcm_rest_calls_total', resource=function_name, method=m)
                 method_dict['call_count'] = '%d' % (call_count)
                 methods_list.append(method_dict)
 
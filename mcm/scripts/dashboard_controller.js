@@ -95,6 +95,24 @@ angular.module('testApp').controller('resultsCtrl',
         $scope.update["fail"] = true;
         $scope.update["status_code"] = data.status;
       });
+
+      var promise3 = $http.get("restapi/dashboard/circuit_breakers");
+      promise3.then(function(data, status){
+        $scope.circuit_breakers = data.data.results;
+      }, function(data, status){
+        $scope.update["success"] = false;
+        $scope.update["fail"] = true;
+        $scope.update["status_code"] = data.status;
+      });
+
+      var promise4 = $http.get("restapi/dashboard/lock_stats?top=10");
+      promise4.then(function(data, status){
+        $scope.lock_stats = data.data.results;
+      }, function(data, status){
+        $scope.update["success"] = false;
+        $scope.update["fail"] = true;
+        $scope.update["status_code"] = data.status;
+      });
     };
 
     $scope.getLogData = function(log_name){
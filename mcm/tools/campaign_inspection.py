@@ -0,0 +1,227 @@
+"""
+Module that contains parallel inspection of all requests of campaigns
+"""
+import itertools
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import flask
+
+from couchdb_layer.mcm_database import database
+from couchdb_layer.rate_limiter import RateLimiter
+from json_layer.request import request as Request
+from tools.locator import locator
+from tools.stats_sync import StatsSync
+
+
+class CampaignInspection:
+    """
+    Inspection of submitted and approved requests of campaigns
+    Requests of one campaign are inspected by at most `workers` threads at
+    the same time and all CouchDB, couchdb-lucene and Stats2 calls of the
+    inspection are kept under `rate_limit` requests per second per endpoint
+    A request whose inspection takes longer than `deadline` seconds is
+    reported as timed out and inspection moves on, its thread is not killed
+    Campaigns and their requests are inspected in order of prepid, so the
+    cursor "<campaign>:<prepid>" that is periodically written to the output
+    says that all requests up to it were inspected and inspection can be
+    resumed after it
+    """
+    logger = logging.getLogger('mcm_error')
+    PAGE_SIZE = 200
+    STATUSES = ['submitted', 'approved']
+    MAX_WORKERS = 16
+    # Seconds between progress lines
+    PROGRESS_INTERVAL = 10
+
+    def __init__(self, campaign_ids, cursor=None, workers=None, deadline=None, rate_limit=None):
+        self.campaign_ids = sorted(set(campaign_ids))
+        self.cursor_campaign, self.cursor_prepid = self.parse_cursor(cursor)
+        config = locator()
+        self.workers = min(max(1, workers or config.inspect_workers()), self.MAX_WORKERS)
+        self.deadline = deadline or config.inspect_deadline()
+        self.rate_limit = rate_limit or config.inspect_rate_limit()
+
+    @staticmethod
+    def parse_cursor(cursor):
+        """
+        Return campaign and prepid of a cursor, prepid may be None
+        """
+        if not cursor:
+            return None, None
+
+        campaign_id, _, prepid = cursor.partition(':')
+        return campaign_id, prepid or None
+
+    def run(self):
+        """
+        Inspect all campaigns and yield output lines
+        """
+        start = time.time()
+        with RateLimiter.throttled(self.rate_limit):
+            for campaign_id in self.campaign_ids:
+                if self.cursor_campaign and campaign_id < self.cursor_campaign:
+                    continue
+
+                after = self.cursor_prepid if campaign_id == self.cursor_campaign else None
+                try:
+                    yield from self.inspect_campaign(campaign_id, after)
+                except Exception as ex:
+                    self.logger.error('Exception while inspecting %s campaign: %s', campaign_id, ex, exc_info=True)
+                    yield 'Exception while inspecting %s campaign: %s\n' % (campaign_id, ex)
+
+        yield 'Inspection of %s campaigns finished in %.1fs\n' % (len(self.campaign_ids), time.time() - start)
+
+    def inspect_campaign(self, campaign_id, after=None):
+        """
+        Inspect requests of a campaign with prepid greater than `after`
+        """
+        request_db = database('requests')
+        query = {'member_of_campaign': campaign_id,
+                 'status': self.STATUSES}
+        total = request_db.search(query, limit=1, include_fields='prepid', total_rows=True)['total_rows']
+        self.logger.info('Starting campaign inspect of %s, %s requests', campaign_id, total)
+        yield 'Starting campaign inspect of %s, %s requests, %s workers\n' % (campaign_id, total, self.workers)
+        # Requests of the campaign come from a view in order of prepid and
+        # every page starts after the last row, so requests that leave the
+        # statuses while they are inspected do not shift later pages as
+        # they would with skip of a search
+        options = {'key': campaign_id}
+        if after:
+            options['startkey_docid'] = after
+
+        request_jsons = (r for r in request_db.iter_view('requests', 'member_of_campaign', options, page_size=self.PAGE_SIZE)
+                         if r.get('status') in self.STATUSES and (not after or r['prepid'] > after))
+
+        progress = {'campaign': campaign_id,
+                    'total': total,
+                    'done': 0,
+                    'failures': 0,
+                    'timeouts': 0,
+                    'cursor': '%s:%s' % (campaign_id, after) if after else campaign_id,
+                    'start': time.time(),
+                    'reported': time.time()}
+        # Inspections in order of prepid, finished ones are removed from the
+        # front and cursor moves over them
+        pending = deque()
+        # Futures that hold a worker thread, timed out ones until they return
+        occupied = set()
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='inspect')
+        try:
+            while True:
+                page = [Request(r) for r in itertools.islice(request_jsons, self.PAGE_SIZE)]
+                if not page:
+                    break
+
+                # Stats2 data of all submitted requests of the page is fetched at once
+                stats_sync = StatsSync([r for r in page if r.get_attribute('status') == 'submitted'])
+                for mcm_request in page:
+                    while True:
+                        occupied.difference_update([future for future in occupied if future.done()])
+                        if len(occupied) < self.workers:
+                            break
+
+                        if all(entry['finished'] for entry in pending):
+                            # Every worker is stuck in a timed out inspection,
+                            # the rest of the campaign can be resumed from cursor
+                            message = 'All %s workers are stuck in timed out inspections, stopping inspection of %s' % (self.workers, campaign_id)
+                            self.logger.error(message)
+                            yield '%s\n' % (message)
+                            yield self.progress_lines(progress)
+                            return
+
+                        yield from self.collect(pending, occupied, progress, block=True)
+
+                    task = self.inspect_request
+                    if flask.has_request_context():
+                        task = flask.copy_current_request_context(task)
+
+                    entry = {'prepid': mcm_request.get_attribute('prepid'),
+                             'started': None,
+                             'finished': False}
+                    entry['future'] = executor.submit(task, mcm_request, stats_sync, entry)
+                    pending.append(entry)
+                    occupied.add(entry['future'])
+
+                yield from self.collect(pending, occupied, progress, block=False)
+
+            while pending:
+                yield from self.collect(pending, occupied, progress, block=True)
+        finally:
+            # Inspections that did not start are cancelled, cursor is not past them
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        yield self.progress_lines(progress)
+        self.logger.info('Campaign %s inspection finished', campaign_id)
+
+    def inspect_request(self, mcm_request, stats_sync, entry):
+        """
+        Inspect a single request in a worker thread
+        Deadline of the inspection starts now, not when it was queued
+        """
+        entry['started'] = time.time()
+        with RateLimiter.throttled(self.rate_limit):
+            try:
+                return mcm_request.inspect(stats_sync=stats_sync)
+            except Exception as ex:
+                prepid = mcm_request.get_attribute('prepid')
+                self.logger.error('Exception while inspecting %s: %s', prepid, ex, exc_info=True)
+                return {'prepid': prepid, 'results': False, 'message': str(ex)}
+
+    def collect(self, pending, occupied, progress, block):
+        """
+        Yield results of finished and timed out inspections and move cursor
+        over the inspections that precede all unfinished ones
+        Timed out inspections keep their place in occupied until they return
+        """
+        if block and occupied:
+            # Wake up at the nearest deadline or to report progress
+            timeout = self.PROGRESS_INTERVAL
+            for entry in pending:
+                if not entry['finished'] and entry['started']:
+                    timeout = min(timeout, entry['started'] + self.deadline - time.time())
+
+            wait(occupied, timeout=max(0, timeout), return_when=FIRST_COMPLETED)
+
+        occupied.difference_update([future for future in occupied if future.done()])
+        now = time.time()
+        for entry in pending:
+            if entry['finished']:
+                continue
+
+            future = entry['future']
+            if future.done():
+                entry['finished'] = True
+                progress['done'] += 1
+                result = future.result()
+                if result.get('results'):
+                    yield '%s: Success!\n' % (entry['prepid'])
+                else:
+                    progress['failures'] += 1
+                    yield '%s: Failure: %s\n' % (entry['prepid'], result.get('message', '?'))
+            elif entry['started'] and now >= entry['started'] + self.deadline:
+                entry['finished'] = True
+                progress['done'] += 1
+                progress['timeouts'] += 1
+                self.logger.warning('Inspection of %s did not finish in %ss', entry['prepid'], self.deadline)
+                yield '%s: Timeout after %ss\n' % (entry['prepid'], self.deadline)
+
+        while pending and pending[0]['finished']:
+            progress['cursor'] = '%s:%s' % (progress['campaign'], pending.popleft()['prepid'])
+
+        if now - progress['reported'] >= self.PROGRESS_INTERVAL:
+            progress['reported'] = now
+            yield self.progress_lines(progress)
+
+    def progress_lines(self, progress):
+        elapsed = max(time.time() - progress['start'], 0.001)
+        return ('Progress of %s: %s/%s inspected, %s failures, %s timeouts, %.2f requests/s\n'
+                'Cursor: %s\n' % (progress['campaign'],
+                                  progress['done'],
+                                  progress['total'],
+                                  progress['failures'],
+                                  progress['timeouts'],
+                                  progress['done'] / elapsed,
+                                  progress['cursor']))
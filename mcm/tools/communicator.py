@@ -7,6 +7,7 @@ from email.utils import make_msgid, formatdate
 from tools.locator import locator
 import tools.settings as settings
 from tools.locker import locker
+from tools.metrics import downstream
 
 
 # Python 3: This is just a split
@@ -28,7 +29,7 @@ class communicator:
 
     def flush(self, Nmin):
         res = []
-        with locker.lock('accumulating_notifcations'):
+        with locker.local_lock('accumulating_notifcations'):
             for key in list(self.cache.keys()):
                 (subject, sender, addressee) = key
                 if self.cache[key]['N'] <= Nmin:
@@ -50,8 +51,8 @@ class communicator:
                 # self.logger.info('Sending a message from cache \n%s'% (text))
                 try:
                     msg.attach(MIMEText(text))
-                    with self._smtp_session() as smtpObj:
-                        smtpObj.sendmail(sender, destination, msg.as_string())    
+                    with downstream('smtp', 'send'), self._smtp_session() as smtpObj:
+                        smtpObj.sendmail(sender, destination, msg.as_string())
                     self.cache.pop(key)
                     res.append(subject)
                 except Exception as e:
@@ -99,7 +100,7 @@ class communicator:
         com__accumulate = settings.get_value('com_accumulate')
         force_com_accumulate = settings.get_value('force_com_accumulate')
         if force_com_accumulate or (accumulate and com__accumulate):
-            with locker.lock('accumulating_notifcations'):
+            with locker.local_lock('accumulating_notifcations'):
                 # get a subject where the request name is taken out
                 subject_type = " ".join([w for w in msg['Subject'].split() if w.count('-') != 2])
                 addressees = msg['To']
@@ -121,7 +122,7 @@ class communicator:
 
         try:
             msg.attach(MIMEText(text))
-            with self._smtp_session() as smtpObj:
+            with downstream('smtp', 'send'), self._smtp_session() as smtpObj:
                 communicator.logger.info('Sending %s to %s...' % (msg['Subject'], msg['To']))
                 smtpObj.sendmail(sender, destination, msg.as_string())
             return new_msg_ID
@@ -0,0 +1,49 @@
+"""
+Module that contains parsing of dataset names
+/<primary dataset>/<campaign>-<processing string>-v<version>/<tier>
+"""
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+
+DATASET_NAME = re.compile(r'^/([^/]+)/(([^/]*)-v(\d+))/([^/]+)$')
+# Processing string is the second to last part of processed dataset,
+# unversioned is the name without version, same for all versions of a dataset
+DatasetName = namedtuple('DatasetName',
+                         ['name', 'primary_dataset', 'processed_dataset', 'campaign',
+                          'processing_string', 'version', 'tier', 'unversioned'])
+
+
+@lru_cache(maxsize=65536)
+def parse(name):
+    """
+    Return DatasetName of a dataset name or None if name is not valid
+    Version is an integer, so v10 is newer than v9
+    Names are memoised, the same datasets are seen in every inspection
+    """
+    match = DATASET_NAME.match(name)
+    if not match:
+        return None
+
+    primary_dataset, processed_dataset, unversioned, version, datatier = match.groups()
+    parts = processed_dataset.split('-')
+    return DatasetName(name=name,
+                       primary_dataset=primary_dataset,
+                       processed_dataset=processed_dataset,
+                       campaign=parts[0],
+                       processing_string=parts[-2],
+                       version=int(version),
+                       tier=datatier,
+                       unversioned='/%s/%s/%s' % (primary_dataset, unversioned, datatier))
+
+
+def tier(name):
+    """
+    Return data tier of a dataset name, the last part of the name
+    """
+    dataset = parse(name)
+    if dataset:
+        return dataset.tier
+
+    return name.rsplit('/', 1)[-1]
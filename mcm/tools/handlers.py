@@ -47,20 +47,36 @@ class Worker(Thread):
 
 
 class ThreadPool:
-    """Pool of threads consuming tasks from a queue"""
+    """
+    Pool of threads consuming tasks from a queue
+    Threads are started with the first task, max_workers can be a function
+    that returns the number of threads, e.g. to read it from settings
+    """
     def __init__(self, name, max_workers):
         self.tasks = Queue(0)
         self.name = name
-        self.worker_number = max_workers
+        self.max_workers = max_workers
+        self.worker_number = 0
+        self.start_lock = Lock()
         self.logger = logging.getLogger("mcm_error")
-        worker_name_pool = ["Antanas", "Adrian", "Giovanni", "Gaelle", "Phat"]
 
-        for i in range(self.worker_number):  # number should be taken from DB
-            _name = "%s-%s" % (worker_name_pool[randint(0, 4)], i)
-            Worker(self.tasks, _name)  # number of concurrent worker threads
+    def start_workers(self):
+        """Start worker threads if they are not running yet"""
+        with self.start_lock:
+            if self.worker_number:
+                return
+
+            max_workers = self.max_workers() if callable(self.max_workers) else self.max_workers
+            worker_name_pool = ["Antanas", "Adrian", "Giovanni", "Gaelle", "Phat"]
+            for i in range(max_workers):
+                _name = "%s-%s" % (worker_name_pool[randint(0, 4)], i)
+                Worker(self.tasks, _name)  # number of concurrent worker threads
+
+            self.worker_number = max_workers
 
     def add_task(self, func, *args, **kargs):
         """Add a task to the queue"""
+        self.start_workers()
         self.logger.info("Adding a task: %s to the Queue %s. Currently in Queue: %s" % (
                 func, id(self.tasks), self.get_queue_length()))
 
@@ -76,7 +92,7 @@ class ThreadPool:
 
 # END OF THREAD POOL
 
-submit_pool = ThreadPool("submission", settings.get_value('threads_num_submission'))
+submit_pool = ThreadPool("submission", lambda: settings.get_value('threads_num_submission'))
 
 
 class Handler():
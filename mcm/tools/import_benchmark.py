@@ -0,0 +1,55 @@
+"""
+Module that checks that McM application can be imported quickly and
+without reaching the database
+Database urls point to an address that never responds, so any request
+made at import time blows the budget
+Usage: python -m tools.import_benchmark [budget in seconds]
+"""
+import os
+import subprocess
+import sys
+
+# Seconds that importing the application may take
+DEFAULT_BUDGET = 3.0
+# Number of imports, median of them is compared with the budget
+RUNS = 3
+# TEST-NET-1 address, reserved for documentation, nothing answers there
+UNREACHABLE_URL = 'http://192.0.2.1:5984/'
+
+
+def measure_import(module='main'):
+    """
+    Return seconds that importing given module took in a new interpreter
+    """
+    env = dict(os.environ)
+    env['MCM_COUCHDB_URL'] = UNREACHABLE_URL
+    env['MCM_LUCENE_URL'] = UNREACHABLE_URL
+    env['COUCH_CRED'] = 'Basic bm9ib2R5Om5vYm9keQ=='
+    code = 'import time; start = time.time(); import %s; print(time.time() - start)' % (module)
+    mcm_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, '-c', code],
+                            cwd=mcm_folder,
+                            env=env,
+                            capture_output=True,
+                            text=True,
+                            timeout=120)
+    if result.returncode != 0:
+        raise RuntimeError('Could not import %s:\n%s' % (module, result.stderr))
+
+    return float(result.stdout.strip().split('\n')[-1])
+
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_BUDGET
+    durations = sorted(measure_import() for _ in range(RUNS))
+    median = durations[len(durations) // 2]
+    print('Import of main took %.2fs (runs: %s), budget %.2fs' % (median,
+                                                                 ', '.join('%.2fs' % (d) for d in durations),
+                                                                 budget))
+    if median > budget:
+        print('Import is over budget')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
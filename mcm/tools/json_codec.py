@@ -0,0 +1,118 @@
+"""
+Module that contains JSON encoding and decoding used by the database layer
+and the REST API
+If orjson is installed, it is used instead of the standard json module
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data):
+    """
+    Decode JSON from str, bytes or a buffer
+    """
+    if orjson:
+        return orjson.loads(data)
+
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+
+    return json.loads(data)
+
+
+def load(response):
+    """
+    Decode JSON body of a response or other file-like object
+    Bodies that are already in memory are decoded in place without a copy
+    """
+    if orjson and hasattr(response, 'getbuffer'):
+        return orjson.loads(response.getbuffer())
+
+    return loads(response.read())
+
+
+def dumps(obj, indent=None, sort_keys=False):
+    """
+    Encode object as a JSON string
+    orjson supports only indentation of two spaces, so any indent
+    makes output indented with two spaces
+    """
+    if orjson:
+        option = 0
+        if indent:
+            option |= orjson.OPT_INDENT_2
+
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+
+        try:
+            return orjson.dumps(obj, option=option).decode('utf-8')
+        except TypeError:
+            # orjson is stricter, e.g. about non str keys or integers above 64 bits
+            pass
+
+    return json.dumps(obj, indent=indent, sort_keys=sort_keys)
+
+
+def dumps_bytes(obj):
+    """
+    Encode object as compact UTF-8 JSON, e.g. for HTTP request bodies
+    """
+    if orjson:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            pass
+
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def iter_dumps(obj, chunk_size=65536):
+    """
+    Encode object as compact UTF-8 JSON in chunks of about chunk_size bytes
+    Lists in the top level object are encoded item by item, so the whole
+    document is never held in memory at once
+    """
+    parts = []
+    size = 0
+
+    def add(part):
+        nonlocal size
+        parts.append(part)
+        size += len(part)
+
+    def items(values):
+        nonlocal parts, size
+        add(b'[')
+        for index, item in enumerate(values):
+            if index:
+                add(b',')
+
+            add(dumps_bytes(item))
+            if size >= chunk_size:
+                yield b''.join(parts)
+                parts = []
+                size = 0
+
+        add(b']')
+
+    if isinstance(obj, list):
+        yield from items(obj)
+    elif isinstance(obj, dict):
+        add(b'{')
+        for index, (key, value) in enumerate(obj.items()):
+            add((b',' if index else b'') + dumps_bytes(str(key)) + b':')
+            if isinstance(value, list):
+                yield from items(value)
+            else:
+                add(dumps_bytes(value))
+
+        add(b'}')
+    else:
+        add(dumps_bytes(obj))
+
+    yield b''.join(parts)
@@ -1,6 +1,7 @@
 import os
 import sys
 import logging
+import tempfile
 
 
 class locator:
@@ -230,6 +231,97 @@ class locator:
         """
         return bool(os.getenv("MCM_DEBUG"))
 
+    def workers(self):
+        """
+        Number of worker processes of the production WSGI server.
+        This can be overwritten using the environment variable:
+            `MCM_WORKERS`
+        With more than one worker, locks and batch semaphores are
+        shared between the processes, see `lock_service`.
+        """
+        return int(os.getenv("MCM_WORKERS", "1"))
+
+    def threads(self):
+        """
+        Number of request threads in every worker process of the
+        production WSGI server. This can be overwritten using the
+        environment variable: `MCM_THREADS`
+        """
+        return int(os.getenv("MCM_THREADS", "16"))
+
+    def request_timeout(self):
+        """
+        Seconds after which an unresponsive worker process is restarted and
+        for which a worker may finish its requests during a graceful reload.
+        This can be overwritten using the environment variable:
+            `MCM_REQUEST_TIMEOUT`
+        """
+        return int(os.getenv("MCM_REQUEST_TIMEOUT", "300"))
+
+    def locks_folder(self):
+        """
+        Retrieve the absolute path of the folder with lock files that are
+        shared by worker processes. This can be overwritten using the
+        environment variable: `MCM_LOCKS_FOLDER`
+
+        Returns:
+            str: Lock folder absolute path.
+        """
+        custom_path = os.getenv("MCM_LOCKS_FOLDER")
+        if custom_path:
+            return custom_path
+
+        return os.path.join(tempfile.gettempdir(), "mcm_locks")
+
+    def lock_service(self):
+        """
+        Service that holds locks and batch semaphores against other McM
+        processes. This can be overwritten using the environment variable:
+            `MCM_LOCK_SERVICE`
+        Services:
+            local: only threads of a single process are excluded.
+            file: flock of files in `locks_folder`, processes on one machine.
+            couchdb: leases in the `locks` database, processes on any machine.
+        Defaults to `file` with more than one worker, `local` otherwise.
+        """
+        service = os.getenv("MCM_LOCK_SERVICE")
+        if service:
+            return service
+
+        return "file" if self.workers() > 1 else "local"
+
+    def lock_ttl(self):
+        """
+        Seconds after which a CouchDB lease of a process that stopped renewing
+        it expires. This can be overwritten using the environment variable:
+            `MCM_LOCK_TTL`
+        """
+        return int(os.getenv("MCM_LOCK_TTL", "60"))
+
+    def inspect_workers(self):
+        """
+        Number of requests of a campaign that are inspected at the same
+        time. This can be overwritten using the environment variable:
+            `MCM_INSPECT_WORKERS`
+        """
+        return int(os.getenv("MCM_INSPECT_WORKERS", "4"))
+
+    def inspect_deadline(self):
+        """
+        Seconds after which inspection of a single request is reported as
+        timed out and the campaign inspection moves on. This can be
+        overwritten using the environment variable: `MCM_INSPECT_DEADLINE`
+        """
+        return int(os.getenv("MCM_INSPECT_DEADLINE", "120"))
+
+    def inspect_rate_limit(self):
+        """
+        Requests per second that campaign inspections of a worker process
+        may send to each of CouchDB, couchdb-lucene and Stats2. This can be
+        overwritten using the environment variable: `MCM_INSPECT_RATE_LIMIT`
+        """
+        return float(os.getenv("MCM_INSPECT_RATE_LIMIT", "50"))
+
     def logs_folder(self):
         """
         Retrieve the absolute path for the log folder.
@@ -270,6 +362,14 @@ class locator:
 
         return "cernmx.cern.ch", 25
 
+    def follow_changes_feed(self):
+        """
+        Follow CouchDB _changes feeds to evict cached documents changed
+        by other McM processes. This can be disabled by setting the
+        environment variable: $MCM_DISABLE_CHANGES_FEED.
+        """
+        return not bool(os.getenv("MCM_DISABLE_CHANGES_FEED"))
+
     def use_gssapi_with_mic_for_auth(self):
         """
         In case `gssapi_with_mic` is available, use a Kerberos ticket
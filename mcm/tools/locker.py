@@ -1,7 +1,676 @@
+import bisect
+import fcntl
+import glob
+import hashlib
 import logging
+import os
+import random
+import socket
+import time
+import uuid
+import weakref
 
-from threading import RLock, Event, Lock
-from collections import defaultdict
+from threading import RLock, Event, Lock, Thread, current_thread, get_ident
+from collections import OrderedDict
+from flask import has_request_context, request
+from tools.locator import locator
+from couchdb_layer.unit_of_work import current_unit
+
+
+class LockServiceError(Exception):
+    """
+    Lock service could not decide whether lock is held
+    """
+
+
+class StaleLockError(LockServiceError):
+    """
+    Fencing token of a lock is not the latest one, lock was taken over by
+    another holder, e.g. after lease of this one expired
+    """
+
+
+def lock_digest(lock_id):
+    return hashlib.sha1(str(lock_id).encode('utf-8')).hexdigest()
+
+
+def lock_file_name(kind, lock_id):
+    """
+    Return path of the file that represents given lock in the shared locks folder
+    """
+    return os.path.join(locator().locks_folder(), '%s-%s' % (kind, lock_digest(lock_id)))
+
+
+def token_file_name(kind):
+    """
+    Return path of the file with the last fencing token of locks of given kind
+    """
+    return os.path.join(locator().locks_folder(), 'tokens-%s' % (kind))
+
+
+class LocalLockService(object):
+    """
+    Locks are held only against threads of this process
+    """
+    name = 'local'
+
+    def acquire(self, lock, blocking):
+        lock.token = (lock.token or 0) + 1
+        return True
+
+    def release(self, lock):
+        pass
+
+    def check_token(self, lock):
+        """
+        Raise StaleLockError if token of the held lock is not the latest one
+        Thread locks of this process cannot be taken over
+        """
+
+    def publish_count(self, lock_id, count):
+        pass
+
+    def total_count(self, lock_id, count):
+        return count
+
+
+class FileLockService(LocalLockService):
+    """
+    Locks are held against processes on the same machine by an exclusive
+    flock of a lock file, the file also keeps the fencing token of the holder
+    Lock file is removed by the holder when it releases the lock, fencing
+    tokens of every kind of locks are counted in one tokens file, so they
+    keep increasing
+    Counters of every process are files named after the process id
+    """
+    name = 'file'
+
+    def acquire(self, lock, blocking):
+        os.makedirs(locator().locks_folder(), exist_ok=True)
+        path = lock_file_name(lock.kind, lock.lock_id)
+        while True:
+            lock_file = open(path, 'a+')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                if not blocking:
+                    lock_file.close()
+                    return False
+
+                lock.contended = True
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            # Previous holder might have removed the file while this process
+            # waited, lock is held only by flock of the file that is at path
+            try:
+                if os.path.samestat(os.fstat(lock_file.fileno()), os.stat(path)):
+                    break
+            except FileNotFoundError:
+                pass
+
+            lock_file.close()
+
+        lock.token = self.next_token(lock.kind)
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(str(lock.token))
+        lock_file.flush()
+        lock.handle = lock_file
+        return True
+
+    def next_token(self, kind):
+        """
+        Increment and return the last fencing token of locks of given kind
+        """
+        with open(token_file_name(kind), 'a+') as token_file:
+            fcntl.flock(token_file, fcntl.LOCK_EX)
+            token_file.seek(0)
+            try:
+                token = int(token_file.read() or 0) + 1
+            except ValueError:
+                token = 1
+
+            token_file.seek(0)
+            token_file.truncate()
+            token_file.write(str(token))
+            token_file.flush()
+            return token
+
+    def release(self, lock):
+        # File is removed while it is still locked, waiters open a new one
+        os.remove(lock_file_name(lock.kind, lock.lock_id))
+        fcntl.flock(lock.handle, fcntl.LOCK_UN)
+        lock.handle.close()
+        lock.handle = None
+
+    def check_token(self, lock):
+        try:
+            with open(lock_file_name(lock.kind, lock.lock_id)) as lock_file:
+                token = lock_file.read()
+        except FileNotFoundError:
+            token = None
+
+        if token != str(lock.token):
+            raise StaleLockError('Token %s of lock %s is stale, latest is %s' % (lock.token, lock.lock_id, token))
+
+    def publish_count(self, lock_id, count):
+        """
+        Write counter of this process to the shared locks folder
+        """
+        path = '%s-%s' % (lock_file_name('semaphore', lock_id), os.getpid())
+        if count:
+            os.makedirs(locator().locks_folder(), exist_ok=True)
+            with open(path, 'w') as count_file:
+                count_file.write(str(count))
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def total_count(self, lock_id, count):
+        """
+        Return sum of counters of all processes that are still running
+        """
+        total = count
+        for path in glob.glob('%s-*' % (lock_file_name('semaphore', lock_id))):
+            pid = int(path.rsplit('-', 1)[-1])
+            if pid == os.getpid():
+                continue
+
+            try:
+                # Counters of dead processes are removed
+                os.kill(pid, 0)
+                with open(path) as count_file:
+                    total += int(count_file.read() or 0)
+            except ProcessLookupError:
+                os.remove(path)
+            except (OSError, ValueError):
+                pass
+
+        return total
+
+
+class CouchLeaseLockService(LocalLockService):
+    """
+    Locks are held against all McM processes by leases, documents in the
+    locks database with an owner and an expiration time
+    Lease is taken by saving the document with its current _rev, so only one
+    of concurrent processes succeeds, every new holder gets the next fencing
+    token from the tokens document of the kind of locks
+    Released leases are deleted, held leases are renewed in the background,
+    lease of a process that died expires after ttl seconds and is taken over
+    and later deleted by the next holder
+    Counters are kept in one document per id with a counter of every process,
+    document is deleted when no process counts anymore
+    """
+    name = 'couchdb'
+    logger = logging.getLogger('mcm_error')
+    # Seconds between checks whether a held lease was released or expired
+    POLL_INTERVAL = 0.2
+
+    def __init__(self, db_name='locks', ttl=None):
+        from couchdb_layer.mcm_database import database
+        self.db = database(db_name, cache_enabled=False)
+        self.ttl = ttl or locator().lock_ttl()
+        self.owner = '%s:%s:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        # Leases and counters of this process that are renewed
+        self.leases = {}
+        self.counts = {}
+        # Reentrant, renew publishes counters
+        self.renew_lock = RLock()
+        self.renewer = None
+
+    def save(self, doc):
+        """
+        Save document and return whether it was saved
+        Return False on conflict, raise LockServiceError on other errors
+        """
+        status = self.db.save_with_status(doc)
+        if status['ok']:
+            return True
+
+        if status['error'] == 'conflict':
+            return False
+
+        raise LockServiceError('Could not save %s in %s: %s %s' % (doc['_id'],
+                                                                   self.db.db_name,
+                                                                   status['error'],
+                                                                   status['reason']))
+
+    def start_renewer(self):
+        with self.renew_lock:
+            if self.renewer and self.renewer.is_alive():
+                return
+
+            self.renewer = Thread(target=self.renew_loop, name='lock-lease-renewer', daemon=True)
+            self.renewer.start()
+
+    def renew_loop(self):
+        while True:
+            time.sleep(self.ttl / 3.0)
+            try:
+                self.renew()
+            except Exception as ex:
+                self.logger.error('Could not renew leases: %s', ex)
+
+    def renew(self):
+        """
+        Extend held leases and counters of this process
+        """
+        with self.renew_lock:
+            for lock in list(self.leases.values()):
+                lease = lock.handle
+                lease['expires'] = time.time() + self.ttl
+                if not self.save(lease):
+                    self.logger.error('Lease %s of %s was taken over, lock is not held anymore',
+                                      lease['_id'],
+                                      lease['name'])
+                    del self.leases[lease['_id']]
+
+            for lock_id, count in list(self.counts.items()):
+                self.publish_count(lock_id, count)
+
+    def next_token(self, kind):
+        """
+        Increment and return the last fencing token of locks of given kind
+        """
+        tokens_id = 'tokens-%s' % (kind)
+        while True:
+            tokens = self.db.get(tokens_id) or {'_id': tokens_id, 'token': 0}
+            tokens['token'] += 1
+            if self.save(tokens):
+                return tokens['token']
+
+    def acquire(self, lock, blocking):
+        lease_id = '%s-%s' % (lock.kind, lock_digest(lock.lock_id))
+        while True:
+            lease = self.db.get(lease_id) or {'_id': lease_id}
+            now = time.time()
+            if lease.get('owner') and lease.get('expires', 0) > now:
+                if not blocking:
+                    return False
+
+                lock.contended = True
+                time.sleep(min(self.POLL_INTERVAL * random.uniform(0.5, 1.5), lease['expires'] - now))
+                continue
+
+            # Lease is either new or expired, then _rev makes sure that only
+            # one process takes it over
+            lease.update({'name': str(lock.lock_id),
+                          'owner': self.owner,
+                          'token': self.next_token(lock.kind),
+                          'expires': time.time() + self.ttl})
+            if self.save(lease):
+                break
+
+        lock.handle = lease
+        lock.token = lease['token']
+        with self.renew_lock:
+            self.leases[lease_id] = lock
+
+        self.start_renewer()
+        return True
+
+    def release(self, lock):
+        lease = lock.handle
+        lock.handle = None
+        with self.renew_lock:
+            if self.leases.pop(lease['_id'], None) is None:
+                # Lease was lost, do not release lease of the new holder
+                return
+
+            # Fencing tokens are kept in the tokens document
+            lease['_deleted'] = True
+            try:
+                if not self.save(lease):
+                    self.logger.error('Lease %s of %s was taken over before release', lease['_id'], lease['name'])
+            except Exception as ex:
+                # Protected work is done, lease just expires after ttl
+                self.logger.error('Could not release lease %s of %s, it expires in %ss: %s',
+                                  lease['_id'],
+                                  lease['name'],
+                                  self.ttl,
+                                  ex)
+
+    def check_token(self, lock):
+        """
+        Read the lease again, it must still belong to this process with the
+        same token and must not have expired
+        """
+        lease = self.db.get(lock.handle['_id'])
+        if (not lease
+                or lease.get('owner') != self.owner
+                or lease.get('token') != lock.token
+                or lease.get('expires', 0) <= time.time()):
+            raise StaleLockError('Token %s of lock %s is stale, lease is %s' % (lock.token, lock.lock_id, lease))
+
+    def publish_count(self, lock_id, count):
+        counter_id = 'semaphore-%s' % (lock_digest(lock_id))
+        if count:
+            self.start_renewer()
+
+        with self.renew_lock:
+            if count:
+                self.counts[lock_id] = count
+            else:
+                self.counts.pop(lock_id, None)
+
+            while True:
+                counter = self.db.get(counter_id) or {'_id': counter_id, 'name': str(lock_id), 'counts': {}}
+                now = time.time()
+                counts = {owner: value for owner, value in counter['counts'].items()
+                          if owner != self.owner and value['expires'] > now}
+                if count:
+                    counts[self.owner] = {'count': count, 'expires': now + self.ttl}
+
+                if counts == counter['counts']:
+                    return
+
+                counter['counts'] = counts
+                if not counts:
+                    counter['_deleted'] = True
+
+                if self.save(counter):
+                    return
+
+    def total_count(self, lock_id, count):
+        counter = self.db.get('semaphore-%s' % (lock_digest(lock_id)))
+        if not counter:
+            return count
+
+        now = time.time()
+        return count + sum(value['count'] for owner, value in counter['counts'].items()
+                           if owner != self.owner and value['expires'] > now)
+
+
+lock_services = {service.name: service for service in (LocalLockService,
+                                                        FileLockService,
+                                                        CouchLeaseLockService)}
+__lock_service = None
+__lock_service_lock = Lock()
+
+
+def lock_service():
+    """
+    Return lock service of this process, chosen by locator().lock_service()
+    """
+    global __lock_service
+    with __lock_service_lock:
+        if __lock_service is None:
+            __lock_service = lock_services[locator().lock_service()]()
+
+        return __lock_service
+
+
+def current_owner():
+    """
+    Return description of the current thread and its REST request
+    """
+    owner = current_thread().name
+    if has_request_context():
+        owner += ' %s %s' % (request.method, request.full_path.rstrip('?'))
+
+    return owner
+
+
+class LockStatistics(object):
+    """
+    Contention, wait and hold times of locks, keyed by kind and lock id
+    Only outermost acquire of reentrant lock is counted
+    Statistics of at most max_keys locks are kept, the least recently used
+    ones that are not held and not waited for are dropped
+    """
+    # Upper bounds of histogram buckets in seconds, the last bucket is unbounded
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+    # Numeric attributes that hottest() can sort by
+    SORT_KEYS = ('acquisitions', 'contended', 'failed', 'waiting',
+                 'wait_total', 'wait_max', 'wait_average',
+                 'hold_total', 'hold_max', 'hold_average', 'held_for')
+    MAX_KEYS = 1000
+
+    def __init__(self, max_keys=MAX_KEYS):
+        self.max_keys = max_keys
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def entry(self, kind, lock_id):
+        """
+        Return entry of a lock, must be called with self.lock
+        """
+        key = (kind, lock_id)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = {'kind': kind,
+                     'lock_id': str(lock_id),
+                     'acquisitions': 0,
+                     'contended': 0,
+                     'failed': 0,
+                     'waiting': 0,
+                     'wait_total': 0.0,
+                     'wait_max': 0.0,
+                     'hold_total': 0.0,
+                     'hold_max': 0.0,
+                     'wait_histogram': [0] * (len(self.BUCKETS) + 1),
+                     'hold_histogram': [0] * (len(self.BUCKETS) + 1),
+                     'owner': None,
+                     'held_since': None}
+            self.entries[key] = entry
+            if len(self.entries) > self.max_keys:
+                for old_key, old_entry in list(self.entries.items()):
+                    if not old_entry['owner'] and not old_entry['waiting']:
+                        del self.entries[old_key]
+                        break
+        else:
+            self.entries.move_to_end(key)
+
+        return entry
+
+    def record_waiting(self, kind, lock_id, change):
+        with self.lock:
+            self.entry(kind, lock_id)['waiting'] += change
+
+    def record_failure(self, kind, lock_id):
+        with self.lock:
+            self.entry(kind, lock_id)['failed'] += 1
+
+    def record_acquire(self, kind, lock_id, wait, contended, owner):
+        with self.lock:
+            entry = self.entry(kind, lock_id)
+            entry['acquisitions'] += 1
+            entry['contended'] += 1 if contended else 0
+            entry['wait_total'] += wait
+            entry['wait_max'] = max(entry['wait_max'], wait)
+            entry['wait_histogram'][bisect.bisect_left(self.BUCKETS, wait)] += 1
+            entry['owner'] = owner
+            entry['held_since'] = time.time()
+
+    def record_release(self, kind, lock_id, hold):
+        with self.lock:
+            entry = self.entry(kind, lock_id)
+            entry['hold_total'] += hold
+            entry['hold_max'] = max(entry['hold_max'], hold)
+            entry['hold_histogram'][bisect.bisect_left(self.BUCKETS, hold)] += 1
+            entry['owner'] = None
+            entry['held_since'] = None
+
+    def hottest(self, top=20, sort='wait_total'):
+        """
+        Return statistics of top locks with the highest value of sort attribute
+        """
+        now = time.time()
+        with self.lock:
+            entries = [dict(entry,
+                            wait_histogram=list(entry['wait_histogram']),
+                            hold_histogram=list(entry['hold_histogram']))
+                       for entry in self.entries.values()]
+
+        for entry in entries:
+            entry['wait_average'] = entry['wait_total'] / entry['acquisitions'] if entry['acquisitions'] else 0
+            released = sum(entry['hold_histogram'])
+            entry['hold_average'] = entry['hold_total'] / released if released else 0
+            entry['held_for'] = now - entry['held_since'] if entry['held_since'] else None
+
+        entries.sort(key=lambda entry: entry.get(sort) or 0, reverse=True)
+        return entries[:top]
+
+lock_statistics = LockStatistics()
+
+
+class ServiceLock(object):
+    """
+    Lock of a single id, held against threads of this process by a thread
+    lock and against other processes by the lock service
+    Thread lock is acquired first, so the service is contended only by
+    processes, reentrant lock asks the service only on its outermost acquire
+    After acquire, token is the fencing token of the holder, writes protected
+    by the lock pass the lock as fence, so they are not done by a holder
+    that lost the lock, see check_fence
+    """
+
+    def __init__(self, dictionary, service, lock_id):
+        self.dictionary = dictionary
+        self.service = service
+        self.lock_id = lock_id
+        self.kind = dictionary.kind
+        self.reentrant = dictionary.reentrant
+        self.thread_lock = RLock() if self.reentrant else Lock()
+        self.depth = 0
+        self.owner_thread = None
+        # Open file, lease or other data of the service about the held lock
+        self.handle = None
+        self.token = None
+        # Whether acquire had to wait, set also by the service
+        self.contended = False
+        self.acquired_at = None
+
+    def acquire(self, blocking=True):
+        start = time.monotonic()
+        contended = not self.thread_lock.acquire(False)
+        if contended:
+            if not blocking:
+                lock_statistics.record_failure(self.kind, self.lock_id)
+                return False
+
+            lock_statistics.record_waiting(self.kind, self.lock_id, 1)
+            try:
+                self.thread_lock.acquire()
+            finally:
+                lock_statistics.record_waiting(self.kind, self.lock_id, -1)
+
+        if self.depth == 0:
+            self.contended = contended
+            try:
+                acquired = self.service.acquire(self, blocking)
+            except BaseException:
+                self.thread_lock.release()
+                raise
+
+            if not acquired:
+                self.thread_lock.release()
+                lock_statistics.record_failure(self.kind, self.lock_id)
+                return False
+
+            self.owner_thread = get_ident()
+            self.dictionary.hold(self)
+            if self.dictionary.fresh_reads:
+                # Documents read before the lock might have changed since
+                unit = current_unit(create=False)
+                if unit is not None:
+                    unit.clear()
+
+            self.acquired_at = time.monotonic()
+            lock_statistics.record_acquire(self.kind,
+                                           self.lock_id,
+                                           self.acquired_at - start,
+                                           self.contended,
+                                           current_owner())
+
+        self.depth += 1
+        return True
+
+    def release(self):
+        if self.depth == 0 or (self.reentrant and self.owner_thread != get_ident()):
+            raise RuntimeError('Cannot release lock %s that is not held' % (self.lock_id))
+
+        self.depth -= 1
+        if self.depth == 0:
+            self.owner_thread = None
+            lock_statistics.record_release(self.kind, self.lock_id, time.monotonic() - self.acquired_at)
+            try:
+                self.service.release(self)
+            finally:
+                self.dictionary.unhold(self)
+                self.thread_lock.release()
+        else:
+            self.thread_lock.release()
+
+    def locked(self):
+        return self.depth > 0
+
+    def check_fence(self):
+        """
+        Raise StaleLockError if this lock is not held anymore with the latest
+        fencing token, called right before a protected write
+        """
+        if self.depth == 0:
+            raise StaleLockError('Lock %s is not held' % (self.lock_id))
+
+        self.service.check_token(self)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def __repr__(self):
+        return '<%s lock depth=%s token=%s>' % (self.service.name, self.depth, self.token)
+
+
+class LockDictionary(object):
+    """
+    Dictionary that creates a lock for every missing id
+    Locks are referenced weakly, so lock that is not held and that nobody
+    keeps a reference to is garbage collected, held locks are kept until
+    they are released
+    If fresh_reads is set, acquiring a lock clears identity map of the
+    current unit of work, so documents are read again under the lock
+    """
+
+    def __init__(self, kind, reentrant, service=None, fresh_reads=False):
+        self.kind = kind
+        self.reentrant = reentrant
+        self.service = service
+        self.fresh_reads = fresh_reads
+        self.locks = weakref.WeakValueDictionary()
+        self.held = {}
+        self.lock = Lock()
+
+    def __getitem__(self, lock_id):
+        with self.lock:
+            lock = self.locks.get(lock_id)
+            if lock is None:
+                lock = ServiceLock(self, self.service or lock_service(), lock_id)
+                self.locks[lock_id] = lock
+
+            return lock
+
+    def __contains__(self, lock_id):
+        return lock_id in self.locks
+
+    def __len__(self):
+        return len(self.locks)
+
+    def hold(self, lock):
+        with self.lock:
+            self.held[lock.lock_id] = lock
+
+    def unhold(self, lock):
+        with self.lock:
+            self.held.pop(lock.lock_id, None)
+
+    def items(self):
+        with self.lock:
+            return list(self.locks.items())
 
 
 class Locker(object):
@@ -12,32 +681,33 @@ class Locker(object):
     with locker.lock(id):
         do something locked
     after releasing lock
+    Locks are held against other McM processes according to locator().lock_service(),
+    local locks protect only state of this process, e.g. caches
     """
     # using reentrant lock so other threads don't release it
-    internal_lock = RLock()
-    lock_dictionary = defaultdict(RLock)
+    lock_dictionary = LockDictionary('rlock', reentrant=True, fresh_reads=True)
     # we also have a dict of Lock which can be release from different threads
-    thread_lock_dictionary = defaultdict(Lock)
+    thread_lock_dictionary = LockDictionary('lock', reentrant=False, fresh_reads=True)
+    local_lock_dictionary = LockDictionary('local', reentrant=True, service=LocalLockService())
     logger = logging.getLogger("mcm_error")
 
     def lock(self, lock_id):
-        # defaultdict and setdefault are not atomic in python 2,6, some manual locking needed
-        with self.internal_lock:
-            # obtaining the lock has to be inside internal_lock space, as we cannot both obtain a lock and
-            # do something to it without risking race conditions
-            lock = self.lock_dictionary[lock_id]
-        return lock
+        return self.lock_dictionary[lock_id]
+
+    def local_lock(self, lock_id):
+        """
+        Return reentrant lock held only against threads of this process
+        """
+        return self.local_lock_dictionary[lock_id]
 
     def acquire(self, lock_id, blocking=True):
-        with self.internal_lock:
-            lock = self.lock_dictionary[lock_id]
-            self.logger.info("Acquiring lock %s for lock_id %s" % (lock, lock_id))
+        lock = self.lock_dictionary[lock_id]
+        self.logger.info("Acquiring lock %s for lock_id %s" % (lock, lock_id))
         return lock.acquire(blocking)
 
     def release(self, lock_id):
-        with self.internal_lock:
-            lock = self.lock_dictionary[lock_id]
-            self.logger.info("Releasing lock %s for lock_id %s" % (lock, lock_id))
+        lock = self.lock_dictionary[lock_id]
+        self.logger.info("Releasing lock %s for lock_id %s" % (lock, lock_id))
         return lock.release()
 
     # Thread sharable lock methods: can be released by different threads
@@ -46,27 +716,23 @@ class Locker(object):
         """
         Create and return Lock object to be shared between threads
         """
-        with self.internal_lock:
-            lock = self.thread_lock_dictionary[lock_id]
-        return lock
+        return self.thread_lock_dictionary[lock_id]
 
     def thread_acquire(self, lock_id, blocking=True):
         """
         Acquire a Lock in our  global locks dictionary
         """
-        with self.internal_lock:
-            lock = self.thread_lock_dictionary[lock_id]
-            self.logger.info("Acquiring simple lock %s for lock_id %s" % (lock, lock_id))
+        lock = self.thread_lock_dictionary[lock_id]
+        self.logger.info("Acquiring simple lock %s for lock_id %s" % (lock, lock_id))
         return lock.acquire(blocking)
 
     def thread_release(self, lock_id):
         """
-        Releasing a lock but also keeping lock object in dict.
-        ???? maybe this should be fixed to not save unneeded not used lock objects
+        Release a Lock, it is kept in the dictionary only while
+        someone references it
         """
-        with self.internal_lock:
-            lock = self.thread_lock_dictionary[lock_id]
-            self.logger.info("Releasing simple lock %s for lock_id %s" % (lock, lock_id))
+        lock = self.thread_lock_dictionary[lock_id]
+        self.logger.info("Releasing simple lock %s for lock_id %s" % (lock, lock_id))
         return lock.release()
 
 locker = Locker()
@@ -76,42 +742,51 @@ class SemaphoreEvents(object):
     """
     Class works like semaphore (counts number of threads) and uses events to call waiting threads when the counter
     reaches 0. Non-waiting threads should use increment/decrement statements.
+    Counters are also published to the lock service, so count and is_set include threads of all processes
+    Counters that drop to 0 are removed, missing counter means 0
     """
 
     logger = logging.getLogger("mcm_error")
-    event_dictionary = defaultdict(Event)
-    count_dictionary = defaultdict(int)
+    event_dictionary = {}
+    count_dictionary = {}
 
     def count(self, lock_id):
-        with locker.lock(lock_id):
-            return self.count_dictionary[lock_id]
+        with locker.local_lock(lock_id):
+            return lock_service().total_count(lock_id, self.count_dictionary.get(lock_id, 0))
 
     def increment(self, lock_id):
-        with locker.lock(lock_id):
-            self.count_dictionary[lock_id] += 1
-            self.event_dictionary[lock_id].clear()
-            self.logger.info("Semaphore {0} incremented -> {1}".format(lock_id, self.count_dictionary[lock_id]))
+        with locker.local_lock(lock_id):
+            count = self.count_dictionary.get(lock_id, 0) + 1
+            self.count_dictionary[lock_id] = count
+            self.event_dictionary.setdefault(lock_id, Event()).clear()
+            lock_service().publish_count(lock_id, count)
+            self.logger.info("Semaphore {0} incremented -> {1}".format(lock_id, count))
 
     def decrement(self, lock_id):
-        with locker.lock(lock_id):
-            self.count_dictionary[lock_id] = max(0, self.count_dictionary[lock_id] - 1)  # floor to 0
-            self.logger.info("Semaphore {0} decremented -> {1}".format(lock_id, self.count_dictionary[lock_id]))
-            if self.count_dictionary[lock_id] == 0:
-                self.event_dictionary[lock_id].set()
+        with locker.local_lock(lock_id):
+            count = max(0, self.count_dictionary.get(lock_id, 0) - 1)  # floor to 0
+            lock_service().publish_count(lock_id, count)
+            self.logger.info("Semaphore {0} decremented -> {1}".format(lock_id, count))
+            if count:
+                self.count_dictionary[lock_id] = count
+            else:
+                self.count_dictionary.pop(lock_id, None)
+                event = self.event_dictionary.pop(lock_id, None)
+                if event:
+                    event.set()
 
     def wait(self, lock_id, timeout):
-        with locker.lock(lock_id):
-            event = self.event_dictionary[lock_id]
+        with locker.local_lock(lock_id):
+            event = self.event_dictionary.get(lock_id)
+
+        if event is None:
+            return True
+
         return event.wait(timeout)
 
     def is_set(self, lock_id):
-        with locker.lock(lock_id):
-            # return self.event_dictionary[lock_id].is_set()
-            if lock_id in self.event_dictionary:
-                return self.event_dictionary[lock_id].is_set()
-            else:
-                # because the default oonstructor is with is_set=False
-                # in case the batch was created, sever cycled, and one tries to announce it on the "second" session
-                return True
+        # in case the batch was created, sever cycled, and one tries to announce it on the "second" session,
+        # there is no counter and it is set
+        return self.count(lock_id) == 0
 
-semaphore_events = SemaphoreEvents()
\ No newline at end of file
+semaphore_events = SemaphoreEvents()
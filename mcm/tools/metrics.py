@@ -0,0 +1,211 @@
+"""
+Module that contains process metrics of McM: counters, gauges and histograms
+served in Prometheus text format
+Every thread writes to its own shard, so recording takes no lock and does
+not serialize requests, shards are summed only when metrics are rendered
+and shards of finished threads are folded into one retired total
+"""
+import bisect
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+# Upper bounds of latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Upper bounds of size histogram buckets in bytes
+SIZE_BUCKETS = (128, 1024, 8192, 65536, 524288, 4194304, 33554432)
+
+
+class Metrics(object):
+    """
+    Registry of metrics of this process
+    Metrics are declared once with their type and help text and then
+    recorded with labels given as keyword arguments, labels of a metric
+    must be always given in the same order
+    """
+
+    def __init__(self):
+        self.declared = {}
+        # (thread, shard) of threads that recorded something
+        self.shards = []
+        # Sum of shards of threads that finished
+        self.retired = {}
+        self.shards_lock = threading.Lock()
+        self.local = threading.local()
+
+    def declare(self, name, metric_type, help_text, buckets=None):
+        self.declared[name] = (metric_type, help_text, buckets)
+
+    def shard(self):
+        """
+        Return shard of the current thread
+        """
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = {}
+            self.local.shard = shard
+            with self.shards_lock:
+                self.shards.append((threading.current_thread(), shard))
+
+        return shard
+
+    def increment(self, name, value=1, **labels):
+        """
+        Increment a counter or change a gauge
+        """
+        shard = self.shard()
+        key = (name, tuple(labels.items()))
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        Add value to a histogram
+        """
+        shard = self.shard()
+        key = (name, tuple(labels.items()))
+        histogram = shard.get(key)
+        buckets = self.declared[name][2]
+        if histogram is None:
+            # Bucket counts, the last bucket is +Inf, then sum of values
+            histogram = [0] * (len(buckets) + 2)
+            shard[key] = histogram
+
+        histogram[bisect.bisect_left(buckets, value)] += 1
+        histogram[-1] += value
+
+    @staticmethod
+    def add_shard(totals, shard):
+        """
+        Add values of a shard to totals
+        """
+        for key, value in shard.items():
+            if isinstance(value, list):
+                total = totals.get(key)
+                if total is None:
+                    totals[key] = list(value)
+                else:
+                    for index, count in enumerate(value):
+                        total[index] += count
+            else:
+                totals[key] = totals.get(key, 0) + value
+
+    def live_shards(self):
+        """
+        Return shards of running threads, shards of finished threads are
+        added to retired totals and dropped, so short lived threads, e.g.
+        of thread pools, do not make the list grow
+        """
+        with self.shards_lock:
+            live = []
+            for thread, shard in self.shards:
+                if thread.is_alive():
+                    live.append((thread, shard))
+                else:
+                    # Finished thread does not write to its shard anymore
+                    self.add_shard(self.retired, shard)
+
+            self.shards = live
+            totals = {}
+            self.add_shard(totals, self.retired)
+            return [shard for _, shard in live], totals
+
+    def collect(self):
+        """
+        Return sum of all shards, dictionary of (name, labels) and value
+        """
+        shards, totals = self.live_shards()
+        for shard in shards:
+            # Copy, so owner thread can add keys while iterating
+            self.add_shard(totals, shard.copy())
+
+        return totals
+
+    def value(self, name, **labels):
+        """
+        Return current value of a counter or a gauge
+        """
+        key = (name, tuple(labels.items()))
+        shards, totals = self.live_shards()
+        return totals.get(key, 0) + sum(shard.get(key, 0) for shard in shards)
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ''
+
+        escaped = ('%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                   for label, value in labels)
+        return '{%s}' % (','.join(escaped))
+
+    def render(self):
+        """
+        Return all metrics in Prometheus text exposition format
+        """
+        by_name = {}
+        for (name, labels), value in self.collect().items():
+            by_name.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name in sorted(by_name):
+            metric_type, help_text, buckets = self.declared[name]
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for labels, value in sorted(by_name[name], key=lambda item: item[0]):
+                if metric_type != HISTOGRAM:
+                    lines.append('%s%s %s' % (name, self.format_labels(labels), value))
+                    continue
+
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), value[:-1]):
+                    cumulative += count
+                    lines.append('%s_bucket%s %s' % (name, self.format_labels(labels, (('le', bound),)), cumulative))
+
+                lines.append('%s_sum%s %s' % (name, self.format_labels(labels), value[-1]))
+                lines.append('%s_count%s %s' % (name, self.format_labels(labels), cumulative))
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.declare('mcm_rest_calls_total', COUNTER,
+                'REST resource calls by resource and method, including rejected ones')
+metrics.declare('mcm_http_requests_total', COUNTER,
+                'Finished REST requests by resource, method and status code')
+metrics.declare('mcm_http_requests_in_flight', GAUGE,
+                'REST requests being processed by resource and method')
+metrics.declare('mcm_http_request_duration_seconds', HISTOGRAM,
+                'Duration of REST requests by resource and method', LATENCY_BUCKETS)
+metrics.declare('mcm_http_response_size_bytes', HISTOGRAM,
+                'Size of REST response bodies by resource and method', SIZE_BUCKETS)
+metrics.declare('mcm_downstream_duration_seconds', HISTOGRAM,
+                'Duration of calls to CouchDB, couchdb-lucene, SSH and SMTP', LATENCY_BUCKETS)
+metrics.declare('mcm_downstream_errors_total', COUNTER,
+                'Failed calls to CouchDB, couchdb-lucene, SSH and SMTP')
+metrics.declare('mcm_process_start_time_seconds', GAUGE,
+                'Start time of the process since unix epoch, every worker process has its own metrics')
+metrics.increment('mcm_process_start_time_seconds', time.time(), pid=os.getpid())
+
+
+@contextmanager
+def downstream(service, operation):
+    """
+    Record duration of the block as a call to a downstream service,
+    exception raised in the block counts as an error
+    """
+    start = time.monotonic()
+    try:
+        yield
+    except BaseException:
+        metrics.increment('mcm_downstream_errors_total', service=service, operation=operation)
+        raise
+    finally:
+        metrics.observe('mcm_downstream_duration_seconds',
+                        time.monotonic() - start,
+                        service=service,
+                        operation=operation)
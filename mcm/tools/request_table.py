@@ -0,0 +1,174 @@
+"""
+Module that contains column oriented tables of request fields for reports
+"""
+import calendar
+import logging
+from array import array
+from couchdb_layer.mcm_database import database
+from tools.locator import locator
+
+
+SECONDS_PER_DAY = 86400.0
+
+
+def submission_time(history):
+    """
+    Return unix time of the last submission in request history,
+    NaN if request was never submitted
+    Dates look like 2024-01-31-23-59 and are split instead of strptime
+    """
+    for entry in reversed(history or []):
+        if entry.get('step') == 'submitted':
+            year, month, day, hour, minute = entry['updater']['submission_date'].split('-')
+            return float(calendar.timegm((int(year), int(month), int(day), int(hour), int(minute), 0)))
+
+    return float('nan')
+
+
+def last_workflow(reqmgr_name):
+    """
+    Return name of the last workflow of a request or None
+    """
+    return reqmgr_name[-1]['name'] if reqmgr_name else None
+
+
+class RequestTable:
+    """
+    Projected fields of many requests stored column by column
+    Documents are read page by page and only their converted values are
+    kept, numeric columns are arrays of doubles, so columns derived from
+    them are computed for all rows at once
+    Columns are given as name -> (field, converter), converter may be None
+    """
+    logger = logging.getLogger('mcm_error')
+    COLUMNS = {}
+    NUMERIC = ()
+
+    def __init__(self, columns=None, numeric=None):
+        self.columns = columns or self.COLUMNS
+        numeric = self.NUMERIC if numeric is None else numeric
+        self.data = {name: array('d') if name in numeric else [] for name in self.columns}
+
+    @classmethod
+    def search(cls, db, query, columns=None, numeric=None, page_size=500):
+        """
+        Return table of all requests that match couchdb-lucene query
+        """
+        table = cls(columns, numeric)
+        fields = sorted(set(field for field, _ in table.columns.values()))
+        for doc in db.iter_search(query, page_size=page_size, include_fields=','.join(fields)):
+            table.append(doc)
+
+        return table
+
+    def append(self, doc):
+        for name, (field, converter) in self.columns.items():
+            value = doc.get(field)
+            if converter:
+                value = converter(value)
+            elif isinstance(self.data[name], array):
+                value = float(value or 0)
+
+            self.data[name].append(value)
+
+    def __len__(self):
+        return len(self.data[next(iter(self.data))]) if self.data else 0
+
+    def __getitem__(self, name):
+        return self.data[name]
+
+    def add_column(self, name, values):
+        """
+        Add a derived column, numeric values are stored in an array
+        """
+        self.data[name] = values
+        return values
+
+
+class StalledRequests(RequestTable):
+    """
+    Table of submitted requests with days since submission, days remaining
+    and percentage of completion of every request
+    """
+    COLUMNS = {'prepid': ('prepid', None),
+               'submitted': ('history', submission_time),
+               'completed_events': ('completed_events', None),
+               'total_events': ('total_events', None),
+               'workflow': ('reqmgr_name', last_workflow),
+               'priority': ('priority', None)}
+    NUMERIC = ('submitted', 'completed_events', 'total_events')
+    # Number of prepids in one couchdb-lucene query of batches
+    BATCH_QUERY_SIZE = 50
+
+    def compute(self, now):
+        """
+        Compute elapsed and remaining days and percentage of completion
+        Remaining time is extrapolated from the rate so far, infinite if
+        nothing was completed, completion is capped at 100%
+        """
+        inf = float('inf')
+        completed = self['completed_events']
+        total = self['total_events']
+        elapsed = self.add_column('elapsed', array('d', [(now - s) / SECONDS_PER_DAY for s in self['submitted']]))
+        self.add_column('remaining', array('d', [max(0., e * (t / c - 1)) if c else inf
+                                                 for e, c, t in zip(elapsed, completed, total)]))
+        self.add_column('fraction', array('d', [min(100., c * 100. / t) if t else 100.
+                                                for c, t in zip(completed, total)]))
+
+    def stalled(self, time_since, time_remaining, below_completed):
+        """
+        Return row indices of requests that are below given completion and
+        either will need more than time_remaining days or did not progress
+        in time_since days
+        Requests without submission in history are skipped
+        """
+        inf = float('inf')
+        rows = []
+        for row, (elapsed, remaining, fraction) in enumerate(zip(self['elapsed'], self['remaining'], self['fraction'])):
+            if fraction > below_completed or elapsed != elapsed:
+                continue
+
+            if (remaining > time_remaining and remaining != inf) or (elapsed > time_since and remaining != 0):
+                rows.append(row)
+
+        skipped = sum(1 for elapsed in self['elapsed'] if elapsed != elapsed)
+        if skipped:
+            self.logger.warning('%s submitted requests have no submission in history', skipped)
+
+        return rows
+
+    def batches(self, rows):
+        """
+        Return dictionary of prepid and the last announced or held batch that
+        contains the request, with one couchdb-lucene query per chunk of rows
+        """
+        prepids = [self['prepid'][row] for row in rows]
+        wanted = set(prepids)
+        bdb = database('batches')
+        in_batch = {}
+        for start in range(0, len(prepids), self.BATCH_QUERY_SIZE):
+            query = {'contains': prepids[start:start + self.BATCH_QUERY_SIZE],
+                     'status': ['announced', 'hold']}
+            for mcm_batch in bdb.search(query, page=-1, include_fields='prepid,requests'):
+                for batch_request in mcm_batch.get('requests', []):
+                    prepid = batch_request.get('content', {}).get('pdmv_prep_id')
+                    # Batch with the greatest prepid is the last one
+                    if prepid in wanted and mcm_batch['prepid'] > in_batch.get(prepid, ''):
+                        in_batch[prepid] = mcm_batch['prepid']
+
+        return in_batch
+
+    def workflow_statuses(self, rows):
+        """
+        Return dictionary of workflow name and its last status in Stats2,
+        all workflows are fetched with a single bulk lookup
+        """
+        names = sorted(set(self['workflow'][row] for row in rows if self['workflow'][row]))
+        stats_db = database('requests', url=locator().stats_database_url(), cache_enabled=False)
+        statuses = {}
+        for workflow in stats_db.bulk_get(names, include_fields='RequestTransition'):
+            transitions = workflow.get('RequestTransition')
+            if transitions:
+                statuses[workflow['_id']] = transitions[-1]['Status']
+
+        return statuses
@@ -0,0 +1,120 @@
+"""
+Module that contains building of JSON responses of the REST API and their
+compression
+Large JSON documents are streamed, responses are compressed with brotli or
+gzip if client accepts it, brotli is used only if it is installed
+"""
+import itertools
+import zlib
+
+from flask import Response, request
+from tools import json_codec
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Documents with a list of at least this many items are streamed
+STREAM_MIN_ITEMS = 100
+# Smaller bodies are not compressed
+COMPRESS_MIN_SIZE = 1024
+# Fast levels, responses are compressed on every request
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+COMPRESSED_MIMETYPES = ('application/json', 'application/javascript', 'text/')
+ENCODINGS = ('br', 'gzip') if brotli else ('gzip',)
+
+
+def is_large(data):
+    """
+    Return whether data is a list or a dictionary with a list that is worth streaming
+    """
+    if isinstance(data, dict):
+        return any(isinstance(value, list) and len(value) >= STREAM_MIN_ITEMS for value in data.values())
+
+    return isinstance(data, list) and len(data) >= STREAM_MIN_ITEMS
+
+
+def json_response(data, code, headers=None):
+    """
+    Make a response with compact JSON body, large documents are streamed
+    """
+    if is_large(data):
+        response = Response(itertools.chain(json_codec.iter_dumps(data), (b'\n',)))
+    else:
+        response = Response(json_codec.dumps_bytes(data) + b'\n')
+
+    response.status_code = code
+    response.mimetype = 'application/json'
+    if headers:
+        for key, value in headers.items():
+            response.headers[key] = value
+
+    return response
+
+
+def compressor(encoding):
+    """
+    Return functions compressing a chunk, flushing compressed data of all
+    chunks so far and finishing the stream
+    """
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        return compressor.process, compressor.flush, compressor.finish
+
+    # wbits 31 is gzip format
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+
+def compress_chunks(chunks, encoding, flush=False):
+    """
+    Compress chunks of bytes or text, text is encoded as UTF-8
+    With flush, every chunk is sent as soon as it is produced, so streamed
+    lines such as progress reach the client without waiting for the end
+    """
+    compress, flush_chunk, finish = compressor(encoding)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+
+        compressed = compress(chunk)
+        if flush:
+            compressed += flush_chunk()
+
+        if compressed:
+            yield compressed
+
+    yield finish()
+
+
+def compress_response(response):
+    """
+    Compress response body with encoding accepted by the client
+    Streamed responses are compressed chunk by chunk
+    """
+    if (response.status_code < 200
+            or response.status_code in (204, 304)
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or not (response.mimetype or '').startswith(COMPRESSED_MIMETYPES)):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(ENCODINGS)
+    if not encoding:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, encoding, flush=True)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+
+        response.set_data(b''.join(compress_chunks((data,), encoding)))
+
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -1,22 +1,86 @@
+"""
+Settings of McM
+All settings are held in an immutable snapshot that is loaded at once and
+read without locks, changes replace the whole snapshot
+"""
+import logging
 import sys
+import time
+from threading import RLock
+from types import MappingProxyType
 from couchdb_layer.mcm_database import database
-from tools.locker import locker
-from cachelib import SimpleCache
+from couchdb_layer.changes_listener import ChangesListener
+from tools import json_codec
 
-__cache = SimpleCache()
 __db = database('settings')
-# Cache timeout in seconds
+# Seconds after which snapshot is reloaded if _changes of settings are not followed
 CACHE_TIMEOUT = 30 * 60
+# Label and JSON of setting, every read decodes a new copy, so callers can
+# modify what they get
+__snapshot = None
+__loaded_at = 0
+# Held by loads and swaps of snapshot, readers do not take it
+__swap_lock = RLock()
+
+def is_current(snapshot):
+    if snapshot is None:
+        return False
+
+    if __db.db_name in database.followed_databases:
+        return True
+
+    return time.time() - __loaded_at < CACHE_TIMEOUT
+
+def load():
+    """
+    Load all settings to a new snapshot
+    If loading fails, previous snapshot is kept
+    """
+    global __snapshot, __loaded_at
+    with __swap_lock:
+        if is_current(__snapshot):
+            return __snapshot
+
+        try:
+            docs = __db.iter_view('settings', 'all')
+            __snapshot = MappingProxyType({doc['_id']: json_codec.dumps_bytes(doc) for doc in docs})
+            __loaded_at = time.time()
+        except Exception as ex:
+            if __snapshot is None:
+                raise
+
+            logging.getLogger('mcm_error').error('Could not reload settings: %s', ex)
+
+        return __snapshot
+
+def swap(label, setting):
+    """
+    Replace snapshot with a copy where setting is updated, or removed if
+    setting is None
+    """
+    global __snapshot
+    with __swap_lock:
+        if __snapshot is None:
+            return
+
+        snapshot = dict(__snapshot)
+        if setting:
+            snapshot[label] = json_codec.dumps_bytes(setting)
+        else:
+            snapshot.pop(label, None)
+
+        __snapshot = MappingProxyType(snapshot)
 
 def get(label):
-    cached_value = __cache.get(label)
-    if cached_value is not None:
-        return cached_value
+    snapshot = __snapshot
+    if not is_current(snapshot):
+        snapshot = load()
 
-    with locker.lock(label):
-        setting = __db.get(label)
-        __cache.set(label, setting, timeout=CACHE_TIMEOUT)
-        return setting
+    body = snapshot.get(label)
+    if body is None:
+        return None
+
+    return json_codec.loads(body)
 
 def get_value(label):
     return get(label)['value']
@@ -25,33 +89,47 @@ def get_notes(label):
     return get(label)['notes']
 
 def add(label, setting):
-    with locker.lock(label):
-        result = __db.save(setting)
-        if result:
-            __cache.set(label, setting, timeout=CACHE_TIMEOUT)
+    result = __db.save(setting)
+    if result:
+        swap(label, setting)
 
-        return result
+    return result
 
 def set_value(label, value):
-    with locker.lock(label):
-        setting = get(label)
-        setting['value'] = value
-        return set(label, setting)
+    setting = get(label)
+    setting['value'] = value
+    return set(label, setting)
 
 def set(label, setting):
-    with locker.lock(label):
-        result = __db.update(setting)
-        if result:
-            __cache.set(label, setting, timeout=CACHE_TIMEOUT)
+    result = __db.update(setting)
+    if result:
+        swap(label, setting)
 
-        return result
+    return result
+
+def forget(label, deleted=False):
+    """
+    Update setting in snapshot, called when setting changes in the database
+    """
+    with __swap_lock:
+        if __snapshot is not None:
+            swap(label, None if deleted else __db.get(label))
+
+ChangesListener.subscribe('settings', forget)
 
 def cache_size():
-    return len(__cache._cache), sys.getsizeof(__cache._cache)
+    snapshot = __snapshot or {}
+    return len(snapshot), sys.getsizeof(snapshot) + sum(sys.getsizeof(body) for body in snapshot.values())
 
 def clear_cache():
+    """
+    Drop snapshot, it is loaded again on the next read
+    """
+    global __snapshot
     size = cache_size()
-    __cache.clear()
+    with __swap_lock:
+        __snapshot = None
+
     return size
 
 def get_htcondor_config_for_validation():
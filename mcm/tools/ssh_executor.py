@@ -6,6 +6,7 @@ import random
 
 from tools.locator import locator
 from tools.logger import InjectionLogAdapter
+from tools.metrics import downstream
 from threading import BoundedSemaphore
 import tools.settings as settings
 
@@ -63,28 +64,29 @@ class ssh_executor:
         try:
             time.sleep(2 * random.randrange(8))
             gssapi_available = self._gssapi_with_mic_available()
-            if gssapi_available and locator().use_gssapi_with_mic_for_auth():
-                self.logger.info(
-                    'Authenticating to remote host (%s) using: gssapi-with-mic',
-                    self.ssh_server
-                )
-                self.ssh_client.connect(
-                    self.ssh_server, 
-                    port=self.ssh_server_port, 
-                    username=us, 
-                    gss_auth=gssapi_available
-                )
-            else:
-                self.logger.info(
-                    'Authenticating to remote host (%s) using: password',
-                    self.ssh_server
-                )
-                self.ssh_client.connect(
-                    self.ssh_server, 
-                    port=self.ssh_server_port, 
-                    username=us, 
-                    password=pw
-                )
+            with downstream('ssh', 'connect'):
+                if gssapi_available and locator().use_gssapi_with_mic_for_auth():
+                    self.logger.info(
+                        'Authenticating to remote host (%s) using: gssapi-with-mic',
+                        self.ssh_server
+                    )
+                    self.ssh_client.connect(
+                        self.ssh_server, 
+                        port=self.ssh_server_port, 
+                        username=us, 
+                        gss_auth=gssapi_available
+                    )
+                else:
+                    self.logger.info(
+                        'Authenticating to remote host (%s) using: password',
+                        self.ssh_server
+                    )
+                    self.ssh_client.connect(
+                        self.ssh_server, 
+                        port=self.ssh_server_port, 
+                        username=us, 
+                        password=pw
+                    )
         except paramiko.AuthenticationException as ex:
             self.logger.error('Could not authenticate to remote server "%s:%d". Reason: %s' % (self.ssh_server, self.ssh_server_port, ex))
             return
@@ -105,7 +107,9 @@ class ssh_executor:
         retries = 2
         while True:
             try:
-                with self.semaph:
+                # Only opening the channel is timed, callers read the output
+                # and exit status of the command later
+                with self.semaph, downstream('ssh', 'channel_setup'):
                     return self.ssh_client.exec_command(cmd)
             except paramiko.SSHException as ex:
                 self.logger.error('Could not execute remote command. Reason: %s' % ex)
@@ -0,0 +1,206 @@
+"""
+Module that contains synchronisation of McM requests with Stats2
+"""
+import logging
+from threading import Lock
+from couchdb_layer.mcm_database import database
+from json_layer.json_base import json_base
+from tools.locator import locator
+
+
+def attribute(mcm_request, name):
+    """
+    Return attribute of request object or request document
+    """
+    if isinstance(mcm_request, dict):
+        return mcm_request.get(name)
+
+    return mcm_request.get_attribute(name)
+
+
+class StatsSync:
+    """
+    Stats2 data of many requests fetched at once
+    Workflows of all requests are fetched with one multi-key query of the
+    Stats2 requests view, workflows that are not in the view are fetched with
+    _bulk_get when they are needed for the first time, so are the chained
+    requests that contain the requests and next requests of those chains
+    request.get_stats(stats_sync=...) reads its data from here
+    Requests are request objects or documents with at least prepid and
+    reqmgr_name, sync() needs request objects
+    Lazy fetches are done under a lock, so requests may be inspected by
+    several threads with one StatsSync
+    """
+    logger = logging.getLogger('mcm_error')
+    # Fields of request documents that are enough for prefetching
+    FIELDS = 'prepid,reqmgr_name,status'
+
+    def __init__(self, requests):
+        self.requests = list(requests)
+        self.prepids = [attribute(r, 'prepid') for r in self.requests]
+        self.stats_db = database('requests', url=locator().stats_database_url(), cache_enabled=False)
+        try:
+            self.workflows = self.stats_db.query_view_keys('_designDoc', 'requests', self.prepids)
+        except Exception as ex:
+            self.logger.error('Error fetching Stats2 workflows of %s requests: %s', len(self.prepids), ex)
+            self.workflows = {}
+
+        # Workflow name -> Stats2 document or None
+        self.fetched = None
+        # Prepid -> next requests in chains
+        self.next_requests = None
+        self.fetch_lock = Lock()
+
+    def workflows_of(self, prepid):
+        """
+        Return Stats2 workflows that list given request
+        """
+        return self.workflows.get(prepid, [])
+
+    def workflow(self, reqmgr_name):
+        """
+        Return Stats2 document of a workflow or None
+        """
+        if self.fetched is None:
+            with self.fetch_lock:
+                if self.fetched is None:
+                    self.fetch_workflows()
+
+        return self.fetched.get(reqmgr_name)
+
+    def fetch_workflows(self):
+        """
+        Fetch all workflows of requests that are not listed in the view
+        Result is published only when it is complete
+        """
+        fetched = {}
+        for workflows in self.workflows.values():
+            for workflow in workflows:
+                fetched[workflow.get('RequestName')] = workflow
+
+        missing = set()
+        for mcm_request in self.requests:
+            for reqmgr in attribute(mcm_request, 'reqmgr_name') or []:
+                if reqmgr['name'] not in fetched:
+                    missing.add(reqmgr['name'])
+
+        if missing:
+            try:
+                for workflow in self.stats_db.bulk_get(sorted(missing)):
+                    fetched[workflow['_id']] = workflow
+            except Exception as ex:
+                self.logger.error('Error fetching %s Stats2 workflows: %s', len(missing), ex)
+
+        self.fetched = fetched
+
+    def next_requests_of(self, prepid):
+        """
+        Return documents of requests that follow given request in its chains
+        """
+        if self.next_requests is None:
+            with self.fetch_lock:
+                if self.next_requests is None:
+                    self.fetch_next_requests()
+
+        return self.next_requests.get(prepid, [])
+
+    def fetch_next_requests(self):
+        """
+        Fetch next requests in chains of all requests
+        """
+        next_prepids = {}
+        try:
+            chains = database('chained_requests').query_view_keys('chained_requests', 'contains', self.prepids)
+            for prepid, chained_requests in chains.items():
+                for chained_request in chained_requests:
+                    chain = chained_request.get('chain', [])
+                    index = chain.index(prepid)
+                    if index < len(chain) - 1:
+                        next_prepids.setdefault(prepid, []).append(chain[index + 1])
+
+            all_next_prepids = sorted(set(p for prepids in next_prepids.values() for p in prepids))
+            next_requests = {r['_id']: r for r in database('requests').bulk_get(all_next_prepids)}
+        except Exception as ex:
+            self.logger.error('Error fetching chains of %s requests: %s', len(self.prepids), ex)
+            self.next_requests = {}
+            return
+
+        self.next_requests = {prepid: [next_requests[p] for p in prepids if p in next_requests]
+                              for prepid, prepids in next_prepids.items()}
+
+    def sync(self, forced=False):
+        """
+        Update all requests from Stats2 and write changed ones in bulk
+        Requests whose bulk write failed, e.g. because of a conflict, are read
+        again, updated from Stats2 on top of the new revision and saved one
+        by one, they replace the outdated objects in self.requests, prepids of
+        requests that still could not be saved are in self.failed
+        Return list of prepids of changed and saved requests
+        """
+        changed = []
+        self.failed = []
+        with json_base.batch() as save_batch:
+            for mcm_request in self.requests:
+                prepid = mcm_request.get_attribute('prepid')
+                try:
+                    if mcm_request.get_stats(forced=forced, stats_sync=self):
+                        mcm_request.save()
+                        changed.append(mcm_request)
+                except Exception as ex:
+                    self.logger.error('Error updating stats of %s: %s', prepid, ex)
+
+        failed = set(status['id'] for status in save_batch.failed())
+        saved = []
+        for mcm_request in changed:
+            prepid = mcm_request.get_attribute('prepid')
+            if mcm_request.get_attribute('_id') not in failed:
+                saved.append(prepid)
+                continue
+
+            updated = self.update_again(mcm_request, forced)
+            if updated:
+                self.requests[self.requests.index(mcm_request)] = updated
+                saved.append(prepid)
+            else:
+                self.failed.append(prepid)
+
+        self.logger.info('Stats of %s/%s requests changed, %s could not be saved',
+                         len(saved),
+                         len(self.requests),
+                         len(self.failed))
+        return saved
+
+    def update_again(self, mcm_request, forced=False):
+        """
+        Update request from Stats2 on top of its latest revision and save it
+        Return new object of the saved request or None if nothing changed or
+        it could not be saved
+        """
+        prepid = mcm_request.get_attribute('prepid')
+        # Cache and unit of work would return the revision that conflicted
+        fresh_db = database('requests', cache_enabled=False)
+        for attempt in range(1, json_base.SAVE_ATTEMPTS + 1):
+            try:
+                current = fresh_db.get(prepid)
+                if not current:
+                    return None
+
+                updated = mcm_request.__class__(current)
+                if not updated.get_stats(forced=forced, stats_sync=self):
+                    # Somebody else already wrote the same data
+                    return None
+
+                status = fresh_db.save_with_status(updated.json())
+                if status['ok']:
+                    return updated
+
+                if status['error'] != 'conflict':
+                    self.logger.error('Could not save stats of %s: %s', prepid, status)
+                    return None
+            except Exception as ex:
+                self.logger.error('Error updating stats of %s again: %s', prepid, ex)
+                return None
+
+            self.logger.info('Conflict while saving stats of %s, attempt %s', prepid, attempt)
+
+        return None
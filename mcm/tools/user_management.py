@@ -1,13 +1,16 @@
 #!/usr/bin/env python
 
 import logging
+import queue
 import sys
+import time
 
 from collections import defaultdict
-from tools.locker import locker
+from threading import Lock, Thread
 from couchdb_layer.mcm_database import database
+from couchdb_layer.changes_listener import ChangesListener
 from tools.enum import Enum
-from flask import request, has_request_context
+from flask import request, has_request_context, g
 from cachelib import SimpleCache
 
 
@@ -53,6 +56,13 @@ class user_pack:
         }
         return user_dict
 
+    @classmethod
+    def forget(cls, username, deleted=False):
+        """
+        Remove user from cache, called when user changes in the database
+        """
+        cls.__user_cache.delete(username)
+
     def get_username(self):
         return self.user_dict['login']
 
@@ -94,46 +104,195 @@ access_rights = Enum(*roles)
 
 
 class authenticator:
+    """
+    Roles of users are resolved from a snapshot of the users database that is
+    loaded and refreshed by a background thread and updated from its _changes
+    feed, so role check of a REST request does not read or write the database
+    """
     logger = logging.getLogger("mcm_error")
 
     # roles list is a list of valid roles for a page
     __db = database('users')
-    __users_roles_cache = SimpleCache()
+    # Username -> (role, email) of all registered users, replaced as a whole
+    # by the refresher and read without locks
+    __users = {}
+    # Whether __users has all users, until then unknown users are read one by one
+    __complete = False
+    # Users changed while refresh reads the database, username -> (role, email)
+    # or None if deleted, they are applied to the new snapshot before it is
+    # published, so the refresh does not undo them
+    __changed = None
+    __users_lock = Lock()
+    __refresher = None
+    __refresher_lock = Lock()
+    # Emails to update and refresh requests, handled by the refresher thread
+    __tasks = queue.Queue()
+    role_indexes = {role: index for index, role in enumerate(roles)}
 
-    # Cache timeout in seconds
-    CACHE_TIMEOUT = 30 * 60
+    # Seconds between full reloads of the users database
+    REFRESH_INTERVAL = 5 * 60
+    # Seconds between attempts to load the first snapshot
+    RETRY_INTERVAL = 30
+
+    @classmethod
+    def start_refresher(cls):
+        if cls.__refresher is not None:
+            return
+
+        with cls.__refresher_lock:
+            if cls.__refresher is None:
+                cls.__refresher = Thread(target=cls.refresh_loop, name='user-roles-refresher', daemon=True)
+                cls.__refresher.start()
+
+    @classmethod
+    def refresh_loop(cls):
+        while True:
+            try:
+                cls.refresh_all()
+            except Exception as ex:
+                cls.logger.error('Could not load user roles: %s', ex)
+
+            interval = cls.REFRESH_INTERVAL if cls.__complete else cls.RETRY_INTERVAL
+            deadline = time.time() + interval
+            while True:
+                try:
+                    task = cls.__tasks.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+
+                if task is None:
+                    # Reload requested
+                    break
+
+                try:
+                    cls.update_email(*task)
+                except Exception as ex:
+                    cls.logger.error('Could not update email of %s: %s', task[0], ex)
+
+    @classmethod
+    def refresh_all(cls):
+        """
+        Replace snapshot with roles and emails of all users
+        """
+        with cls.__users_lock:
+            cls.__changed = {}
+
+        try:
+            users = {}
+            for user in cls.__db.iter_view('users', 'all', include_fields='role,email'):
+                users[user['_id']] = (user.get('role', roles[0]), user.get('email'))
+
+            with cls.__users_lock:
+                for username, user in cls.__changed.items():
+                    if user is None:
+                        users.pop(username, None)
+                    else:
+                        users[username] = user
+
+                cls.__users = users
+                cls.__complete = True
+        finally:
+            with cls.__users_lock:
+                cls.__changed = None
+
+        cls.logger.info('Loaded roles of %s users', len(users))
+
+    @classmethod
+    def set_user(cls, username, user):
+        """
+        Set role and email of user in the snapshot, remove the user if user
+        is None, change is also recorded for a refresh that is running
+        """
+        with cls.__users_lock:
+            if user is None:
+                cls.__users.pop(username, None)
+            else:
+                cls.__users[username] = user
+
+            if cls.__changed is not None:
+                cls.__changed[username] = user
+
+    @classmethod
+    def update_email(cls, username, email):
+        user = cls.__db.get(username)
+        if user and user.get('email') != email:
+            user['email'] = email
+            cls.__db.update(user)
 
     # get the roles that are registered to a specific username
     @classmethod
     def get_user_role(cls, username, email=None):
+        """
+        Return role of the user, unregistered users are 'user'
+        If email differs from the registered one, it is updated in the background
+        """
         if not username:
             return 'user'
 
-        with locker.lock(username):
-            cached_value = cls.__users_roles_cache.get(username)
-            if cached_value:
-                return cached_value
+        cls.start_refresher()
+        user = cls.__users.get(username)
+        if user is None and not cls.__complete:
+            # Snapshot is not loaded yet
+            doc = cls.__db.get(username, include_fields='role,email')
+            if doc:
+                user = (doc.get('role', roles[0]), doc.get('email'))
+                cls.set_user(username, user)
+
+        if user is None:
+            return 'user'
+
+        role, registered_email = user
+        if email and email != registered_email:
+            cls.set_user(username, (role, email))
+            cls.__tasks.put((username, email))
 
-            user_role = 'user'
-            user = cls.__db.get(username)
-            if user:
-                user_role = user.get('role', roles[0])
-                if email and user.get('email') != email:
-                    user['email'] = email
-                    cls.__db.update(user)
+        return role
 
-            cls.__users_roles_cache.set(username, user_role, timeout=cls.CACHE_TIMEOUT)
-            return user_role
+    @classmethod
+    def role_index(cls, role):
+        try:
+            return cls.role_indexes[role]
+        except KeyError:
+            raise ValueError('Role {0} is not recognized'.format(role))
 
     @classmethod
     def get_user_role_index(cls, username, email=None):
         r = cls.get_user_role(username, email)
-        return getattr(access_rights, r), r
+        return cls.role_index(r), r
+
+    @classmethod
+    def current_user(cls):
+        """
+        Return username, role and role index of the user of current request
+        They are resolved once per request and kept in flask.g
+        """
+        user = getattr(g, 'mcm_user', None)
+        if user is None:
+            username = user_pack().get_username()
+            role = cls.get_user_role(username)
+            user = {'username': username, 'role': role, 'role_index': cls.role_index(role)}
+            g.mcm_user = user
+
+        return user
 
     @classmethod
     def set_user_role(cls, username, role):
-        with locker.lock(username):
-            cls.__users_roles_cache.set(username, role, timeout=cls.CACHE_TIMEOUT)
+        user = cls.__users.get(username)
+        cls.set_user(username, (role, user[1] if user else None))
+
+    @classmethod
+    def forget(cls, username, deleted=False):
+        """
+        Update role of user in the snapshot, called when user changes in the database
+        """
+        if deleted:
+            cls.set_user(username, None)
+            return
+
+        # Projected documents are not cached, so the new revision is read
+        doc = cls.__db.get(username, include_fields='role,email')
+        if doc:
+            cls.set_user(username, (doc.get('role', roles[0]), doc.get('email')))
 
     @classmethod
     def can_access(cls, username, limit):
@@ -141,26 +300,26 @@ class authenticator:
         returns True, if a user matches the base role or higher
         returns False, otherwise.
         """
-        role = cls.get_user_role(username)
-        try:
-            if getattr(access_rights, role) >= limit:
-                return True
-            return False
-        except AttributeError:
-            raise ValueError('Role {0} is not recognized'.format(role))
+        return cls.role_index(cls.get_user_role(username)) >= limit
 
     @classmethod
     def cache_size(cls):
         """
-        Return number of elements in cache and cache size in bytes
+        Return number of users in snapshot and its size in bytes
         """
-        return len(cls.__users_roles_cache._cache), sys.getsizeof(cls.__users_roles_cache._cache)
+        return len(cls.__users), sys.getsizeof(cls.__users)
 
     @classmethod
     def clear_cache(cls):
         """
-        Clear cache
+        Clear snapshot and reload it in the background
         """
         size = cls.cache_size()
-        cls.__users_roles_cache.clear()
+        cls.__users = {}
+        cls.__complete = False
+        cls.__tasks.put(None)
         return size
+
+
+ChangesListener.subscribe('users', user_pack.forget)
+ChangesListener.subscribe('users', authenticator.forget)